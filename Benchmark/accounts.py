@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Compares transfers per second of the accounts database access before and after connection pooling.
+
+Usage: python3 -m Benchmark.accounts [transfers] [threads]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import apsw
+
+from Client.Accounts import Accounts
+
+ACCOUNTS = 100
+INITIAL_BALANCE = 10 ** 9
+
+
+class UnpooledAccounts():
+    """
+    Database access as it was done before: a new connection for every call and 3 ms busy timeout.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def transfer(self, from_account_id: str, to_account_id: str, amount: int):
+        connection = apsw.Connection(self.filename)
+        connection.setbusytimeout(3)
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT balance FROM accounts WHERE id = ?", [from_account_id])
+            cursor.fetchone()
+            cursor.execute("UPDATE accounts SET balance = balance + ? WHERE id = ?", (-amount, from_account_id))
+            cursor.execute("UPDATE accounts SET balance = balance + ? WHERE id = ?", (amount, to_account_id))
+        # The balance was read again by a separate connection for logging
+        connection = apsw.Connection(self.filename)
+        connection.setbusytimeout(3)
+        connection.cursor().execute("SELECT balance FROM accounts WHERE id = ?", [from_account_id]).fetchone()
+
+
+class PooledAccounts():
+
+    def __init__(self, filename, pool_size):
+        self.accounts = Accounts(filename, pool_size=pool_size)
+
+    def transfer(self, from_account_id: str, to_account_id: str, amount: int):
+        self.accounts.transfer_money(from_account_id, to_account_id, amount)
+        self.accounts.get_account_balance(from_account_id)
+
+
+def create_database(filename):
+    connection = apsw.Connection(filename)
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE accounts (id TEXT NOT NULL, balance INTEGER)")
+    with connection:
+        for account in range(ACCOUNTS):
+            cursor.execute("INSERT INTO accounts VALUES (?, ?)", (f"account{account}", INITIAL_BALANCE))
+    connection.close()
+
+
+def run(accounts, transfers: int, threads: int) -> dict:
+    failures = 0
+
+    def transfer(number):
+        nonlocal failures
+        try:
+            accounts.transfer(f"account{number % ACCOUNTS}", f"account{(number + 1) % ACCOUNTS}", 1)
+        except apsw.BusyError:
+            failures += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(transfer, range(transfers)))
+    duration = time.perf_counter() - start
+    return {'transfers_per_second': transfers / duration, 'failures': failures}
+
+
+def main():
+    transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with tempfile.TemporaryDirectory() as directory:
+        unpooled_file = os.path.join(directory, "unpooled.sqlite")
+        pooled_file = os.path.join(directory, "pooled.sqlite")
+        create_database(unpooled_file)
+        create_database(pooled_file)
+        results = {
+            'unpooled': run(UnpooledAccounts(unpooled_file), transfers, threads),
+            'pooled': run(PooledAccounts(pooled_file, threads), transfers, threads)
+        }
+    for name, result in results.items():
+        print(f"{name:>10}: {result['transfers_per_second']:10.1f} transfers/s, {result['failures']} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Compares bytes on the wire and encode/decode time per message of the connection codecs.
+
+Usage: python3 -m Benchmark.codecs [messages]
+"""
+
+import secrets
+import sys
+import time
+import uuid
+
+from Codecs import CODECS, decode_frame
+
+
+def sample_envelopes() -> dict:
+    rsa_message = secrets.token_bytes(512)  # 4096 bit RSA ciphertext
+    session_message = {
+        'scheme': 'rsa-aes-gcm',
+        'session': secrets.token_urlsafe(12),
+        'key': secrets.token_bytes(512),
+        'nonce': secrets.token_bytes(16),
+        'ciphertext': secrets.token_bytes(64),
+        'tag': secrets.token_bytes(16)
+    }
+    return {
+        'rsa request': {
+            'id': str(uuid.uuid4()), 'type': 'request',
+            'payload': {'action': 'send_message', 'data': {'recipient_id': 'bank', 'message': rsa_message}}
+        },
+        'session request': {
+            'id': str(uuid.uuid4()), 'type': 'request',
+            'payload': {'action': 'send_message', 'data': {'recipient_id': 'bank', 'message': session_message}}
+        },
+        'empty response': {'id': str(uuid.uuid4()), 'type': 'response', 'success': True, 'payload': None}
+    }
+
+
+def measure(codec, envelope, messages: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(messages):
+        frame = codec.encode(envelope)
+    encoded = time.perf_counter()
+    for _ in range(messages):
+        decode_frame(frame)
+    decoded = time.perf_counter()
+    return {
+        'bytes': len(frame.encode() if isinstance(frame, str) else frame),
+        'encode_us': (encoded - start) / messages * 10 ** 6,
+        'decode_us': (decoded - encoded) / messages * 10 ** 6
+    }
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, envelope in sample_envelopes().items():
+        for codec in CODECS.values():
+            result = measure(codec, envelope, messages)
+            print(
+                f"{name:>16} {codec.name:>8}: {result['bytes']:6} bytes, "
+                f"encode {result['encode_us']:6.2f} us, decode {result['decode_us']:6.2f} us"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Compares bytes on the wire and CPU time per message of permessage-deflate settings.
+
+Messages are compressed and decompressed the way permessage-deflate does with context takeover,
+one compressor per direction of a connection, flushed after every message.
+Single envelopes and batches of envelopes (see Connection.py) are measured with both codecs.
+
+Usage: python3 -m Benchmark.compression [messages]
+"""
+
+import sys
+import time
+import zlib
+
+from Benchmark.codecs import sample_envelopes
+from Codecs import CODECS
+from Compression import compress_settings
+
+SETTINGS = {
+    'off': None,
+    'default': {'window_bits': '15', 'memory_level': '8', 'level': '6', 'min_size': '0'},
+    'fast': {'window_bits': '15', 'memory_level': '8', 'level': '1', 'min_size': '0'},
+    'small window': {'window_bits': '10', 'memory_level': '2', 'level': '6', 'min_size': '0'},
+    'min size 1024': {'window_bits': '15', 'memory_level': '8', 'level': '6', 'min_size': '1024'},
+}
+
+BATCH_SIZE = 16
+
+
+def sample_frames(codec, messages: int) -> dict:
+    """
+    Returns frames of every kind with new ids and ciphertext, as repeating the same frame would compress unrealistically well.
+    """
+    frames = {}
+    for _ in range(messages):
+        envelopes = sample_envelopes()
+        for name, envelope in envelopes.items():
+            frames.setdefault(name, []).append(codec.encode(envelope))
+        batch = [sample_envelopes()['session request'] for _ in range(BATCH_SIZE)]
+        frames.setdefault(f"batch of {BATCH_SIZE}", []).append(codec.encode(batch))
+    return {
+        name: [frame.encode() if isinstance(frame, str) else frame for frame in kind_frames]
+        for name, kind_frames in frames.items()
+    }
+
+
+def measure(config, frames: list) -> dict:
+    messages = len(frames)
+    if config is None:
+        return {'bytes': sum(len(frame) for frame in frames) / messages, 'compress_us': 0., 'decompress_us': 0.}
+    window_bits = int(config['window_bits'])
+    compressor = zlib.compressobj(wbits=-window_bits, **compress_settings(config))
+    decompressor = zlib.decompressobj(wbits=-window_bits)
+    min_size = int(config['min_size'])
+
+    compressed, compress_time, decompress_time = 0, 0., 0.
+    for frame in frames:
+        if len(frame) < min_size:
+            compressed += len(frame)
+            continue
+        start = time.perf_counter()
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed_at = time.perf_counter()
+        decompressor.decompress(data)
+        decompress_time += time.perf_counter() - compressed_at
+        compress_time += compressed_at - start
+        # The empty block ending every flushed message is not sent
+        compressed += len(data) - 4
+    return {
+        'bytes': compressed / messages,
+        'compress_us': compress_time / messages * 10 ** 6,
+        'decompress_us': decompress_time / messages * 10 ** 6
+    }
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for codec in CODECS.values():
+        for name, frames in sample_frames(codec, messages).items():
+            uncompressed = sum(len(frame) for frame in frames) / messages
+            for setting, config in SETTINGS.items():
+                result = measure(config, frames)
+                print(
+                    f"{codec.name:>8} {name:>16} {setting:>14}: {result['bytes']:8.1f} bytes "
+                    f"({result['bytes'] / uncompressed:4.0%}), "
+                    f"compress {result['compress_us']:7.2f} us, decompress {result['decompress_us']:7.2f} us"
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+"""
+Load generator for the relay and the bank.
+
+Generates identities with their keys, bank permissions and seeded accounts, starts server.py and bank.py,
+drives many synthetic clients sending a mix of plain messages, ADD / SUB transfers and BAL queries,
+and reports throughput, p50 / p99 latency and CPU time of every component.
+The results are written to a JSON file, so that runs can be compared.
+
+Usage: python3 -m Benchmark.loadgen [--clients 20] [--operations 50] [--mix message=2,add=1,sub=1] [--output loadgen.json]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import apsw
+from Crypto.PublicKey import RSA
+
+from Client.Person import Person
+from Client.ShardedAccounts import split_accounts
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INITIAL_BALANCE = 10 ** 9
+KINDS = ['message', 'add', 'sub', 'bal']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generates load on the relay and the bank.")
+    parser.add_argument('--clients', type=int, default=20, help="number of synthetic clients")
+    parser.add_argument('--operations', type=int, default=50, help="operations sent by every client")
+    parser.add_argument('--concurrency', type=int, default=1, help="operations in flight per client")
+    parser.add_argument('--mix', default='message=2,add=1,sub=1', help="weights of plain messages, transfers and balance queries")
+    parser.add_argument('--drivers', type=int, default=min(4, os.cpu_count() or 1), help="processes running the clients")
+    parser.add_argument('--server-workers', type=int, default=1, help="worker processes of the server")
+    parser.add_argument('--account-shards', type=int, default=1, help="databases the accounts are split into")
+    parser.add_argument('--key-size', type=int, default=2048, help="RSA key size of the generated identities")
+    parser.add_argument('--session-encryption', default='1', choices=['0', '1'])
+    parser.add_argument('--batching', default='1', choices=['0', '1'])
+    parser.add_argument('--codec', default='msgpack')
+    parser.add_argument('--relay-frames', default='1', choices=['0', '1'], help="relay messages without decoding them")
+    parser.add_argument('--output', default='loadgen.json', help="file receiving the results")
+    parser.add_argument('--keep', action='store_true', help="keep the generated files and logs")
+    return parser.parse_args()
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise ValueError(f"Unknown operation {kind}, expected one of {KINDS}!")
+        weights[kind] = float(weight)
+    return weights
+
+
+def generate_key(bits: int) -> dict:
+    key = RSA.generate(bits)
+    return {
+        'private': base64.b64encode(key.export_key('DER')).decode(),
+        'public': base64.b64encode(key.publickey().export_key('DER')).decode()
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """
+    Returns user and system CPU time of a process, None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def processes_cpu_seconds(processes: List[subprocess.Popen]) -> Optional[float]:
+    """
+    CPU time of the processes and their children, e.g. server workers or crypto pools of the bank.
+    """
+    pids = [process.pid for process in processes]
+    total = 0.
+    while pids:
+        pid = pids.pop()
+        seconds = cpu_seconds(pid)
+        if seconds is None:
+            return None
+        total += seconds
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return total
+
+
+def client_data(identity: dict, port: int, general: dict) -> dict:
+    return {
+        'person': {'id': identity['id'], 'name': identity['name'], 'keys': identity['keys']},
+        'general': general,
+        'server': {'ip': 'localhost', 'port': str(port)},
+        'actions': []
+    }
+
+
+def prepare(directory: str, args, port: int) -> List[dict]:
+    """
+    Generates the identities, the bank and server configurations, bank permissions and accounts.
+    """
+    with ProcessPoolExecutor() as executor:
+        keys = list(executor.map(generate_key, [args.key_size] * (args.clients + 1)))
+
+    identities = [
+        {'id': f"load{index}", 'name': f"Load, Client{index}", 'account': f"load-account{index}", 'keys': keys[index]}
+        for index in range(args.clients)
+    ]
+
+    with open(os.path.join(directory, 'bank_permissions.json'), 'w') as permissions:
+        json.dump({
+            'organizations': {},
+            'persons': {
+                identity['id']: {'account': identity['account'], 'public_key': identity['keys']['public']}
+                for identity in identities
+            }
+        }, permissions)
+
+    connection = apsw.Connection(os.path.join(directory, 'accounts.sqlite'))
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE accounts (id TEXT NOT NULL, balance INTEGER)")
+        cursor.executemany(
+            "INSERT INTO accounts VALUES (?, ?)",
+            [(identity['account'], INITIAL_BALANCE) for identity in identities]
+        )
+    connection.close()
+    if args.account_shards > 1:
+        split_accounts(os.path.join(directory, 'accounts.sqlite'), args.account_shards)
+
+    with open(os.path.join(ROOT, 'configs', 'server.json')) as server_file:
+        server_config = json.load(server_file)
+    server_config.update({
+        'port': str(port), 'workers': {'count': str(args.server_workers)}, 'metrics': {}, 'relay_frames': args.relay_frames
+    })
+    with open(os.path.join(directory, 'server.json'), 'w') as server_file:
+        json.dump(server_config, server_file)
+
+    with open(os.path.join(ROOT, 'configs', 'bank.json')) as bank_file:
+        bank_config = json.load(bank_file)
+    bank_config.update({
+        'person': {'id': 'bank', 'name': 'Bank, Load', 'keys': keys[-1]},
+        'server': {'ip': 'localhost', 'port': str(port)},
+        'actions': []
+    })
+    bank_config['general'].update({
+        'duration': '86400', 'session_encryption': args.session_encryption, 'relay_frames': args.relay_frames
+    })
+    bank_config['accounts']['shards'] = str(args.account_shards)
+    bank_config['executors']['database_threads'] = str(max(args.account_shards, int(bank_config['executors']['database_threads'])))
+    with open(os.path.join(directory, 'bank.json'), 'w') as bank_file:
+        json.dump(bank_config, bank_file)
+
+    return identities
+
+
+def wait_for(condition, timeout: float, description: str) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise Exception(f"Timed out waiting for {description}!")
+        time.sleep(0.1)
+
+
+def port_open(port: int) -> bool:
+    try:
+        socket.create_connection(('localhost', port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def log_contains(path: str, text: str) -> bool:
+    with open(path) as log:
+        return text in log.read()
+
+
+class LoadClient(Person):
+
+    def __init__(self, client_data, logger):
+        super().__init__(client_data, logger)
+        self.ready = asyncio.Event()
+
+    async def register(self):
+        await super().register()
+        self.ready.set()
+
+
+async def drive(identities: List[dict], recipients: List[str], settings: dict, barrier) -> dict:
+    logger = logging.getLogger("LoadClient")
+    general = {
+        'duration': '86400', 'retries': '1', 'timeout': '1', 'request_timeout': '30',
+        'session_encryption': settings['session_encryption'], 'batching': settings['batching'], 'codec': settings['codec'],
+        'relay_frames': settings['relay_frames']
+    }
+    clients = []
+    for identity in identities:
+        data = client_data(identity, settings['port'], general)
+        # Every driver runs many clients, RSA runs inline instead of in a process pool per client
+        data['executors'] = {'crypto_processes': '0', 'database_threads': '0'}
+        clients.append((identity, LoadClient(data, logger)))
+    tasks = [asyncio.ensure_future(client.start()) for _, client in clients]
+    await asyncio.wait_for(asyncio.gather(*(client.ready.wait() for _, client in clients)), 60)
+    await asyncio.get_event_loop().run_in_executor(None, barrier.wait)
+    # Like the server and the bank, client CPU time is measured between the barriers
+    cpu_started = time.process_time()
+
+    kinds = list(settings['mix'])
+    weights = [settings['mix'][kind] for kind in kinds]
+    latencies = {kind: [] for kind in KINDS}
+    failures = {kind: 0 for kind in KINDS}
+
+    async def operate(identity: dict, client: LoadClient, operations: int):
+        for _ in range(operations):
+            kind = random.choices(kinds, weights)[0]
+            if kind == 'message':
+                recipient, message = random.choice([id for id in recipients if id != identity['id']]), "HELLO"
+            elif kind == 'add':
+                recipient, message = 'bank', f"ADD [{identity['account']}] [{random.choice(settings['accounts'])}] [1]"
+            elif kind == 'sub':
+                recipient, message = 'bank', f"SUB [{identity['account']}] [1]"
+            else:
+                recipient, message = 'bank', f"BAL [{identity['account']}]"
+            started = time.perf_counter()
+            try:
+                await client.send_message(recipient, message)
+                latencies[kind].append(time.perf_counter() - started)
+            except Exception:
+                failures[kind] += 1
+
+    started = time.time()
+    operations = settings['operations']
+    concurrency = settings['concurrency']
+    await asyncio.gather(*(
+        operate(identity, client, operations // concurrency + (1 if lane < operations % concurrency else 0))
+        for identity, client in clients for lane in range(concurrency)
+    ))
+    finished = time.time()
+
+    # Clients stay connected until every driver is done, because they receive messages from the other drivers
+    await asyncio.get_event_loop().run_in_executor(None, barrier.wait)
+    cpu = time.process_time() - cpu_started
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {'latencies': latencies, 'failures': failures, 'started': started, 'finished': finished, 'cpu': cpu}
+
+
+def run_driver(identities: List[dict], recipients: List[str], settings: dict, barrier, results) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    results.put(asyncio.get_event_loop().run_until_complete(drive(identities, recipients, settings, barrier)))
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def summarize(args, driver_results: List[dict], cpu: Dict[str, Optional[float]]) -> dict:
+    duration = max(result['finished'] for result in driver_results) - min(result['started'] for result in driver_results)
+    by_kind = {}
+    for kind in KINDS:
+        latencies = [latency for result in driver_results for latency in result['latencies'][kind]]
+        failures = sum(result['failures'][kind] for result in driver_results)
+        if not latencies and not failures:
+            continue
+        by_kind[kind] = {
+            'completed': len(latencies),
+            'failed': failures,
+            'throughput': len(latencies) / duration,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'mean': sum(latencies) / len(latencies) if latencies else None
+        }
+    completed = sum(kind['completed'] for kind in by_kind.values())
+    all_latencies = [latency for result in driver_results for kind in KINDS for latency in result['latencies'][kind]]
+    return {
+        'parameters': vars(args),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'duration': duration,
+        'completed': completed,
+        'failed': sum(kind['failed'] for kind in by_kind.values()),
+        'throughput': completed / duration,
+        'p50': percentile(all_latencies, 0.5),
+        'p99': percentile(all_latencies, 0.99),
+        'by_kind': by_kind,
+        'cpu_seconds': cpu,
+        'cpu_utilization': {
+            component: seconds / duration if seconds is not None else None for component, seconds in cpu.items()
+        }
+    }
+
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    directory = tempfile.mkdtemp(prefix='loadgen-')
+    port = free_port()
+    processes = []
+    try:
+        print(f"Generating {args.clients} identities in {directory}...")
+        identities = prepare(directory, args, port)
+
+        server_log = open(os.path.join(directory, 'server.log'), 'w')
+        server = subprocess.Popen(
+            [sys.executable, 'server.py', os.path.join(directory, 'server.json')],
+            cwd=ROOT, stdout=server_log, stderr=subprocess.STDOUT
+        )
+        processes.append(server)
+        wait_for(lambda: port_open(port), 30, "the server")
+
+        bank_log_path = os.path.join(directory, 'bank.log')
+        bank = subprocess.Popen(
+            [sys.executable, 'bank.py', os.path.join(directory, 'bank.json'),
+             os.path.join(directory, 'bank_permissions.json'), os.path.join(directory, 'accounts.sqlite')],
+            cwd=ROOT, stdout=open(bank_log_path, 'w'), stderr=subprocess.STDOUT
+        )
+        processes.append(bank)
+        wait_for(lambda: log_contains(bank_log_path, "Registered."), 30, "the bank")
+
+        drivers = max(1, min(args.drivers, args.clients))
+        context = multiprocessing.get_context('spawn')
+        # Drivers start sending together once all clients are registered and stop together,
+        # the coordinator measures CPU at both points
+        barrier = context.Barrier(drivers + 1)
+        results = context.Queue()
+        settings = {
+            'port': port, 'mix': mix, 'operations': args.operations, 'concurrency': args.concurrency,
+            'session_encryption': args.session_encryption, 'batching': args.batching, 'codec': args.codec,
+            'relay_frames': args.relay_frames, 'accounts': [identity['account'] for identity in identities]
+        }
+        recipients = [identity['id'] for identity in identities]
+        per_driver = math.ceil(len(identities) / drivers)
+        driver_processes = [
+            context.Process(
+                target=run_driver,
+                args=(identities[index * per_driver:(index + 1) * per_driver], recipients, settings, barrier, results)
+            )
+            for index in range(drivers)
+        ]
+        for process in driver_processes:
+            process.start()
+
+        print(f"Registering {args.clients} clients in {drivers} drivers...")
+        barrier.wait()
+        server_cpu, bank_cpu = processes_cpu_seconds([server]), processes_cpu_seconds([bank])
+        print(f"Sending {args.clients * args.operations} operations...")
+        barrier.wait()
+        cpu = {
+            'server': processes_cpu_seconds([server]) - server_cpu if server_cpu is not None else None,
+            'bank': processes_cpu_seconds([bank]) - bank_cpu if bank_cpu is not None else None
+        }
+        driver_results = [results.get() for _ in driver_processes]
+        cpu['clients'] = sum(result['cpu'] for result in driver_results)
+        for process in driver_processes:
+            process.join()
+
+        summary = summarize(args, driver_results, cpu)
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2)
+
+        print(f"{summary['completed']} operations in {summary['duration']:.2f} s, {summary['failed']} failed")
+        print(f"throughput {summary['throughput']:.1f} ops/s, p50 {summary['p50']}, p99 {summary['p99']}")
+        for kind, stats in summary['by_kind'].items():
+            print(f"  {kind:>8}: {stats['throughput']:8.1f} ops/s, p50 {stats['p50']}, p99 {stats['p99']}, failed {stats['failed']}")
+        print(f"CPU seconds: {cpu}")
+        print(f"Results written to {args.output}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if args.keep:
+            print(f"Generated files and logs kept in {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
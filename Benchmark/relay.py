@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+Compares the cost of relaying a message by the server with and without relay frames.
+
+Relaying decodes the frame of the sender, builds the payload for the recipient and encodes the frame of the recipient.
+The time and the peak of memory allocated per message are measured for messages of growing size.
+
+Usage: python3 -m Benchmark.relay [messages]
+"""
+
+import secrets
+import sys
+import time
+import tracemalloc
+import uuid
+
+from Codecs import CODECS, Opaque, decode_frame, decode_relay_frame, encode_relay_frame, find_opaque, is_relay_frame
+from Server.Clients import CLIENT_OPAQUE_PATHS
+
+SIZES = [512, 16 * 1024, 256 * 1024]
+
+
+def sender_envelope(size: int, codec, relay_frames: bool) -> dict:
+    message = {'scheme': 'rsa-aes-gcm', 'session': secrets.token_urlsafe(12), 'ciphertext': secrets.token_bytes(size)}
+    return {
+        'id': str(uuid.uuid4()), 'type': 'request',
+        'payload': {
+            'action': 'send_message',
+            'data': {'recipient_id': 'bank', 'message': Opaque.wrap(message, codec) if relay_frames else message}
+        }
+    }
+
+
+def encode(codec, envelope: dict):
+    path = find_opaque(envelope)
+    if path is None:
+        return codec.encode(envelope)
+    opaque = envelope
+    for key in path:
+        opaque = opaque[key]
+    return encode_relay_frame(envelope, path, opaque)
+
+
+def relay(codec, frame) -> None:
+    """
+    The work of the server for a single message, see send_message_action in server.py.
+    """
+    request = decode_relay_frame(frame, CLIENT_OPAQUE_PATHS) if is_relay_frame(frame) else decode_frame(frame)
+    data = request['payload']['data']
+    payload = {'sender_id': 'person', 'sender_connection_id': 'connection', 'message': data['message'], 'recipient_id': 'bank'}
+    encode(codec, {'id': str(uuid.uuid4()), 'type': 'request', 'payload': payload})
+
+
+def measure(codec, size: int, relay_frames: bool, messages: int) -> dict:
+    frame = encode(codec, sender_envelope(size, codec, relay_frames))
+    start = time.perf_counter()
+    for _ in range(messages):
+        relay(codec, frame)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    relay(codec, frame)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'relay_us': duration / messages * 10 ** 6, 'peak_bytes': peak}
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for size in SIZES:
+        for codec in CODECS.values():
+            for relay_frames in (False, True):
+                result = measure(codec, size, relay_frames, messages)
+                print(
+                    f"{size:>7} bytes {codec.name:>8} {'relay frames' if relay_frames else 'decoded':>12}: "
+                    f"relay {result['relay_us']:8.2f} us, peak {result['peak_bytes']:8} bytes allocated"
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,421 @@
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import apsw
 
 from Client.Client import ClientResponseException
+from Metrics import Metrics
+
+# Result of an item of a batch that was applied
+APPLIED = 'OK'
+# Result of an item of an atomic batch that was rolled back because another item failed
+ROLLED_BACK = 'ROLLED BACK'
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Destination of a debit recorded for a withdrawal, the money leaves the bank instead of being credited
+WITHDRAWAL = ''
+
+
+def failed_operation(exception: Exception) -> Callable[[apsw.Connection], None]:
+    """
+    Returns an operation that fails with the exception, e.g. for an item of a batch rejected before it reached the database.
+    """
+    def operation(connection):
+        raise exception
+    return operation
+
+
+class BatchRolledBack(ClientResponseException):
+    """
+    Raised by an atomic batch with a failing item, carries the JSON list of results of all items.
+    """
+
+    def __init__(self, response: str):
+        super().__init__(response)
+        self.response = response
 
 
 class Accounts():
+    """
+    This class provides access to the accounts database.
+
+    Opening a database connection is expensive, therefore connections are opened once and kept in a pool.
+    Every connection uses WAL journal, so that readers do not block the writer,
+    and keeps a cache of prepared statements, so that the same SQL is not parsed again for every call.
+    Every SQL call is timed in the accounts_sql_seconds histogram of the metrics.
+
+    Balances are also kept in memory, loaded once when the accounts are opened, so that reading them does not touch the database.
+    Changes made by a transaction are collected while it runs and applied to the memory only after it commits,
+    changes of an operation rolled back to its savepoint are dropped. The bank is therefore expected to be
+    the only writer of the database while it runs.
+
+    Operations requested with an idempotency key record their response in the responses table in the same transaction,
+    so that a retried request can be answered from the table without being applied again (see Client/Responses.py).
+
+    When the accounts are split into shards (see Client/ShardedAccounts.py), a transfer between two shards
+    debits the source and records the transfer in its outgoing_transfers table in one transaction,
+    then credits the destination and records the transfer in its incoming_transfers table in another,
+    and finally removes the outgoing record. An outgoing record therefore marks money on its way,
+    which a recovery after a crash delivers, and the incoming record makes the credit idempotent.
+    A batch with accounts in many shards debits all of its items first and records whether it is committed or aborted
+    in the batches table of the first shard, the debits of an aborted batch are refunded instead of delivered.
+    """
 
-    def __init__(self, filename):
-        self.connection = apsw.Connection(filename)
-        self.connection.setbusytimeout(3)
+    def __init__(self, filename, pool_size: int = 4, busy_timeout: int = 5000,
+                 synchronous: str = 'NORMAL', statement_cache_size: int = 100, metrics: Optional[Metrics] = None):
+        self.filename = filename
+        # The mode is put into the PRAGMA statement as it is, so only the known ones are accepted
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode {synchronous}, expected one of {', '.join(SYNCHRONOUS_MODES)}!")
+        metrics = metrics or Metrics()
+        self.select_balance_seconds = metrics.histogram('accounts_sql_seconds', statement='select_balance')
+        self.update_balance_seconds = metrics.histogram('accounts_sql_seconds', statement='update_balance')
+        self.begin_seconds = metrics.histogram('accounts_sql_seconds', statement='begin')
+        self.commit_seconds = metrics.histogram('accounts_sql_seconds', statement='commit')
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(self._connect(busy_timeout, synchronous, statement_cache_size))
+        # Balance changes of the transactions in progress by their connection, applied to the balances on commit
+        self.uncommitted: Dict[apsw.Connection, List[Tuple[str, int]]] = {}
+        self.balances_lock = threading.Lock()
+        self.balances: Dict[str, int] = self._load_balances()
 
     def get_account_balance(self, account_id: str) -> int:
-        return self._fetch_column("SELECT balance FROM accounts WHERE id = ?", [account_id])
+        with self._connection() as connection:
+            return self._get_account_balance(connection, account_id)
+
+    def has_account(self, account_id: str) -> bool:
+        with self.balances_lock:
+            return account_id in self.balances
+
+    def get_cached_balance(self, account_id: str) -> int:
+        """
+        Returns the balance as of the last committed transaction without touching the database.
+        """
+        with self.balances_lock:
+            balance = self.balances.get(account_id)
+        if balance is None:
+            raise ClientResponseException(f"Account {account_id} does not exist!")
+        return balance
 
     def transfer_money(self, from_account_id: str, to_account_id: str, amount: int):
-        if amount < 0: raise ClientResponseException(f"Only positive amount of money can be transferred while requested {amount}.")
-        with self.connection:
-            from_account_balance = self.get_account_balance(from_account_id)
-            if from_account_balance < amount:
-                raise ClientResponseException(
-                    f"Account {from_account_id} has only {from_account_balance} deposited, while requested to transfer {amount}!"
-                )
-            self._update_account_balance(from_account_id, - amount)
-            self._update_account_balance(to_account_id,   + amount)
+        with self._transaction() as connection:
+            self._transfer_money(connection, from_account_id, to_account_id, amount)
 
     def withdraw_money(self, account_id: str, amount: int):
-        if amount < 0: raise ClientResponseException(f"Only positive amount of money can be withdrawn while requested {amount}.")
-        with self.connection:
-            account_balance = self.get_account_balance(account_id)
-            if account_balance < amount:
-                raise ClientResponseException(
-                    f"Account {account_id} has only {account_balance} deposited, while requested to withdraw {amount}!"
+        with self._transaction() as connection:
+            self._withdraw_money(connection, account_id, amount)
+
+    def get_response(self, sender_id: str, key: str) -> Optional[dict]:
+        """
+        Returns {'response': response} recorded for the request, None if the request was not applied.
+        """
+        with self._connection() as connection:
+            row = self._fetch_row(connection, "SELECT response FROM responses WHERE sender_id = ? AND key = ?", [sender_id, key])
+        return {'response': json.loads(row[0])} if row is not None else None
+
+    def prune_responses(self, max_age: float, max_rows: int) -> int:
+        """
+        Removes responses older than max_age seconds and the oldest ones above max_rows, returns the number removed.
+        """
+        with self._transaction() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - max_age,))
+            removed = connection.changes()
+            cursor.execute(
+                "DELETE FROM responses WHERE rowid IN "
+                "(SELECT rowid FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (max_rows,)
+            )
+            removed += connection.changes()
+            # Credits older than any transfer that may still be delivered do not need to be recognized any more
+            cursor.execute("DELETE FROM incoming_transfers WHERE created_at < ?", (time.time() - max_age,))
+            cursor.execute("DELETE FROM batches WHERE created_at < ?", (time.time() - max_age,))
+            return removed
+
+    def get_outgoing_transfers(self, max_created_at: float) -> List[Tuple[str, str, str, int, Optional[str], Optional[str]]]:
+        """
+        Returns transfers to other shards debited before max_created_at and not completed yet,
+        with the sender and the idempotency key of the request if it had one.
+        """
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT id, from_account, to_account, amount, sender_id, key FROM outgoing_transfers "
+                "WHERE created_at < ? ORDER BY created_at",
+                (max_created_at,)
+            )
+            return list(cursor)
+
+    def apply_operations(self, operations: List[Callable[[apsw.Connection], Any]]) -> List[Any]:
+        """
+        Applies many operations in a single transaction, so that they share one commit.
+
+        Every operation runs inside its own savepoint, therefore a failing operation (e.g. overdraft)
+        is rolled back alone and does not abort the rest of the batch.
+        Returns a list with the result of every operation or the exception that it raised.
+        """
+        with self._transaction() as connection:
+            return self._apply_in_savepoints(connection, operations, 'operation')
+
+    def transfer_operation(self, from_account_id: str, to_account_id: str, amount: int,
+                           response_key: Optional[Tuple[str, str]] = None) -> Callable[[apsw.Connection], None]:
+        def operation(connection):
+            self._transfer_money(connection, from_account_id, to_account_id, amount)
+            if response_key is not None:
+                self._save_response(connection, response_key, None)
+        return operation
+
+    def withdraw_operation(self, account_id: str, amount: int,
+                           response_key: Optional[Tuple[str, str]] = None) -> Callable[[apsw.Connection], None]:
+        def operation(connection):
+            self._withdraw_money(connection, account_id, amount)
+            if response_key is not None:
+                self._save_response(connection, response_key, None)
+        return operation
+
+    def debit_operation(self, transfer_id: str, from_account_id: str, to_account_id: str, amount: int,
+                        response_key: Optional[Tuple[str, str]] = None) -> Callable[[apsw.Connection], None]:
+        """
+        Returns the first phase of a transfer to another shard, the debit of the source account.
+        A debit to WITHDRAWAL is a withdrawal of an item of a batch, which is completed without a credit.
+        """
+        sender_id, key = response_key if response_key is not None else (None, None)
+
+        def operation(connection):
+            self._withdraw_money(connection, from_account_id, amount, 'withdraw' if to_account_id == WITHDRAWAL else 'transfer')
+            connection.cursor().execute(
+                "INSERT INTO outgoing_transfers (id, from_account, to_account, amount, sender_id, key, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (transfer_id, from_account_id, to_account_id, amount, sender_id, key, time.time())
+            )
+            if response_key is not None:
+                self._save_response(connection, response_key, None)
+        return operation
+
+    def credit_operation(self, transfer_id: str, to_account_id: str, amount: int) -> Callable[[apsw.Connection], None]:
+        """
+        Returns the second phase of a transfer from another shard, the credit of the destination account.
+        Crediting a transfer again does nothing.
+        """
+        def operation(connection):
+            if self._fetch_row(connection, "SELECT 1 FROM incoming_transfers WHERE id = ?", [transfer_id]) is not None:
+                return
+            self._update_account_balance(connection, to_account_id, + amount)
+            connection.cursor().execute(
+                "INSERT INTO incoming_transfers (id, created_at) VALUES (?, ?)", (transfer_id, time.time())
+            )
+        return operation
+
+    def complete_operation(self, transfer_id: str) -> Callable[[apsw.Connection], None]:
+        return lambda connection: connection.cursor().execute("DELETE FROM outgoing_transfers WHERE id = ?", (transfer_id,))
+
+    def refund_operation(self, transfer_id: str, from_account_id: str, amount: int,
+                         response_key: Optional[Tuple[str, str]] = None) -> Callable[[apsw.Connection], None]:
+        """
+        Returns the operation returning a debited transfer that the destination shard refused, e.g. to a missing account.
+        Refunding a transfer again does nothing.
+        """
+        def operation(connection):
+            connection.cursor().execute("DELETE FROM outgoing_transfers WHERE id = ?", (transfer_id,))
+            if connection.changes() != 1:
+                return
+            self._update_account_balance(connection, from_account_id, + amount)
+            if response_key is not None:
+                connection.cursor().execute(
+                    "DELETE FROM responses WHERE sender_id = ? AND key = ?", response_key
                 )
-            self._update_account_balance(account_id, - amount)
+        return operation
+
+    def decide_batch_operation(self, batch_id: str, committed: bool, response_key: Optional[Tuple[str, str]] = None,
+                               response: Any = None) -> Callable[[apsw.Connection], bool]:
+        """
+        Returns the operation recording whether a batch across shards is committed, together with its response if it is.
+        The first decision stands, the operation returns it, so that a recovery aborting an interrupted batch
+        and the batch committing itself can not both win.
+        """
+        def operation(connection):
+            row = self._fetch_row(connection, "SELECT committed FROM batches WHERE id = ?", [batch_id])
+            if row is not None:
+                return bool(row[0])
+            connection.cursor().execute(
+                "INSERT INTO batches (id, committed, created_at) VALUES (?, ?, ?)", (batch_id, int(committed), time.time())
+            )
+            if committed and response_key is not None:
+                self._save_response(connection, response_key, response)
+            return committed
+        return operation
+
+    def save_response_operation(self, response_key: Tuple[str, str], response: Any) -> Callable[[apsw.Connection], None]:
+        return lambda connection: self._save_response(connection, response_key, response)
+
+    def batch_operation(self, operations: List[Callable[[apsw.Connection], Any]], atomic: bool,
+                        response_key: Optional[Tuple[str, str]] = None) -> Callable[[apsw.Connection], str]:
+        """
+        Returns an operation applying many items, which returns the JSON list of their results: APPLIED or the error.
+        Every item runs inside its own savepoint, when the batch is atomic and any item fails
+        the operation raises BatchRolledBack, so that the savepoint of the whole batch is rolled back.
+        """
+        def operation(connection):
+            results = self._apply_in_savepoints(connection, operations, 'item')
+            failed = any(isinstance(result, Exception) for result in results)
+            if atomic and failed:
+                raise BatchRolledBack(json.dumps([
+                    str(result) if isinstance(result, Exception) else ROLLED_BACK for result in results
+                ]))
+            response = json.dumps([str(result) if isinstance(result, Exception) else APPLIED for result in results])
+            if response_key is not None:
+                self._save_response(connection, response_key, response)
+            return response
+        return operation
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+    def _connect(self, busy_timeout: int, synchronous: str, statement_cache_size: int) -> apsw.Connection:
+        connection = apsw.Connection(self.filename, statementcachesize=statement_cache_size)
+        connection.setbusytimeout(busy_timeout)
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL is still safe from corruption and skips fsync on every commit
+        cursor.execute(f"PRAGMA synchronous = {synchronous.upper()}")
+        cursor.execute("CREATE INDEX IF NOT EXISTS accounts_id ON accounts (id)")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "sender_id TEXT NOT NULL, key TEXT NOT NULL, response TEXT, created_at REAL NOT NULL, "
+            "PRIMARY KEY (sender_id, key))"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS outgoing_transfers ("
+            "id TEXT PRIMARY KEY, from_account TEXT NOT NULL, to_account TEXT NOT NULL, amount INTEGER NOT NULL, "
+            "sender_id TEXT, key TEXT, created_at REAL NOT NULL)"
+        )
+        cursor.execute("CREATE TABLE IF NOT EXISTS incoming_transfers (id TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, committed INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        connection = self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs a transaction that takes the write lock up front.
+        Deferred transactions that read before writing can not wait for the lock and fail under contention.
+        """
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            with self.begin_seconds.time():
+                cursor.execute("BEGIN IMMEDIATE")
+            changes = self.uncommitted[connection] = []
+            try:
+                try:
+                    yield connection
+                    with self.commit_seconds.time():
+                        cursor.execute("COMMIT")
+                except:
+                    # A failed COMMIT, e.g. busy or out of disk, leaves the transaction open,
+                    # which would make every later BEGIN on this connection of the pool fail
+                    if not connection.getautocommit():
+                        cursor.execute("ROLLBACK")
+                    raise
+            finally:
+                del self.uncommitted[connection]
+            self._apply_changes(changes)
+
+    def _apply_in_savepoints(self, connection, operations: List[Callable[[apsw.Connection], Any]], savepoint: str) -> List[Any]:
+        results = []
+        cursor = connection.cursor()
+        changes = self.uncommitted[connection]
+        for operation in operations:
+            cursor.execute(f"SAVEPOINT {savepoint}")
+            applied_changes = len(changes)
+            try:
+                results.append(operation(connection))
+            except Exception as exception:
+                cursor.execute(f"ROLLBACK TO {savepoint}")
+                del changes[applied_changes:]
+                results.append(exception)
+            cursor.execute(f"RELEASE {savepoint}")
+        return results
+
+    def _load_balances(self) -> Dict[str, int]:
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT id, balance FROM accounts")
+            return {account_id: balance for account_id, balance in cursor}
+
+    def _apply_changes(self, changes: List[Tuple[str, int]]):
+        with self.balances_lock:
+            for account_id, change in changes:
+                # Accounts added to the database after the balances were loaded are not known
+                if account_id in self.balances:
+                    self.balances[account_id] += change
 
-    def _fetch_column(self, statement, params):
-        return self._fetch_row(statement, params)[0]
+    def _transfer_money(self, connection, from_account_id: str, to_account_id: str, amount: int):
+        if amount < 0: raise ClientResponseException(f"Only positive amount of money can be transferred while requested {amount}.")
+        from_account_balance = self._get_account_balance(connection, from_account_id)
+        if from_account_balance < amount:
+            raise ClientResponseException(
+                f"Account {from_account_id} has only {from_account_balance} deposited, while requested to transfer {amount}!"
+            )
+        self._update_account_balance(connection, from_account_id, - amount)
+        self._update_account_balance(connection, to_account_id,   + amount)
+
+    def _withdraw_money(self, connection, account_id: str, amount: int, action: str = 'withdraw'):
+        if amount < 0: raise ClientResponseException(f"Only positive amount of money can be withdrawn while requested {amount}.")
+        account_balance = self._get_account_balance(connection, account_id)
+        if account_balance < amount:
+            raise ClientResponseException(
+                f"Account {account_id} has only {account_balance} deposited, while requested to {action} {amount}!"
+            )
+        self._update_account_balance(connection, account_id, - amount)
 
-    def _fetch_row(self, statement, params):
-        cursor = self.connection.cursor()
+    def _get_account_balance(self, connection, account_id: str) -> int:
+        with self.select_balance_seconds.time():
+            row = self._fetch_row(connection, "SELECT balance FROM accounts WHERE id = ?", [account_id])
+        if row is None:
+            raise ClientResponseException(f"Account {account_id} does not exist!")
+        return row[0]
+
+    def _fetch_row(self, connection, statement, params):
+        cursor = connection.cursor()
         cursor.execute(statement, params)
         return cursor.fetchone()
 
-    def _update_account_balance(self, account_id: str, change: int):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            "UPDATE accounts SET balance = balance + ? WHERE id = ?",
-            (change, account_id)
-        )
\ No newline at end of file
+    def _update_account_balance(self, connection, account_id: str, change: int):
+        cursor = connection.cursor()
+        with self.update_balance_seconds.time():
+            cursor.execute(
+                "UPDATE accounts SET balance = balance + ? WHERE id = ?",
+                (change, account_id)
+            )
+        if connection.changes() != 1:
+            raise ClientResponseException(f"Account {account_id} does not exist!")
+        self.uncommitted[connection].append((account_id, change))
+
+    def _save_response(self, connection, response_key: Tuple[str, str], response: Any):
+        sender_id, key = response_key
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO responses (sender_id, key, response, created_at) VALUES (?, ?, ?, ?)",
+                (sender_id, key, json.dumps(response), time.time())
+            )
+        except apsw.ConstraintError:
+            # The savepoint of the operation is rolled back, so the duplicate is not applied
+            raise ClientResponseException(f"Request {key} from {sender_id} was already applied!")
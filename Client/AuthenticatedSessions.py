@@ -0,0 +1,36 @@
+import time
+from typing import Dict, Optional, Tuple
+
+
+class AuthenticatedSessions():
+    """
+    This class keeps track of peers that passed the authentication challenge.
+
+    A session is bound to the server connection of the peer, so a peer that reconnects,
+    or anybody else who registers with the same id later, has to pass the challenge again.
+    Sessions expire after ttl seconds and are revoked when the peer deregisters.
+    """
+
+    def __init__(self, ttl: float = 300.):
+        self.ttl = ttl
+        self.sessions_by_person_id: Dict[str, Tuple[str, float]] = {}
+
+    def is_authenticated(self, person_id: str, connection_id: Optional[str]) -> bool:
+        session = self.sessions_by_person_id.get(person_id)
+        if session is None or connection_id is None:
+            return False
+        session_connection_id, expires_at = session
+        if time.monotonic() >= expires_at:
+            del self.sessions_by_person_id[person_id]
+            return False
+        return session_connection_id == connection_id
+
+    def start(self, person_id: str, connection_id: Optional[str]) -> None:
+        if self.ttl <= 0 or connection_id is None:
+            return
+        self.sessions_by_person_id[person_id] = (connection_id, time.monotonic() + self.ttl)
+
+    def revoke(self, person_id: str, connection_id: Optional[str] = None) -> None:
+        session = self.sessions_by_person_id.get(person_id)
+        if session is not None and (connection_id is None or session[0] == connection_id):
+            del self.sessions_by_person_id[person_id]
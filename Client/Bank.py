@@ -1,120 +1,350 @@
+import asyncio
+import json
+import os
 import re
 import secrets
-from typing import Dict, List
+import time
+from typing import Dict, List, Optional, Tuple
 
 from Client.Client import Client, ClientResponseException
-from Client.Accounts import Accounts
+from Client.Accounts import BatchRolledBack, ROLLED_BACK
+from Client.ShardedAccounts import ShardedAccounts
+from Client.Responses import Responses
+from Client.AuthenticatedSessions import AuthenticatedSessions
+from Client.Permissions import Permissions
+from LogPipeline import fields
 
+ADD_PATTERN = re.compile(r'ADD \[(?P<from_account>.*?)] \[(?P<to_account>.*)] \[(?P<amount>\d+)]')
+SUB_PATTERN = re.compile(r'SUB \[(?P<from_account>.*?)] \[(?P<amount>\d+)]')
+BAL_PATTERN = re.compile(r'BAL \[(?P<account>.*?)]')
+# First line of a batch, every following line is an ADD or SUB item
+BATCH_PATTERN = re.compile(r'BATCH \[(?P<mode>atomic|each)]')
 
-class Bank(Client):
 
-    organization_per_account: Dict[str, str] = {}
-    public_key_per_person_id: Dict[str, str] = {}
+class Bank(Client):
 
-    def __init__(self, client_data, accounts_sqlite, bank_permissions, logger):
+    def __init__(self, client_data, accounts_sqlite, bank_permissions, logger, bank_permissions_file: Optional[str] = None):
         super().__init__(client_data, logger)
 
         self.accounts_sqlite = accounts_sqlite
-        self.get_accounts() # test db config
+        accounts_config = client_data.get('accounts', {})
+        # Every shard is written by its own transfer queue, database_threads should be at least the number of shards
+        self.accounts = ShardedAccounts(
+            accounts_sqlite,
+            self.executors,
+            shards=int(accounts_config.get('shards', 1)),
+            max_batch=int(accounts_config.get('batch_size', 64)),
+            batch_window=float(accounts_config.get('batch_window', 0.002)),
+            metrics=self.metrics,
+            tracer=self.tracer,
+            pool_size=int(accounts_config.get('pool_size', 4)),
+            busy_timeout=int(accounts_config.get('busy_timeout', 5000)),
+            synchronous=accounts_config.get('synchronous', 'NORMAL'),
+            statement_cache_size=int(accounts_config.get('statement_cache_size', 100))
+        )
+        # Transfers between shards older than the delay are considered interrupted and delivered again
+        self.recovery_interval = float(accounts_config.get('recovery_interval', 60))
+        self.recovery_delay = float(accounts_config.get('recovery_delay', 60))
+        self.max_batch_items = int(accounts_config.get('max_batch_items', 1000))
 
-        self.bank_permissions = bank_permissions
-        for organization_id, organization_data in bank_permissions['organizations'].items():
-            organization_account_id = organization_data['account']
-            if organization_account_id in self.organization_per_account:
-                raise Exception(f"One account {organization_account_id} assigned to two organizations!")
-            self.organization_per_account[organization_account_id] = organization_id
+        # Responses to requests carrying an idempotency key, so that retries are not applied twice
+        responses_config = client_data.get('responses', {})
+        self.responses = Responses(
+            self.accounts,
+            self.executors,
+            max_size=int(responses_config.get('cache_size', 10000)),
+            metrics=self.metrics
+        )
+        self.responses_ttl = float(responses_config.get('ttl', 86400))
+        self.responses_max_rows = int(responses_config.get('max_rows', 100000))
+        self.responses_prune_interval = float(responses_config.get('prune_interval', 60))
+
+        self.authenticated_sessions = AuthenticatedSessions(
+            ttl=float(client_data.get('authentication', {}).get('session_ttl', 300))
+        )
+        self.pending_challenges: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.permissions = Permissions(bank_permissions)
+        # When the file is given, changes of the permissions are picked up without restarting the bank
+        self.bank_permissions_file = bank_permissions_file
+        self.permissions_reload_interval = float(client_data.get('permissions', {}).get('reload_interval', 1))
+
+        self.authenticate_seconds = self.metrics.histogram('bank_authenticate_seconds')
+        self.authorize_seconds = self.metrics.histogram('bank_authorize_seconds')
+        self.authorization_denied = self.metrics.counter('bank_authorizations', outcome='denied')
+        self.authorization_allowed = self.metrics.counter('bank_authorizations', outcome='allowed')
+        self.metrics.gauge('bank_authenticated_sessions', lambda: len(self.authenticated_sessions.sessions_by_person_id))
 
     def get_public_key(self, person_id: str) -> str:
-        return self.bank_permissions['persons'][person_id]['public_key']
+        return self.permissions.get_public_key(person_id)
+
+    def background_tasks(self) -> list:
+        tasks = super().background_tasks() + [self.prune_responses(), self.recover_transfers()]
+        if self.bank_permissions_file is None:
+            return tasks
+        return tasks + [self.watch_permissions()]
 
-    def get_organization_employees(self, organization_id: str) -> dict:
-        return self.bank_permissions['organizations'][organization_id]['employees']
+    async def recover_transfers(self):
+        """
+        Delivers transfers between shards interrupted e.g. by a stop of the bank, right away and then periodically.
+        """
+        if len(self.accounts.shards) == 1:
+            return
+        min_age = 0.
+        while True:
+            try:
+                recovered = await self.accounts.recover(min_age)
+                if recovered:
+                    self.logger.warning("Recovered interrupted transfers between shards.", extra=fields(transfers=recovered))
+            except Exception:
+                self.logger.exception("Failed to recover transfers between shards.")
+            min_age = self.recovery_delay
+            await asyncio.sleep(self.recovery_interval)
+
+    async def prune_responses(self):
+        """
+        Keeps the recorded responses within their age and count limits.
+        """
+        while True:
+            await asyncio.sleep(self.responses_prune_interval)
+            try:
+                removed = await self.executors.run_database(
+                    self.accounts.prune_responses, self.responses_ttl, self.responses_max_rows
+                )
+            except Exception:
+                self.logger.exception("Failed to prune recorded responses.")
+                continue
+            if removed:
+                self.logger.debug("Pruned recorded responses.", extra=fields(responses=removed))
+
+    async def watch_permissions(self):
+        """
+        Polls the permissions file and swaps in a newly compiled index when the file changes.
+        """
+        last_modified = os.stat(self.bank_permissions_file).st_mtime_ns
+        while True:
+            await asyncio.sleep(self.permissions_reload_interval)
+            try:
+                modified = os.stat(self.bank_permissions_file).st_mtime_ns
+                if modified == last_modified:
+                    continue
+                last_modified = modified
+                permissions = await asyncio.get_event_loop().run_in_executor(
+                    None, Permissions.load, self.bank_permissions_file
+                )
+            except Exception:
+                self.logger.exception("Failed to reload permissions, keeping the previous ones.")
+                continue
+            self.replace_permissions(permissions)
+
+    def replace_permissions(self, permissions: Permissions) -> None:
+        previous_permissions, self.permissions = self.permissions, permissions
+        # Keys that changed or were removed must not be used any more
+        for person_id, public_key in previous_permissions.public_key_per_person_id.items():
+            if permissions.public_key_per_person_id.get(person_id) != public_key:
+                self.key_cache.invalidate(person_id)
+                self.sessions.forget(person_id)
+                self.authenticated_sessions.revoke(person_id)
+        self.logger.info("Permissions reloaded.")
+
+    async def fetch_peer_info(self, peer_id: str) -> dict:
+        # Bank trusts only the keys assigned in its own records
+        # Support of session encryption is learned from the messages received from the peer
+        return {'public_key': self.get_public_key(peer_id)}
+
+    def subscriptions(self) -> List[str]:
+        return ['client_deregistered']
+
+    def peer_deregistered(self, peer_id: str, connection_id: str) -> None:
+        self.authenticated_sessions.revoke(peer_id, connection_id)
+
+    async def authenticate(self, person_id, connection_id: Optional[str] = None) -> bool:
+        """
+        Authenticates the person unless it already did so over the same connection recently.
+        Concurrent requests from the same connection share one challenge.
+        """
+        with self.authenticate_seconds.time(), self.tracer.span('authenticate'):
+            return await self.__authenticate(person_id, connection_id)
+
+    async def __authenticate(self, person_id, connection_id: Optional[str]) -> bool:
+        if self.authenticated_sessions.is_authenticated(person_id, connection_id):
+            self.logger.debug("Authenticated by session: %s", person_id)
+            return True
 
-    def get_employee_permissions(self, organization_id: str, person_id: str) -> List[str]:
-        return self.get_organization_employees(organization_id)[person_id]['permissions']
+        challenge_key = (person_id, connection_id)
+        challenge = self.pending_challenges.get(challenge_key)
+        if challenge is None:
+            challenge = asyncio.ensure_future(self.challenge(person_id))
+            self.pending_challenges[challenge_key] = challenge
+            challenge.add_done_callback(lambda _: self.pending_challenges.pop(challenge_key, None))
+        authenticated = await asyncio.shield(challenge)
 
-    async def encrypt_message(self, recipient_id, message):
-        return self.encrypt(message, self.get_public_key(recipient_id))
+        if authenticated:
+            self.authenticated_sessions.start(person_id, connection_id)
+        return authenticated
 
-    async def authenticate(self, person_id) -> bool:
-        self.logger.info(f"Requesting authentication from {person_id}")
+    async def challenge(self, person_id) -> bool:
+        self.logger.info("Authentication requested.", extra=fields(person=person_id))
         secret = secrets.token_urlsafe(64)
         received_secret = await self.send_message(person_id, "AUTH " + secret)
         if secret == received_secret:
-            self.logger.info(f"Authenticated: {person_id}")
+            self.logger.info("Authenticated.", extra=fields(person=person_id))
         else:
-            self.logger.warning(f"Invalid secret received from {person_id}!")
+            self.logger.warning("Invalid secret received!", extra=fields(person=person_id))
         return secret == received_secret
 
     def authorize(self, person_id, account_id, permission: str) -> bool:
-        self.logger.info(f"Requesting authorization from {person_id} to {account_id}")
-
-        if self.bank_permissions['persons'][person_id]['account'] == account_id:
-            self.logger.info(f"Person {person_id} authorized to manage {account_id} as their personal account.")
-            return True
-
-        if account_id not in self.organization_per_account:
-            self.logger.warning(f"Person {person_id} attempted to gain unauthorized access to account {account_id}!")
-            return False
-
-        organization_id = self.organization_per_account[account_id]
-        if person_id not in self.get_organization_employees(organization_id):
-            self.logger.warning(f"Person {person_id} is not employed by org {organization_id} owning {account_id} account.")
+        started = time.perf_counter()
+        granted_by = self.permissions.authorize(person_id, account_id, permission)
+        self.authorize_seconds.observe(time.perf_counter() - started)
+        if granted_by is None:
+            self.authorization_denied.inc()
+            self.logger.warning(
+                "Not authorized!", extra=fields(person=person_id, permission=permission, account=account_id)
+            )
             return False
+        self.authorization_allowed.inc()
+        self.logger.debug(
+            "Authorized.", extra=fields(person=person_id, permission=permission, account=account_id, granted_by=granted_by)
+        )
+        return True
 
-        has_permission = permission in self.get_employee_permissions(organization_id, person_id)
-        if has_permission:
-            self.logger.info(f"Person {person_id} is authorized by org {organization_id} to {permission} on {account_id} account.")
-            return True
+    async def replay_response(self, sender_id: str, idempotency_key: str, retried: bool) -> Optional[dict]:
+        return await self.responses.replay(sender_id, idempotency_key, retried)
 
-        self.logger.warning(f"Person {person_id} is not authorized by org {organization_id} to {permission} on {account_id} account.")
-        return False
+    async def receive_message(self, sender_id: str, message: str, metadata: dict):
+        idempotency_key = metadata.get('idempotency_key')
+        if idempotency_key is None:
+            return await self.handle_request(sender_id, message, metadata)
+        return await self.responses.run(
+            sender_id, idempotency_key,
+            lambda: self.handle_request(sender_id, message, metadata, (sender_id, idempotency_key))
+        )
 
-    async def receive_message(self, sender_id: str, message: str):
-        self.logger.info(f"From {sender_id} received message: {message}")
-        if not await self.authenticate(sender_id):
-            return "Authentication failed!"
+    async def handle_request(self, sender_id: str, message: str, metadata: dict,
+                             response_key: Optional[Tuple[str, str]] = None):
+        self.logger.info("Message received.", extra=fields(sender=sender_id, message=message))
+        if not await self.authenticate(sender_id, metadata.get('sender_connection_id')):
+            # Raised rather than returned, so that the result is not replayed to a retry that may authenticate
+            raise ClientResponseException("Authentication failed!")
 
         if message.startswith("ADD "):
-            match = re.match(r'ADD \[(?P<from_account>.*?)] \[(?P<to_account>.*)] \[(?P<amount>\d+)]', message)
-            return await self.move_action(sender_id, **match.groupdict())
+            match = ADD_PATTERN.match(message)
+            return await self.move_action(sender_id, **match.groupdict(), response_key=response_key)
 
         elif message.startswith("SUB "):
-            match = re.match(r'SUB \[(?P<from_account>.*?)] \[(?P<amount>\d+)]', message)
-            return await self.withdraw_action(sender_id, **match.groupdict())
+            match = SUB_PATTERN.match(message)
+            return await self.withdraw_action(sender_id, **match.groupdict(), response_key=response_key)
+
+        elif message.startswith("BAL "):
+            match = BAL_PATTERN.match(message)
+            return self.balance_action(sender_id, **match.groupdict())
+
+        elif message.startswith("BATCH "):
+            return await self.batch_action(sender_id, message, response_key=response_key)
 
         else:
-            self.logger.warning(f"Unknown action requested!")
+            self.logger.warning("Unknown action requested!", extra=fields(sender=sender_id))
 
-    async def move_action(self, requesting_person:str, from_account:str, to_account:str, amount: int):
+    async def move_action(self, requesting_person:str, from_account:str, to_account:str, amount: int,
+                          response_key: Optional[Tuple[str, str]] = None):
         self.logger.info(
-            f"Person {requesting_person} requested to move {amount} from account {from_account} to account {to_account}."
+            "Transfer requested.",
+            extra=fields(person=requesting_person, from_account=from_account, to_account=to_account, amount=amount)
         )
 
         if not self.authorize(requesting_person, from_account, "ADD"):
             raise ClientResponseException(f"Unauthorized ADD operation by {requesting_person} on account {from_account}!")
 
-        self.get_accounts().transfer_money(from_account, to_account, int(amount))
+        with self.tracer.span('transfer_money', shard=self.accounts.shard(from_account)):
+            await self.accounts.transfer_money(from_account, to_account, int(amount), response_key)
 
-        new_balance = self.get_accounts().get_account_balance(from_account)
         self.logger.info(
-            f"New balance: {new_balance} on account {from_account}."
+            "New balance.", extra=fields(account=from_account, balance=self.get_accounts().get_cached_balance(from_account))
         )
 
-    async def withdraw_action(self, requesting_person:str, from_account:str, amount: int):
+    async def withdraw_action(self, requesting_person:str, from_account:str, amount: int,
+                              response_key: Optional[Tuple[str, str]] = None):
         self.logger.info(
-            f"Person {requesting_person} requested to withdraw {amount} from account {from_account}."
+            "Withdrawal requested.", extra=fields(person=requesting_person, account=from_account, amount=amount)
         )
 
         if not self.authorize(requesting_person, from_account, "SUB"):
             raise ClientResponseException(f"Unauthorized SUB operation by {requesting_person} on account {from_account}!")
 
-        self.get_accounts().withdraw_money(from_account, int(amount))
+        with self.tracer.span('withdraw_money', shard=self.accounts.shard(from_account)):
+            await self.accounts.withdraw_money(from_account, int(amount), response_key)
 
-        new_balance = self.get_accounts().get_account_balance(from_account)
         self.logger.info(
-            f"New balance: {new_balance} on account {from_account}."
+            "New balance.", extra=fields(account=from_account, balance=self.get_accounts().get_cached_balance(from_account))
         )
 
-    def get_accounts(self) -> Accounts:
-        return Accounts(self.accounts_sqlite)
\ No newline at end of file
+    def balance_action(self, requesting_person: str, account: str) -> str:
+        """
+        Answers the balance from memory, so that balance queries do not wait for the database.
+        """
+        self.logger.info("Balance requested.", extra=fields(person=requesting_person, account=account))
+
+        if not self.authorize(requesting_person, account, "BAL"):
+            raise ClientResponseException(f"Unauthorized BAL operation by {requesting_person} on account {account}!")
+
+        return str(self.get_accounts().get_cached_balance(account))
+
+    async def batch_action(self, requesting_person: str, message: str, response_key: Optional[Tuple[str, str]] = None) -> str:
+        """
+        Applies many ADD and SUB items, one per line after the BATCH [atomic] or BATCH [each] line, in one transaction.
+        Every item is authorized on its own. An atomic batch is applied only if every item succeeds,
+        otherwise every item that succeeds is applied. Returns the JSON list of results of the items, "OK" or the error.
+        """
+        lines = message.split("\n")
+        header = BATCH_PATTERN.match(lines[0])
+        if header is None:
+            raise ClientResponseException("Unknown batch mode, expected BATCH [atomic] or BATCH [each]!")
+        items = [line for line in lines[1:] if line.strip()]
+        if len(items) > self.max_batch_items:
+            raise ClientResponseException(f"Batch of {len(items)} items exceeds the limit of {self.max_batch_items} items!")
+        atomic = header.group('mode') == 'atomic'
+        self.logger.info("Batch requested.", extra=fields(person=requesting_person, atomic=atomic, items=len(items)))
+
+        batch_items, rejections = [], []
+        for item in items:
+            try:
+                batch_items.append(self.batch_item(requesting_person, item))
+                rejections.append(None)
+            except ClientResponseException as exception:
+                batch_items.append(exception)
+                rejections.append(exception)
+
+        if atomic and any(rejections):
+            # The batch would be rolled back anyway, the database is not needed to tell which items failed
+            return json.dumps([str(rejection) if rejection is not None else ROLLED_BACK for rejection in rejections])
+        try:
+            with self.tracer.span('apply_batch', items=len(batch_items)):
+                return await self.accounts.apply_batch(batch_items, atomic, response_key)
+        except BatchRolledBack as exception:
+            return exception.response
+
+    def batch_item(self, requesting_person: str, item: str) -> tuple:
+        """
+        Returns the authorized item as ('ADD', from_account, to_account, amount) or ('SUB', account, amount).
+        """
+        if item.startswith("ADD "):
+            match = ADD_PATTERN.match(item)
+            if match is not None:
+                if not self.authorize(requesting_person, match.group('from_account'), "ADD"):
+                    raise ClientResponseException(
+                        f"Unauthorized ADD operation by {requesting_person} on account {match.group('from_account')}!"
+                    )
+                return 'ADD', match.group('from_account'), match.group('to_account'), int(match.group('amount'))
+        elif item.startswith("SUB "):
+            match = SUB_PATTERN.match(item)
+            if match is not None:
+                if not self.authorize(requesting_person, match.group('from_account'), "SUB"):
+                    raise ClientResponseException(
+                        f"Unauthorized SUB operation by {requesting_person} on account {match.group('from_account')}!"
+                    )
+                return 'SUB', match.group('from_account'), int(match.group('amount'))
+        raise ClientResponseException(f"Unknown batch item {item}!")
+
+    def get_accounts(self) -> ShardedAccounts:
+        return self.accounts
\ No newline at end of file
@@ -1,22 +1,33 @@
 import asyncio
-from typing import Any
+from typing import Any, List, Optional
 
 import websockets
 import re
 
-import base64
-
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 
-from Connection import Connection
+from Codecs import Opaque, to_bytes, available_codecs, get_codec
+from Compression import compression_options
+from Connection import Connection, FailedRequest
+from LogPipeline import fields
+from Metrics import Metrics
+from Tracing import Tracer
+from Client.KeyCache import KeyCache, PeerKey
+from Client.Sessions import SessionKeys, RSA_ENCRYPTION, SESSION_ENCRYPTION
+from Client.Executors import Executors
+from Client.CryptoWorkers import rsa_encrypt, rsa_decrypt
 
 class ClientResponseException(Exception):
     pass
 
 class Client():
 
-    def __init__(self, client_data, logger):
+    def __init__(self, client_data, logger, executors: Optional[Executors] = None, metrics: Optional[Metrics] = None,
+                 tracer: Optional[Tracer] = None):
+        """
+        Clients served by one host share its worker pools and metrics (see Client/Host.py).
+        """
 
         # Load client parameters
         self.logger = logger
@@ -28,12 +39,30 @@ class Client():
         self.duration = int(client_data['general']['duration'])
         self.retries = int(client_data['general']['retries'])
         self.timeout = int(client_data['general']['timeout'])
+        # Deadline of a single attempt of a request, timeout above is the backoff between the attempts
+        self.request_timeout = float(client_data['general'].get('request_timeout', 30))
+        # Opt-in sending of many envelopes per websocket frame, used only if the server agrees
+        self.batching = client_data['general'].get('batching', '0') == '1'
+        self.batch_window = float(client_data['general'].get('batch_window', 0.001))
+        self.batch_max_size = int(client_data['general'].get('batch_max_size', 64))
+        # Preferred codec of the connection, the server may still choose JSON
+        self.codec = client_data['general'].get('codec', 'json')
+        # Opt-in sending of encrypted messages as opaque bytes that the server relays without decoding them
+        self.relay_frames = client_data['general'].get('relay_frames', '0') == '1'
+        # permessage-deflate settings of the connection, the defaults of the websockets library without them
+        self.compression = client_data.get('compression')
         self.server_ip = client_data['server']['ip']
         self.server_port = client_data['server']['port']
         self.actions = client_data['actions']
 
+        # Cache of peer public keys, so that they are not requested from the server for every message
+        self.key_cache = KeyCache(
+            max_size=int(client_data['general'].get('key_cache_size', 256)),
+            ttl=float(client_data['general'].get('key_cache_ttl', 300))
+        )
+
         # Create the list of information of actions, in the form of [[recipient0, message0], [recipient1, message1], ..]
-        self.actions_info = [re.findall(r'SEND \[(?P<reciver>.*?)] (?P<message>.*)', action)[0] for action in self.actions]
+        self.actions_info = [re.findall(r'SEND \[(?P<reciver>.*?)] (?P<message>.*)', action, re.DOTALL)[0] for action in self.actions]
 
         # Import own private key
         private_key_formatted = RSA.importKey(
@@ -43,98 +72,265 @@ class Client():
         # Decrypt the message using own private key
         self.cipher = PKCS1_OAEP.new(private_key_formatted)
 
+        # Worker pools for RSA and database work, so that it does not block the event loop
+        executors_config = client_data.get('executors', {})
+        self.executors = executors or Executors(
+            crypto_processes=int(executors_config.get('crypto_processes', 2)),
+            database_threads=int(executors_config.get('database_threads', 4))
+        )
+
+        # Counters and timings of the client, optionally served over HTTP in the Prometheus text format
+        self.metrics = metrics or Metrics()
+        self.metrics_config = client_data.get('metrics', {})
+        # Sampled spans of the requests sent and handled by the client (see Tracing.py)
+        self.tracer = tracer or Tracer.from_config(self.id, client_data.get('tracing', {}))
+        self.connection = None
+        # A client served by a host shares the connection with other clients and names itself in its requests
+        self.hosted = False
+        self.metrics.gauge('client_in_flight_requests', lambda: len(self.connection.pending) if self.connection else 0)
+        for pool in (self.executors.crypto, self.executors.database):
+            self.metrics.gauge('client_pool_in_flight', lambda pool=pool: pool.in_flight, pool=pool.name)
+            self.metrics.gauge('client_pool_completed', lambda pool=pool: pool.completed, pool=pool.name)
+        self.send_message_seconds = self.metrics.histogram('client_send_message_seconds')
+
+        # Opt-in hybrid encryption: RSA wraps a session key, messages are encrypted with AES-GCM
+        self.session_encryption = client_data['general'].get('session_encryption', '0') == '1'
+        self.sessions = SessionKeys(
+            self.rsa_encrypt,
+            self.rsa_decrypt,
+            max_messages=int(client_data['general'].get('session_max_messages', 1000)),
+            max_age=float(client_data['general'].get('session_max_age', 3600))
+        )
+
     async def start(self):
         await asyncio.wait_for(self.__start(), self.duration)
 
     async def __start(self):
         uri = f"ws://{self.server_ip}:{self.server_port}"
-        async with websockets.connect(uri) as websocket:
-            self.connection = Connection(websocket)
+        async with websockets.connect(uri, **compression_options(self.compression, server=False)) as websocket:
+            self.connection = Connection(websocket, timeout=self.request_timeout)
 
             await asyncio.gather(
                 self.register(),  # Register at the server
                 self.receive_messages(),  # Receive messages
-                # TODO: recipient can be specified also by first and last name
-                # Do the actions specified in the configuration file
-                *(self.send_message(recipient_id=action[0], message=action[1]) for action in self.actions_info)
+                *self.background_tasks(),
+                *self.perform_actions()
             )
 
-    async def register(self):
-        client_info = {
+    def perform_actions(self) -> list:
+        """
+        Coroutines doing the actions specified in the configuration file.
+        """
+        # TODO: recipient can be specified also by first and last name
+        return [self.send_message(recipient_id=action[0], message=action[1]) for action in self.actions_info]
+
+    def background_tasks(self) -> list:
+        """
+        Coroutines that run alongside the client for its whole duration.
+        """
+        if int(self.metrics_config.get('http_port', 0)) > 0:
+            return [self.metrics.serve_http(self.metrics_config.get('http_host', '127.0.0.1'), int(self.metrics_config['http_port']))]
+        return []
+
+    def registration_info(self) -> dict:
+        return {
             'id': self.id,
             'first_name': self.first_name,
             'last_name': self.last_name,
-            'public_key': self.public_key
+            'public_key': self.public_key,
+            'encryption': self.supported_encryption(),
+            'subscriptions': self.subscriptions(),
+            'batching': self.batching,
+            'codecs': [self.codec] if self.codec in available_codecs() else [],
+            'relay_frames': self.relay_frames
         }
-        if await self.connection.send(client_info, max_tries=self.retries, backoff=self.timeout):
-            self.logger.info("Registered.")
-        else:
+
+    async def register(self):
+        try:
+            registration = await self.connection.request(self.registration_info(), max_tries=self.retries, backoff=self.timeout)
+        except FailedRequest:
             raise Exception("Failed to register.")
+        registration = registration or {}
+        self.connection.set_codec(get_codec(registration.get('codec')))
+        if self.batching and registration.get('batching') is not None:
+            # Neither side waits longer or sends bigger batches than the other accepts
+            batching = registration['batching']
+            self.connection.enable_batching(
+                min(self.batch_window, float(batching.get('window', self.batch_window))),
+                min(self.batch_max_size, int(batching.get('max_size', self.batch_max_size)))
+            )
+        self.connection.relay_frames = self.relay_frames and bool(registration.get('relay_frames'))
+        self.logger.info("Registered.")
 
     async def complete_authentication(self, message_id: str, sender_id: str, decrypted_message: str):
-        self.logger.info(f"Requested to authenticate by {sender_id}")
+        self.logger.info("Authentication requested.", extra=fields(sender=sender_id))
         secret = decrypted_message.split(" ")[1]
-        await self.connection.report_success(message_id, await self.encrypt_message(sender_id, secret))
-        self.logger.info(f"Responded to authentication request by {sender_id}")
+        await self.connection.report_success(message_id, self.opaque(await self.encrypt_message(sender_id, secret)))
+        self.logger.info("Authentication answered.", extra=fields(sender=sender_id))
+
+    def subscriptions(self) -> List[str]:
+        """
+        Server notifications that the client wants to receive besides the ones sent to every client.
+        """
+        return []
 
-    def encrypt(self, message, recipient_public_key):
+    def supported_encryption(self) -> List[str]:
+        return [RSA_ENCRYPTION, SESSION_ENCRYPTION] if self.session_encryption else [RSA_ENCRYPTION]
+
+    async def encrypt(self, message, recipient_key: PeerKey):
         if message is None:
             return None
-        public_key_formatted = RSA.importKey(
-            '-----BEGIN RSA PUBLIC KEY-----\n' + recipient_public_key + "\n-----END RSA PUBLIC KEY-----")
         # Encrypt the message using the recipient's public key
-        cipher = PKCS1_OAEP.new(public_key_formatted)
-        ciphertext = cipher.encrypt(message.encode())
-        base64_bytes = base64.b64encode(ciphertext)
-        base64_ciphertext = base64_bytes.decode('ascii')
-        return base64_ciphertext
-
-    def decrypt(self, base64_ciphertext):
-        if base64_ciphertext is None:
+        # The ciphertext stays raw bytes, JSON codec sends it as base64 and binary codec as it is
+        return await self.rsa_encrypt(recipient_key, message.encode())
+
+    async def decrypt(self, encrypted_message, sender_id: Optional[str] = None):
+        if encrypted_message is None:
             return None
-        # Decode the encrypted message from base64
-        base64_bytes = base64_ciphertext.encode('ascii')
-        ciphertext = base64.b64decode(base64_bytes)
-        decrypted_message = self.cipher.decrypt(ciphertext).decode()
+        if isinstance(encrypted_message, dict):
+            return await self.decrypt_session_message(encrypted_message, sender_id)
+        # Decode the encrypted message from base64 unless it was received as bytes
+        ciphertext = to_bytes(encrypted_message)
+        decrypted_message = (await self.rsa_decrypt(ciphertext)).decode()
         return decrypted_message
 
+    async def rsa_encrypt(self, recipient_key: PeerKey, plaintext: bytes) -> bytes:
+        if self.executors.crypto.executor is None:
+            return recipient_key.cipher.encrypt(plaintext)
+        return await self.executors.run_crypto(rsa_encrypt, recipient_key.public_key, plaintext)
+
+    async def rsa_decrypt(self, ciphertext: bytes) -> bytes:
+        if self.executors.crypto.executor is None:
+            return self.cipher.decrypt(ciphertext)
+        return await self.executors.run_crypto(rsa_decrypt, self.private_key, ciphertext)
+
     async def send_message(self, recipient_id: str, message: str):
-        self.logger.debug("Message before encryption: " + message)
-        encrypted_message = await self.encrypt_message(recipient_id, message)
-        self.logger.debug("Encrypted message: " + str(encrypted_message))
-        response = await self.connection.action('send_message',
-                                     {'recipient_id': recipient_id, 'message': encrypted_message},
-                                     max_tries=self.retries,
-                                     backoff=self.timeout)
-        self.logger.info(f"Message delivered to {recipient_id} with response {response}")
-        return self.decrypt(response)
+        with self.tracer.span('send_message', recipient=recipient_id):
+            self.logger.debug("Message before encryption: %s", message)
+            encrypted_message = await self.encrypt_message(recipient_id, message)
+            self.logger.debug("Encrypted message: %s", encrypted_message)
+            data = {'recipient_id': recipient_id, 'message': self.opaque(encrypted_message)}
+            if self.hosted:
+                data['sender_id'] = self.id
+            with self.send_message_seconds.time(), self.tracer.span('request'):
+                response = await self.connection.action('send_message', data, max_tries=self.retries, backoff=self.timeout)
+            if isinstance(response, dict) and response.get('queued'):
+                # The recipient is offline, the server will deliver the message once it registers
+                self.logger.info("Message queued.", extra=fields(recipient=recipient_id))
+                return None
+            self.logger.info("Message delivered.", extra=fields(recipient=recipient_id, response=response))
+            with self.tracer.span('decrypt'):
+                return await self.decrypt(response, recipient_id)
+
+    def opaque(self, encrypted_message):
+        """
+        Encodes the encrypted message once, so that the server relays its bytes instead of decoding and encoding it again.
+        """
+        if encrypted_message is None or not self.connection.relay_frames:
+            return encrypted_message
+        return Opaque.wrap(encrypted_message, self.connection.codec)
 
     async def encrypt_message(self, recipient_id, message):
         if message is None:
             return None
-        recipient_public_key = await self.connection.action('get_public_key', recipient_id)
-        encrypted_message = self.encrypt(message, recipient_public_key)
-        return encrypted_message
+        recipient_key = await self.get_peer_key(recipient_id)
+        with self.tracer.span('encrypt'):
+            if self.session_encryption and self.sessions.is_supported(recipient_id):
+                return await self.sessions.encrypt(recipient_id, recipient_key, message)
+            encrypted_message = await self.encrypt(message, recipient_key)
+            return encrypted_message
+
+    async def decrypt_session_message(self, encrypted_message: dict, sender_id: Optional[str]) -> str:
+        if encrypted_message.get('scheme') != SESSION_ENCRYPTION:
+            raise ClientResponseException(f"Unsupported encryption scheme {encrypted_message.get('scheme')}!")
+        decrypted_message = await self.sessions.decrypt(sender_id, encrypted_message)
+        # The peer evidently supports sessions, so the replies can use them as well
+        if sender_id is not None:
+            self.sessions.mark_supported(sender_id)
+        return decrypted_message
+
+    async def get_peer_key(self, peer_id: str) -> PeerKey:
+        peer_key = self.key_cache.get(peer_id)
+        if peer_key is None:
+            with self.tracer.span('get_public_key', peer=peer_id):
+                peer_info = await self.fetch_peer_info(peer_id)
+            peer_key = self.key_cache.put(peer_id, peer_info['public_key'])
+            if SESSION_ENCRYPTION in peer_info.get('encryption', []):
+                self.sessions.mark_supported(peer_id)
+        return peer_key
+
+    async def fetch_peer_info(self, peer_id: str) -> dict:
+        if not self.session_encryption:
+            return {'public_key': await self.connection.action('get_public_key', peer_id)}
+        return await self.connection.action('get_peer_info', peer_id)
 
     async def receive_messages(self):
         async for message in self.connection.receive_many():
 
+                if 'action' in message['payload']:
+                    asyncio.create_task(self.handle_server_action(message))
+                    self.logger.debug("Server action scheduled for handling.")
+                    continue
+
                 asyncio.create_task(self.handle_message(message))
                 self.logger.debug("Message scheduled for handling.")
 
+    async def handle_server_action(self, message):
+        """
+        Handles notifications pushed by the server, as opposed to messages relayed from other clients.
+        """
+        if self.apply_server_action(message['payload']['action'], message['payload']['data']):
+            await self.connection.report_success(message['id'])
+        else:
+            await self.connection.report_failure(message['id'])
+
+    def apply_server_action(self, action: str, data: dict) -> bool:
+        """
+        Applies a notification of the server, returns False if the action is unknown.
+        """
+        if action == 'public_key_changed':
+            self.logger.info("Public key changed.", extra=fields(peer=data['id']))
+            self.key_cache.invalidate_public_key(data['previous_public_key'])
+            for peer_id in data['aliases']:
+                self.key_cache.invalidate(peer_id)
+                self.sessions.forget(peer_id)
+        elif action == 'client_deregistered':
+            self.peer_deregistered(data['id'], data['connection_id'])
+        else:
+            self.logger.warning("Unknown server action requested!", extra=fields(action=action))
+            return False
+        return True
+
     async def handle_message(self, message):
+        with self.tracer.continue_trace('handle_message', message.get('trace'), sender=message['payload'].get('sender_id')):
+            await self.__handle_message(message)
+
+    async def __handle_message(self, message):
         try:
-            decrypted_message = self.decrypt(message['payload']['message'])
-            self.logger.debug("Received message: " + decrypted_message)
+            # A retried request that was handled already is answered without decrypting and handling it again
+            idempotency_key = message['payload'].get('idempotency_key')
+            if idempotency_key is not None:
+                replayed = await self.replay_response(
+                    message['payload']['sender_id'], idempotency_key, message['payload'].get('attempt', 1) > 1
+                )
+                if replayed is not None:
+                    encrypted_response = await self.encrypt_message(message['payload']['sender_id'], replayed['response'])
+                    await self.connection.report_success(message['id'], self.opaque(encrypted_response))
+                    self.logger.debug("Response to a retried message replayed.")
+                    return
+
+            with self.tracer.span('decrypt'):
+                decrypted_message = await self.decrypt(message['payload']['message'], message['payload']['sender_id'])
+            self.logger.debug("Received message: %s", decrypted_message)
 
             # handle possible need to authenticate
             if decrypted_message.startswith("AUTH "):
                 await self.complete_authentication(message['id'], message['payload']['sender_id'], decrypted_message)
                 return
 
-            response = await self.receive_message(message['payload']['sender_id'], decrypted_message)
+            response = await self.receive_message(message['payload']['sender_id'], decrypted_message, message['payload'])
             encrypted_response = await self.encrypt_message(message['payload']['sender_id'], response)
-            await self.connection.report_success(message['id'], encrypted_response)
+            await self.connection.report_success(message['id'], self.opaque(encrypted_response))
 
             self.logger.debug("Message successfully handled.")
         except Exception as e:
@@ -145,5 +341,18 @@ class Client():
             await self.connection.report_failure(message['id'], response)
             self.logger.debug("Failure to receive message reported.")
 
-    async def receive_message(self, sender_id: str, message: Any) -> Any:
+    async def receive_message(self, sender_id: str, message: Any, metadata: dict) -> Any:
         pass
+
+    async def replay_response(self, sender_id: str, idempotency_key: str, retried: bool) -> Optional[dict]:
+        """
+        Returns {'response': response} if the request with the key was handled already, None otherwise.
+        Only a retried request may have been handled in an earlier run of the client.
+        """
+        return None
+
+    def peer_deregistered(self, peer_id: str, connection_id: str) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {'executors': self.executors.stats(), 'metrics': self.metrics.snapshot(), 'tracing': self.tracer.stats()}
@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+
+class Pool():
+    """
+    Wrapper around an executor that keeps track of the queue depth.
+    Without an executor the functions are called directly on the event loop.
+    """
+
+    def __init__(self, name: str, executor: Optional[Executor], workers: int):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+
+    async def run(self, function: Callable, *args) -> Any:
+        if self.executor is None:
+            self.completed += 1
+            return function(*args)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'queued': max(0, self.in_flight - self.workers),
+            'max_in_flight': self.max_in_flight,
+            'completed': self.completed
+        }
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class Executors():
+    """
+    This class provides worker pools for blocking work, so that it does not stall the event loop.
+
+    RSA operations are CPU bound and hold the GIL, therefore they run in a process pool.
+    SQLite calls release the GIL while waiting for the disk or a lock, therefore a thread pool is enough.
+    Setting the number of workers to 0 runs the work directly on the event loop.
+    """
+
+    def __init__(self, crypto_processes: int = 2, database_threads: int = 4):
+        self.crypto = Pool(
+            'crypto',
+            ProcessPoolExecutor(crypto_processes) if crypto_processes > 0 else None,
+            crypto_processes
+        )
+        self.database = Pool(
+            'database',
+            ThreadPoolExecutor(database_threads, thread_name_prefix='database') if database_threads > 0 else None,
+            database_threads
+        )
+
+    async def run_crypto(self, function: Callable, *args) -> Any:
+        return await self.crypto.run(function, *args)
+
+    async def run_database(self, function: Callable, *args) -> Any:
+        return await self.database.run(function, *args)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {'crypto': self.crypto.stats(), 'database': self.database.stats()}
+
+    def shutdown(self) -> None:
+        self.crypto.shutdown()
+        self.database.shutdown()
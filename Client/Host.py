@@ -0,0 +1,122 @@
+import asyncio
+from logging import Logger
+from typing import Awaitable, Dict, List, Type
+
+import websockets
+
+from Compression import compression_options
+from Connection import Connection
+from LogPipeline import fields
+from Metrics import Metrics
+from Tracing import Tracer
+from Client.Client import Client
+from Client.Executors import Executors
+from Client.Person import Person
+
+
+class Host():
+    """
+    This class serves many clients over a single connection to the server, e.g. to run thousands of endpoints in one process.
+
+    The first client registers when the connection opens and the others with the register action of the server.
+    Every client keeps its own keys, sessions and handling of messages, while the worker pools, metrics and tracer are shared.
+    Messages relayed by the server name their recipient and are dispatched to it,
+    notifications of the server are applied to every client and acknowledged once.
+
+    The server limits the requests handled at once per connection, not per client,
+    therefore the host keeps at most max_in_flight registrations and actions of its clients in progress.
+    """
+
+    def __init__(self, host_data: dict, clients_data: List[dict], logger: Logger, client_class: Type[Client] = Person):
+        self.logger = logger
+        executors_config = host_data.get('executors', {})
+        self.executors = Executors(
+            crypto_processes=int(executors_config.get('crypto_processes', 2)),
+            database_threads=int(executors_config.get('database_threads', 0))
+        )
+        self.metrics = Metrics()
+        self.metrics_config = host_data.get('metrics', {})
+        self.tracer = Tracer.from_config('host', host_data.get('tracing', {}))
+        self.clients = [
+            client_class(client_data, logger.getChild(client_data['person']['id']), self.executors, self.metrics, self.tracer)
+            for client_data in clients_data
+        ]
+        self.clients_by_id: Dict[str, Client] = {client.id: client for client in self.clients}
+        self.duration = float(host_data.get('duration', max(client.duration for client in self.clients)))
+        self.max_in_flight = int(host_data.get('max_in_flight', 16))
+        self.compression = host_data.get('compression')
+        self.connection = None
+        self.metrics.gauge('host_clients', lambda: len(self.clients))
+
+    async def start(self):
+        await asyncio.wait_for(self.__start(), self.duration)
+
+    async def __start(self):
+        first = self.clients[0]
+        uri = f"ws://{first.server_ip}:{first.server_port}"
+        async with websockets.connect(uri, **compression_options(self.compression, server=False)) as websocket:
+            self.connection = Connection(websocket, timeout=first.request_timeout)
+            for client in self.clients:
+                client.connection = self.connection
+                client.hosted = True
+
+            await asyncio.gather(
+                self.run(),
+                self.receive_messages(),
+                *self.background_tasks()
+            )
+
+    def background_tasks(self) -> list:
+        if int(self.metrics_config.get('http_port', 0)) > 0:
+            return [self.metrics.serve_http(self.metrics_config.get('http_host', '127.0.0.1'), int(self.metrics_config['http_port']))]
+        return []
+
+    async def run(self):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def limited(request: Awaitable):
+            async with in_flight:
+                return await request
+
+        # The connection is opened by the registration of the first client, which also agrees on the codec and batching
+        first = self.clients[0]
+        await first.register()
+        await asyncio.gather(*(
+            limited(self.connection.action(
+                'register', client.registration_info(), max_tries=client.retries, backoff=client.timeout
+            ))
+            for client in self.clients[1:]
+        ))
+        self.logger.info("Registered clients.", extra=fields(clients=len(self.clients)))
+
+        await asyncio.gather(*(
+            limited(action)
+            for client in self.clients for action in client.perform_actions()
+        ))
+
+    async def receive_messages(self):
+        async for message in self.connection.receive_many():
+            payload = message['payload']
+            if 'action' in payload:
+                asyncio.create_task(self.handle_server_action(message))
+                continue
+            client = self.clients_by_id.get(payload.get('recipient_id'))
+            if client is None:
+                self.logger.warning("Message for unknown client received!", extra=fields(recipient=payload.get('recipient_id')))
+                asyncio.create_task(self.connection.report_failure(message['id']))
+                continue
+            asyncio.create_task(client.handle_message(message))
+
+    async def handle_server_action(self, message):
+        action = message['payload']['action']
+        data = message['payload']['data']
+        if all([client.apply_server_action(action, data) for client in self.clients]):
+            await self.connection.report_success(message['id'])
+        else:
+            await self.connection.report_failure(message['id'])
+
+    def stats(self) -> dict:
+        return {
+            'clients': len(self.clients), 'executors': self.executors.stats(), 'metrics': self.metrics.snapshot(),
+            'tracing': self.tracer.stats()
+        }
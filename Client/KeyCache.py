@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from Client.CryptoWorkers import public_cipher
+
+
+class PeerKey():
+    """
+    Public key of a peer together with a ready to use cipher.
+    The key is parsed on first use, when RSA runs in worker processes it is parsed only there.
+    """
+
+    def __init__(self, public_key: str):
+        self.public_key = public_key
+        self.created_at = time.monotonic()
+        self.references = 0
+        self._cipher = None
+
+    @property
+    def cipher(self):
+        if self._cipher is None:
+            self._cipher = public_cipher(self.public_key)
+        return self._cipher
+
+
+class KeyCache():
+    """
+    This class provides a bounded cache of peer public keys.
+
+    Parsing a 4096 bit RSA key and asking the server for it are both expensive,
+    therefore keys are kept per peer id and evicted when:
+        - the cache grows above max_size (least recently used peer goes first)
+        - the entry is older than ttl seconds
+        - the server reports that the peer registered with a different key
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 300.):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.keys_by_peer_id: OrderedDict = OrderedDict()
+        self.keys_by_public_key = dict()
+
+    def get(self, peer_id: str) -> Optional[PeerKey]:
+        peer_key = self.keys_by_peer_id.get(peer_id)
+        if peer_key is None:
+            return None
+        if time.monotonic() - peer_key.created_at > self.ttl:
+            self.invalidate(peer_id)
+            return None
+        self.keys_by_peer_id.move_to_end(peer_id)
+        return peer_key
+
+    def put(self, peer_id: str, public_key: str) -> PeerKey:
+        self.invalidate(peer_id)
+        # Several ids (e.g. id and name) may point to the same key, parse it only once
+        peer_key = self.keys_by_public_key.get(public_key)
+        if peer_key is None or time.monotonic() - peer_key.created_at > self.ttl:
+            peer_key = PeerKey(public_key)
+            self.keys_by_public_key[public_key] = peer_key
+        peer_key.references += 1
+        self.keys_by_peer_id[peer_id] = peer_key
+        while len(self.keys_by_peer_id) > self.max_size:
+            self.invalidate(next(iter(self.keys_by_peer_id)))
+        return peer_key
+
+    def invalidate(self, peer_id: str) -> None:
+        peer_key = self.keys_by_peer_id.pop(peer_id, None)
+        if peer_key is None:
+            return
+        peer_key.references -= 1
+        if peer_key.references == 0 and self.keys_by_public_key.get(peer_key.public_key) is peer_key:
+            del self.keys_by_public_key[peer_key.public_key]
+
+    def invalidate_public_key(self, public_key: str) -> None:
+        for peer_id, peer_key in list(self.keys_by_peer_id.items()):
+            if peer_key.public_key == public_key:
+                self.invalidate(peer_id)
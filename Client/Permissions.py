@@ -0,0 +1,50 @@
+import json
+from typing import Dict, Optional, Tuple
+
+PERSONAL_ACCOUNT = 'personal account'
+
+
+class Permissions():
+    """
+    This class provides a compiled form of the bank permissions configuration.
+
+    The nested organizations and persons structure is flattened into an index keyed by (person, account, permission),
+    so that authorization is a single dictionary lookup regardless of the number of employees and accounts.
+    Instances are immutable, a changed configuration is compiled into a new instance which replaces the old one.
+    """
+
+    def __init__(self, bank_permissions: dict):
+        self.public_key_per_person_id: Dict[str, str] = {}
+        self.organization_per_account: Dict[str, str] = {}
+        # (person, account, permission) -> organization granting the permission or PERSONAL_ACCOUNT
+        self.grants: Dict[Tuple[str, str, str], str] = {}
+        # (person, account) -> PERSONAL_ACCOUNT, personal account allows every operation
+        self.personal_accounts: Dict[Tuple[str, str], str] = {}
+
+        for person_id, person_data in bank_permissions['persons'].items():
+            self.public_key_per_person_id[person_id] = person_data['public_key']
+            self.personal_accounts[(person_id, person_data['account'])] = PERSONAL_ACCOUNT
+
+        for organization_id, organization_data in bank_permissions['organizations'].items():
+            organization_account_id = organization_data['account']
+            if organization_account_id in self.organization_per_account:
+                raise Exception(f"One account {organization_account_id} assigned to two organizations!")
+            self.organization_per_account[organization_account_id] = organization_id
+            for person_id, employee_data in organization_data['employees'].items():
+                for permission in employee_data['permissions']:
+                    self.grants[(person_id, organization_account_id, permission)] = organization_id
+
+    @classmethod
+    def load(cls, bank_permissions_file: str) -> 'Permissions':
+        with open(bank_permissions_file) as bank_permissions:
+            return cls(json.load(bank_permissions))
+
+    def get_public_key(self, person_id: str) -> str:
+        return self.public_key_per_person_id[person_id]
+
+    def authorize(self, person_id: str, account_id: str, permission: str) -> Optional[str]:
+        """
+        Returns who grants the permission: PERSONAL_ACCOUNT or the organization owning the account.
+        Returns None if the permission is not granted.
+        """
+        return self.personal_accounts.get((person_id, account_id)) or self.grants.get((person_id, account_id, permission))
@@ -1,9 +1,10 @@
 from typing import Any
 
 from Client.Client import Client
+from LogPipeline import fields
 
 
 class Person(Client):
 
-    async def receive_message(self, sender_id: str, message: Any):
-        self.logger.info(f"From {sender_id} received message: {message}")
+    async def receive_message(self, sender_id: str, message: Any, metadata: dict):
+        self.logger.info("Message received.", extra=fields(sender=sender_id, message=message))
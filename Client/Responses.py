@@ -0,0 +1,87 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from Client.ShardedAccounts import ShardedAccounts
+from Client.Executors import Executors
+from Metrics import Metrics
+
+
+class Responses():
+    """
+    This class replays responses to retried requests, recognized by the idempotency key chosen by their sender.
+
+    A request is identified by the id of its sender and its key, so that senders can not replay each other's responses.
+    Duplicates arriving while the request is still handled wait for the same result instead of handling it again.
+    Results of handled requests are kept in a bounded memory cache, while the requests that changed the accounts
+    are also recorded by Accounts in the same transaction as the change (see Accounts.apply_operations),
+    so that a request is never applied twice, not even after a restart of the bank.
+    The database is searched only for retried attempts, the first attempt of a request can not have been recorded,
+    and a duplicate recorded meanwhile is refused by the primary key of the responses table anyway.
+    Only successful results are kept, a request that failed, e.g. because it was not authenticated, may be retried.
+    """
+
+    def __init__(self, accounts: ShardedAccounts, executors: Executors, max_size: int = 10000, metrics: Optional[Metrics] = None):
+        self.accounts = accounts
+        self.executors = executors
+        self.max_size = max_size
+        self.responses_by_key: OrderedDict = OrderedDict()
+        self.in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+        metrics = metrics or Metrics()
+        self.replayed_from_memory = metrics.counter('bank_replayed_responses', source='memory')
+        self.replayed_from_database = metrics.counter('bank_replayed_responses', source='database')
+        self.replayed_in_flight = metrics.counter('bank_replayed_responses', source='in_flight')
+        metrics.gauge('bank_cached_responses', lambda: len(self.responses_by_key))
+        metrics.gauge('bank_in_flight_idempotent_requests', lambda: len(self.in_flight))
+
+    async def replay(self, sender_id: str, key: str, retried: bool = True) -> Optional[dict]:
+        """
+        Returns {'response': response} if the request was handled already, None otherwise.
+        """
+        request_key = (sender_id, key)
+        in_flight = self.in_flight.get(request_key)
+        if in_flight is not None:
+            self.replayed_in_flight.inc()
+            return {'response': await asyncio.shield(in_flight)}
+        if request_key in self.responses_by_key:
+            self.responses_by_key.move_to_end(request_key)
+            self.replayed_from_memory.inc()
+            return {'response': self.responses_by_key[request_key]}
+        if not retried:
+            return None
+        stored = await self.executors.run_database(self.accounts.get_response, sender_id, key)
+        if stored is not None:
+            self.replayed_from_database.inc()
+            self.__remember(request_key, stored['response'])
+        return stored
+
+    async def run(self, sender_id: str, key: str, handle: Callable[[], Awaitable]) -> Any:
+        """
+        Handles the request once, concurrent duplicates share the result.
+        """
+        request_key = (sender_id, key)
+        # A duplicate that passed replay() while the original was finishing gets its result
+        if request_key in self.responses_by_key:
+            self.responses_by_key.move_to_end(request_key)
+            self.replayed_from_memory.inc()
+            return self.responses_by_key[request_key]
+        in_flight = self.in_flight.get(request_key)
+        if in_flight is None:
+            in_flight = asyncio.ensure_future(handle())
+            self.in_flight[request_key] = in_flight
+            in_flight.add_done_callback(lambda _: self.__finished(request_key, in_flight))
+        else:
+            self.replayed_in_flight.inc()
+        return await asyncio.shield(in_flight)
+
+    def __finished(self, request_key: Tuple[str, str], in_flight: asyncio.Future) -> None:
+        del self.in_flight[request_key]
+        # Failed requests are not remembered, the sender may retry them
+        if not in_flight.cancelled() and in_flight.exception() is None:
+            self.__remember(request_key, in_flight.result())
+
+    def __remember(self, request_key: Tuple[str, str], response: Any) -> None:
+        self.responses_by_key[request_key] = response
+        self.responses_by_key.move_to_end(request_key)
+        while len(self.responses_by_key) > self.max_size:
+            self.responses_by_key.popitem(last=False)
@@ -0,0 +1,118 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from Crypto.Cipher import AES
+
+from Client.KeyCache import PeerKey
+from Codecs import to_bytes
+
+RSA_ENCRYPTION = 'rsa-oaep'
+SESSION_ENCRYPTION = 'rsa-aes-gcm'
+
+
+def failed(future: asyncio.Future) -> bool:
+    return future.done() and (future.cancelled() or future.exception() is not None)
+
+
+class OutgoingSession():
+
+    def __init__(self, peer_key: PeerKey, wrap_key: Callable[[PeerKey, bytes], Awaitable[bytes]]):
+        self.id = secrets.token_urlsafe(12)
+        self.key = secrets.token_bytes(32)
+        # Concurrent messages to the same peer wait for the same RSA operation
+        self.wrapped_key = asyncio.ensure_future(wrap_key(peer_key, self.key))
+        self.public_key = peer_key.public_key
+        self.created_at = time.monotonic()
+        self.messages = 0
+
+
+class SessionKeys():
+    """
+    This class provides hybrid encryption of messages exchanged with peers.
+
+    RSA is used only to wrap a random AES key once per session.
+    Messages are then encrypted with AES-GCM, which is orders of magnitude cheaper than RSA.
+    The wrapped key travels with every message, so the recipient does not need to keep any state,
+    but it unwraps the key with its private key only once and reuses it for the following messages.
+
+    The session key of a peer is rotated after max_messages messages or max_age seconds.
+    Sessions are used only with peers that are known to support them, otherwise RSA is used as before.
+    """
+
+    def __init__(self,
+                 wrap_key: Callable[[PeerKey, bytes], Awaitable[bytes]],
+                 unwrap_key: Callable[[bytes], Awaitable[bytes]],
+                 max_messages: int = 1000, max_age: float = 3600., max_peers: int = 1024):
+        self.wrap_key = wrap_key
+        self.unwrap_key = unwrap_key
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_peers = max_peers
+        self.outgoing_by_peer_id = dict()
+        self.incoming_keys: OrderedDict = OrderedDict()
+        self.supporting_peers: OrderedDict = OrderedDict()
+
+    def mark_supported(self, peer_id: str) -> None:
+        self.supporting_peers[peer_id] = True
+        self.supporting_peers.move_to_end(peer_id)
+        while len(self.supporting_peers) > self.max_peers:
+            self.forget(next(iter(self.supporting_peers)))
+
+    def is_supported(self, peer_id: str) -> bool:
+        return peer_id in self.supporting_peers
+
+    def forget(self, peer_id: str) -> None:
+        self.supporting_peers.pop(peer_id, None)
+        self.outgoing_by_peer_id.pop(peer_id, None)
+
+    async def encrypt(self, peer_id: str, peer_key: PeerKey, message: str) -> dict:
+        session = self.__get_outgoing_session(peer_id, peer_key)
+        session.messages += 1
+        wrapped_key = await asyncio.shield(session.wrapped_key)
+        cipher = AES.new(session.key, AES.MODE_GCM)
+        cipher.update(session.id.encode())
+        ciphertext, tag = cipher.encrypt_and_digest(message.encode())
+        return {
+            'scheme': SESSION_ENCRYPTION,
+            'session': session.id,
+            'key': wrapped_key,
+            'nonce': cipher.nonce,
+            'ciphertext': ciphertext,
+            'tag': tag
+        }
+
+    async def decrypt(self, sender_id: Optional[str], encrypted_message: dict) -> str:
+        key = await asyncio.shield(
+            self.__get_incoming_key(sender_id, encrypted_message['session'], encrypted_message['key'])
+        )
+        cipher = AES.new(key, AES.MODE_GCM, nonce=to_bytes(encrypted_message['nonce']))
+        cipher.update(encrypted_message['session'].encode())
+        return cipher.decrypt_and_verify(
+            to_bytes(encrypted_message['ciphertext']),
+            to_bytes(encrypted_message['tag'])
+        ).decode()
+
+    def __get_outgoing_session(self, peer_id: str, peer_key: PeerKey) -> OutgoingSession:
+        session = self.outgoing_by_peer_id.get(peer_id)
+        if session is None \
+                or failed(session.wrapped_key) \
+                or session.public_key != peer_key.public_key \
+                or session.messages >= self.max_messages \
+                or time.monotonic() - session.created_at >= self.max_age:
+            session = OutgoingSession(peer_key, self.wrap_key)
+            self.outgoing_by_peer_id[peer_id] = session
+        return session
+
+    def __get_incoming_key(self, sender_id: Optional[str], session_id: str, wrapped_key) -> asyncio.Future:
+        incoming_key_id = (sender_id, session_id)
+        key = self.incoming_keys.get(incoming_key_id)
+        if key is None or failed(key):
+            key = asyncio.ensure_future(self.unwrap_key(to_bytes(wrapped_key)))
+            self.incoming_keys[incoming_key_id] = key
+            while len(self.incoming_keys) > self.max_peers:
+                self.incoming_keys.popitem(last=False)
+        self.incoming_keys.move_to_end(incoming_key_id)
+        return key
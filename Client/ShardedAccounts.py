@@ -0,0 +1,359 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import zlib
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import apsw
+
+from Client.Client import ClientResponseException
+from Client.Accounts import Accounts, APPLIED, BatchRolledBack, ROLLED_BACK, WITHDRAWAL, failed_operation
+from Client.Executors import Executors
+from Client.TransferQueue import TransferQueue
+from Metrics import Metrics
+from Tracing import Tracer
+
+# An item of a batch: ('ADD', from_account, to_account, amount), ('SUB', account, amount) or the exception rejecting it
+BatchItem = Union[tuple, Exception]
+
+
+def shard_of(account_id: str, shards: int) -> int:
+    """
+    Returns the shard of the account, the hash is stable across processes unlike hash() of Python.
+    """
+    return zlib.crc32(account_id.encode()) % shards
+
+
+def shard_filenames(filename: str, shards: int) -> List[str]:
+    """
+    Returns the database files of the shards, e.g. accounts-shard0.sqlite, a single shard uses the file itself.
+    """
+    if shards == 1:
+        return [filename]
+    base, extension = os.path.splitext(filename)
+    return [f"{base}-shard{index}{extension}" for index in range(shards)]
+
+
+def batch_of(transfer_id: str) -> Optional[str]:
+    """
+    Returns the id of the batch whose item debited the transfer, None for a transfer on its own.
+    """
+    batch_id, separator, _ = transfer_id.partition('/')
+    return batch_id if separator else None
+
+
+def remove_database(filename: str) -> None:
+    for path in (filename, f"{filename}-wal", f"{filename}-shm", f"{filename}-journal"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def split_accounts(filename: str, shards: int) -> List[str]:
+    """
+    Copies the accounts and recorded responses of a database into new shard databases, returns their files.
+    The source database is left untouched, the copies are verified to hold the same accounts and the same total.
+    """
+    if shards < 2:
+        raise ValueError("Accounts can be split into 2 or more shards!")
+    filenames = shard_filenames(filename, shards)
+    existing = [shard_filename for shard_filename in filenames if os.path.exists(shard_filename)]
+    if existing:
+        raise FileExistsError(f"Shards {', '.join(existing)} already exist!")
+
+    source = apsw.Connection(filename, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        schema = source.cursor().execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'accounts'").fetchone()
+        if schema is None:
+            raise ValueError(f"{filename} has no accounts table!")
+        targets = [apsw.Connection(shard_filename) for shard_filename in filenames]
+        try:
+            copy_accounts(source, targets, schema[0])
+        except:
+            # Shards left behind would make the next attempt fail as existing
+            for target in targets:
+                target.close()
+            for shard_filename in filenames:
+                remove_database(shard_filename)
+            raise
+        for target in targets:
+            target.close()
+    finally:
+        source.close()
+    return filenames
+
+
+def copy_accounts(source: apsw.Connection, targets: List[apsw.Connection], schema: str) -> None:
+    shards = len(targets)
+    for target in targets:
+        target.cursor().execute("BEGIN")
+        target.cursor().execute(schema)
+
+    accounts, total = 0, 0
+    for account_id, balance in source.cursor().execute("SELECT id, balance FROM accounts"):
+        targets[shard_of(account_id, shards)].cursor().execute(
+            "INSERT INTO accounts (id, balance) VALUES (?, ?)", (account_id, balance)
+        )
+        accounts, total = accounts + 1, total + (balance or 0)
+
+    # Responses are looked up in every shard, so all of them can stay together
+    has_responses = source.cursor().execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'responses'"
+    ).fetchone()
+    if has_responses:
+        targets[0].cursor().execute(
+            "CREATE TABLE responses (sender_id TEXT NOT NULL, key TEXT NOT NULL, response TEXT, created_at REAL NOT NULL, "
+            "PRIMARY KEY (sender_id, key))"
+        )
+        targets[0].cursor().executemany(
+            "INSERT INTO responses VALUES (?, ?, ?, ?)",
+            list(source.cursor().execute("SELECT sender_id, key, response, created_at FROM responses"))
+        )
+
+    copied_accounts, copied_total = 0, 0
+    for target in targets:
+        count, balance = target.cursor().execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM accounts").fetchone()
+        copied_accounts, copied_total = copied_accounts + count, copied_total + balance
+    if (copied_accounts, copied_total) != (accounts, total):
+        raise Exception(f"Copied {copied_accounts} accounts with {copied_total} in total instead of {accounts} with {total}!")
+
+    for target in targets:
+        target.cursor().execute("COMMIT")
+
+
+class ShardedAccounts():
+    """
+    This class partitions the accounts across many databases by a stable hash of the account id.
+
+    SQLite lets only one transaction write a database at a time, therefore every shard has its own Accounts
+    and its own TransferQueue writing to it, so that transfers between accounts of different shards do not wait for each other.
+
+    A transfer within one shard is a single transaction as before.
+    A transfer between shards debits the source shard and credits the destination shard in two transactions,
+    the transfer is recorded in both of them, so that money is never lost or created (see Accounts):
+        - if the bank stops after the debit, recover() credits the transfer when the bank starts again
+        - if the destination refuses the credit, e.g. the account does not exist, the source is refunded
+        - crediting or refunding a transfer twice does nothing
+    A batch stays a single transaction when all of its accounts are in one shard. A batch across shards is applied
+    in the same two phases: every shard debits the items of its accounts in one transaction, then the first shard records
+    the decision on the batch and the debits are delivered, or refunded if an atomic batch had a failing item.
+    A batch interrupted before its decision is aborted by recover(), after it the debits are delivered.
+
+    With a single shard the accounts database is used as is.
+    """
+
+    def __init__(self, filename: str, executors: Executors, shards: int = 1, max_batch: int = 64, batch_window: float = 0.002,
+                 metrics: Optional[Metrics] = None, tracer: Optional[Tracer] = None, **accounts_options):
+        self.executors = executors
+        metrics = metrics or Metrics()
+        self.shards = [
+            Accounts(shard_filename, metrics=metrics, **accounts_options) for shard_filename in shard_filenames(filename, shards)
+        ]
+        self.transfers = [TransferQueue(accounts, executors, max_batch, batch_window, tracer) for accounts in self.shards]
+        self.cross_shard_transfers = metrics.counter('accounts_cross_shard_transfers')
+        self.cross_shard_batches = metrics.counter('accounts_cross_shard_batches')
+        self.recovered_transfers = metrics.counter('accounts_recovered_transfers')
+        # Batches across shards not decided yet, recover() leaves their debits alone
+        self.batches_in_progress: Set[str] = set()
+
+    def shard(self, account_id: str) -> int:
+        return shard_of(account_id, len(self.shards))
+
+    def has_account(self, account_id: str) -> bool:
+        return self.shards[self.shard(account_id)].has_account(account_id)
+
+    def get_cached_balance(self, account_id: str) -> int:
+        return self.shards[self.shard(account_id)].get_cached_balance(account_id)
+
+    def get_response(self, sender_id: str, key: str) -> Optional[dict]:
+        """
+        Responses are recorded by the shard that applied the request, therefore all shards are asked.
+        """
+        for accounts in self.shards:
+            response = accounts.get_response(sender_id, key)
+            if response is not None:
+                return response
+        return None
+
+    def prune_responses(self, max_age: float, max_rows: int) -> int:
+        return sum(accounts.prune_responses(max_age, max_rows) for accounts in self.shards)
+
+    async def transfer_money(self, from_account_id: str, to_account_id: str, amount: int,
+                             response_key: Optional[Tuple[str, str]] = None):
+        source, destination = self.shard(from_account_id), self.shard(to_account_id)
+        if source == destination:
+            return await self.transfers[source].transfer_money(from_account_id, to_account_id, amount, response_key)
+
+        if amount < 0:
+            raise ClientResponseException(f"Only positive amount of money can be transferred while requested {amount}.")
+        if not self.shards[destination].has_account(to_account_id):
+            raise ClientResponseException(f"Account {to_account_id} does not exist!")
+        transfer_id = uuid.uuid4().hex
+        await self.transfers[source].submit(
+            self.shards[source].debit_operation(transfer_id, from_account_id, to_account_id, amount, response_key)
+        )
+        self.cross_shard_transfers.inc()
+        await self.__deliver(transfer_id, from_account_id, to_account_id, amount, response_key)
+
+    async def withdraw_money(self, account_id: str, amount: int, response_key: Optional[Tuple[str, str]] = None):
+        return await self.transfers[self.shard(account_id)].withdraw_money(account_id, amount, response_key)
+
+    async def apply_batch(self, items: List[BatchItem], atomic: bool, response_key: Optional[Tuple[str, str]] = None) -> str:
+        """
+        Applies the items of a batch, returns the JSON list of their results (see Accounts.batch_operation).
+        """
+        shards = {self.shard(account_id) for item in items for account_id in self.__accounts(item)}
+        if len(shards) <= 1:
+            index = shards.pop() if shards else 0
+            accounts = self.shards[index]
+            return await self.transfers[index].apply_batch(
+                [self.__operation(accounts, item) for item in items], atomic, response_key
+            )
+        return await self.__apply_batch_across_shards(items, atomic, response_key)
+
+    async def recover(self, min_age: float = 0.) -> int:
+        """
+        Delivers transfers between shards debited at least min_age seconds ago and not completed, e.g. because the bank stopped.
+        Returns the number of transfers delivered or refunded.
+        """
+        recovered = 0
+        decisions: Dict[str, bool] = {}
+        for index, accounts in enumerate(self.shards):
+            outgoing_transfers = await self.executors.run_database(accounts.get_outgoing_transfers, time.time() - min_age)
+            for transfer_id, from_account_id, to_account_id, amount, sender_id, key in outgoing_transfers:
+                batch_id = batch_of(transfer_id)
+                if batch_id in self.batches_in_progress:
+                    continue
+                if batch_id is not None and batch_id not in decisions:
+                    # A batch without a decision was interrupted during its debits, it is aborted unless it committed meanwhile
+                    decisions[batch_id] = await self.transfers[0].submit(self.shards[0].decide_batch_operation(batch_id, False))
+                if batch_id is not None and not decisions[batch_id]:
+                    await self.transfers[index].submit(accounts.refund_operation(transfer_id, from_account_id, amount))
+                    recovered += 1
+                    self.recovered_transfers.inc()
+                    continue
+                try:
+                    await self.__deliver(
+                        transfer_id, from_account_id, to_account_id, amount, (sender_id, key) if key is not None else None
+                    )
+                except ClientResponseException:
+                    pass
+                recovered += 1
+                self.recovered_transfers.inc()
+        return recovered
+
+    def close(self):
+        for accounts in self.shards:
+            accounts.close()
+
+    async def __deliver(self, transfer_id: str, from_account_id: str, to_account_id: str, amount: int,
+                        response_key: Optional[Tuple[str, str]]):
+        source = self.shard(from_account_id)
+        try:
+            if to_account_id != WITHDRAWAL:
+                destination = self.shard(to_account_id)
+                await self.transfers[destination].submit(
+                    self.shards[destination].credit_operation(transfer_id, to_account_id, amount)
+                )
+        except ClientResponseException:
+            await self.transfers[source].submit(
+                self.shards[source].refund_operation(transfer_id, from_account_id, amount, response_key)
+            )
+            raise
+        await self.transfers[source].submit(self.shards[source].complete_operation(transfer_id))
+
+    async def __apply_batch_across_shards(self, items: List[BatchItem], atomic: bool,
+                                          response_key: Optional[Tuple[str, str]]) -> str:
+        batch_id = uuid.uuid4().hex
+        results: List[Optional[str]] = [None] * len(items)
+        indexes_by_shard: Dict[int, List[int]] = {}
+        for index, item in enumerate(items):
+            if isinstance(item, Exception):
+                results[index] = str(item)
+            elif item[0] == 'ADD' and not self.has_account(item[2]):
+                results[index] = f"Account {item[2]} does not exist!"
+            else:
+                indexes_by_shard.setdefault(self.shard(item[1]), []).append(index)
+        if atomic and any(results):
+            raise BatchRolledBack(json.dumps([result or ROLLED_BACK for result in results]))
+
+        self.cross_shard_batches.inc()
+        self.batches_in_progress.add(batch_id)
+        try:
+            debits = await asyncio.gather(*(
+                self.__debit_items(batch_id, shard, indexes, items, atomic) for shard, indexes in indexes_by_shard.items()
+            ))
+            for shard_results in debits:
+                for index, result in shard_results:
+                    results[index] = result
+            debited = [index for index, result in enumerate(results) if result == APPLIED]
+            response = json.dumps(results)
+            try:
+                committed = await self.transfers[0].submit(self.shards[0].decide_batch_operation(
+                    batch_id, not atomic or len(debited) == len(items), response_key, response
+                ))
+            except:
+                # E.g. the request was applied already, recover() refunds the debits if refunding them now fails
+                await self.__settle(batch_id, items, debited, False)
+                raise
+            await self.__settle(batch_id, items, debited, committed)
+        finally:
+            self.batches_in_progress.discard(batch_id)
+        if not committed:
+            raise BatchRolledBack(json.dumps([ROLLED_BACK if result == APPLIED else result for result in results]))
+        return response
+
+    async def __debit_items(self, batch_id: str, shard: int, indexes: List[int], items: List[BatchItem],
+                            atomic: bool) -> List[Tuple[int, str]]:
+        """
+        Debits the items of the batch from the accounts of the shard in one transaction, returns the result of every item.
+        """
+        accounts = self.shards[shard]
+        operations = [
+            accounts.debit_operation(
+                f"{batch_id}/{index}", items[index][1], items[index][2] if items[index][0] == 'ADD' else WITHDRAWAL,
+                items[index][-1]
+            )
+            for index in indexes
+        ]
+        try:
+            response = await self.transfers[shard].apply_batch(operations, atomic)
+        except BatchRolledBack as exception:
+            response = exception.response
+        except Exception as exception:
+            # The transaction failed as a whole, e.g. the database is not available, so nothing was debited
+            return [(index, str(exception)) for index in indexes]
+        return list(zip(indexes, json.loads(response)))
+
+    async def __settle(self, batch_id: str, items: List[BatchItem], debited: List[int], committed: bool) -> None:
+        """
+        Delivers the debits of a committed batch or refunds those of an aborted one.
+        Debits that fail to settle stay recorded, so that recover() settles them later.
+        """
+        settlements = []
+        for index in debited:
+            item, transfer_id = items[index], f"{batch_id}/{index}"
+            to_account_id = item[2] if item[0] == 'ADD' else WITHDRAWAL
+            if committed:
+                settlements.append(self.__deliver(transfer_id, item[1], to_account_id, item[-1], None))
+            else:
+                shard = self.shard(item[1])
+                settlements.append(
+                    self.transfers[shard].submit(self.shards[shard].refund_operation(transfer_id, item[1], item[-1]))
+                )
+        await asyncio.gather(*settlements, return_exceptions=True)
+
+    def __accounts(self, item: BatchItem) -> List[str]:
+        if isinstance(item, Exception):
+            return []
+        if item[0] == 'ADD':
+            return [item[1], item[2]]
+        return [item[1]]
+
+    def __operation(self, accounts: Accounts, item: BatchItem):
+        if isinstance(item, Exception):
+            return failed_operation(item)
+        if item[0] == 'ADD':
+            return accounts.transfer_operation(item[1], item[2], item[3])
+        return accounts.withdraw_operation(item[1], item[2])
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from Client.Accounts import Accounts
+from Client.Executors import Executors
+from Tracing import SpanContext, Tracer, current_span
+
+
+class TransferQueue():
+    """
+    This class provides group commit of transfers.
+
+    Every transaction ends with a commit that has to reach the disk, which limits the number of transfers per second.
+    Transfers requested concurrently are therefore collected for batch_window seconds or until there is max_batch of them
+    and applied by Accounts in a single transaction. Every caller still receives its own result or exception.
+    Only one batch is written at a time and it is written in the database worker pool.
+    The transaction is recorded in the traces of all the transfers it applied, next to the time they waited for it.
+    """
+
+    def __init__(self, accounts: Accounts, executors: Executors, max_batch: int = 64, batch_window: float = 0.002,
+                 tracer: Optional[Tracer] = None):
+        self.accounts = accounts
+        self.executors = executors
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.tracer = tracer or Tracer('accounts')
+        self.pending: List[Tuple[Callable, asyncio.Future, Optional[SpanContext]]] = []
+        self.batch_full = asyncio.Event()
+        self.writer = None
+
+    async def transfer_money(self, from_account_id: str, to_account_id: str, amount: int,
+                             response_key: Optional[Tuple[str, str]] = None):
+        return await self.submit(self.accounts.transfer_operation(from_account_id, to_account_id, amount, response_key))
+
+    async def withdraw_money(self, account_id: str, amount: int, response_key: Optional[Tuple[str, str]] = None):
+        return await self.submit(self.accounts.withdraw_operation(account_id, amount, response_key))
+
+    async def apply_batch(self, operations: List[Callable], atomic: bool, response_key: Optional[Tuple[str, str]] = None) -> str:
+        return await self.submit(self.accounts.batch_operation(operations, atomic, response_key))
+
+    async def submit(self, operation: Callable) -> Any:
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((operation, future, current_span.get()))
+        if len(self.pending) >= self.max_batch:
+            self.batch_full.set()
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.__write())
+        return await future
+
+    async def __write(self):
+        while self.pending:
+            if len(self.pending) < self.max_batch:
+                self.batch_full.clear()
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            start, started = time.time(), time.perf_counter()
+            try:
+                results = await self.executors.run_database(
+                    self.accounts.apply_operations, [operation for operation, _, _ in batch]
+                )
+            except Exception as exception:
+                # The whole transaction failed e.g. database is not available
+                results = [exception] * len(batch)
+            duration = time.perf_counter() - started
+            for (_, future, span), result in zip(batch, results):
+                self.tracer.record('transaction', span, start, duration, operations=len(batch))
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
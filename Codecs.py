@@ -0,0 +1,185 @@
+import base64
+import json
+import struct
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # the binary codec is optional, JSON is always available
+    msgpack = None
+
+
+def encode_bytes(data: Any) -> str:
+    """
+    JSON has no type for bytes, therefore they are sent as base64 text.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return base64.b64encode(data).decode('ascii')
+    raise TypeError(f"Object of type {type(data).__name__} is not JSON serializable")
+
+
+def to_bytes(data: Union[str, bytes]) -> bytes:
+    """
+    Returns raw bytes of binary data received with any codec.
+    """
+    if isinstance(data, bytes):
+        return data
+    return base64.b64decode(data.encode('ascii'))
+
+
+class JsonCodec():
+    """
+    Default codec, envelopes are sent as JSON text frames.
+    """
+
+    name = 'json'
+    binary = False
+
+    def encode(self, data: Any) -> str:
+        return json.dumps(data, default=encode_bytes)
+
+    def decode(self, frame: str) -> Any:
+        return json.loads(frame)
+
+
+class MessagePackCodec():
+    """
+    Compact codec, envelopes are sent as MessagePack binary frames and bytes are sent as they are.
+    """
+
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame: bytes) -> Any:
+        return msgpack.unpackb(frame, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = MessagePackCodec() if msgpack is not None else None
+
+CODECS = {codec.name: codec for codec in (JSON_CODEC, BINARY_CODEC) if codec is not None}
+
+
+def available_codecs() -> List[str]:
+    return list(CODECS)
+
+
+def choose_codec(offered: List[str], allowed: List[str]):
+    """
+    Returns the first codec offered by the client that is allowed and available, JSON otherwise.
+    """
+    for name in offered:
+        if name in allowed and name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+def decode_frame(frame: Union[str, bytes]) -> Any:
+    """
+    Text frames are always JSON and binary frames are always MessagePack,
+    so frames can be decoded regardless of the codec negotiated for sending.
+    """
+    if isinstance(frame, bytes):
+        if BINARY_CODEC is None:
+            raise Exception("Received a binary frame but MessagePack is not installed.")
+        return BINARY_CODEC.decode(frame)
+    return JSON_CODEC.decode(frame)
+
+
+def get_codec(name: Optional[str]):
+    return CODECS.get(name, JSON_CODEC)
+
+
+class Opaque():
+    """
+    A value encoded once by its sender and passed on as bytes, e.g. an encrypted message that the server only relays.
+    """
+
+    __slots__ = ('data', 'codec')
+
+    def __init__(self, data: Union[bytes, memoryview], codec):
+        self.data = data
+        self.codec = codec
+
+    @classmethod
+    def wrap(cls, value: Any, codec) -> 'Opaque':
+        encoded = codec.encode(value)
+        return cls(encoded if codec.binary else encoded.encode(), codec)
+
+    def unwrap(self) -> Any:
+        return self.codec.decode(self.data if self.codec.binary else str(self.data, 'utf-8'))
+
+
+# Relay frames start with a byte that MessagePack never uses, so they can not be mistaken for envelopes.
+# The byte is followed by the codec and the length of the header, the header holds the envelope
+# without the opaque value and the path to it, the opaque value follows the header as it is.
+RELAY_FRAME = b'\xc1'
+RELAY_HEADER = struct.Struct('!BI')
+RELAY_CODECS = ['json', 'msgpack']
+
+
+def find_opaque(value: Any) -> Optional[List[str]]:
+    """
+    Returns the path to the opaque value in the nested dictionaries of an envelope, None if there is none.
+    """
+    if isinstance(value, Opaque):
+        return []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            path = find_opaque(item)
+            if path is not None:
+                return [key] + path
+    return None
+
+
+def replace_at(envelope: dict, path: List[str], value: Any) -> dict:
+    """
+    Returns a copy of the envelope with the value at the path replaced, only the dictionaries on the path are copied.
+    """
+    envelope = dict(envelope)
+    if len(path) == 1:
+        envelope[path[0]] = value
+    else:
+        envelope[path[0]] = replace_at(envelope[path[0]], path[1:], value)
+    return envelope
+
+
+def is_relay_frame(frame: Union[str, bytes]) -> bool:
+    return isinstance(frame, bytes) and frame[:1] == RELAY_FRAME
+
+
+def encode_relay_frame(envelope: dict, path: List[str], opaque: Opaque) -> bytes:
+    header = opaque.codec.encode([path, replace_at(envelope, path, None)])
+    if not opaque.codec.binary:
+        header = header.encode()
+    # Joined at once, so that the opaque value is copied only into the frame
+    return b''.join((RELAY_FRAME, RELAY_HEADER.pack(RELAY_CODECS.index(opaque.codec.name), len(header)), header, opaque.data))
+
+
+def decode_relay_frame(frame: bytes, opaque_paths: Optional[Dict[str, List[str]]] = None) -> dict:
+    """
+    Decodes only the header of a relay frame. Without opaque_paths the opaque value is decoded too,
+    otherwise it is kept as it is and accepted only at the path given for the type of the envelope,
+    so that a party can not put an opaque value where the receiver expects something else.
+    Raises ValueError for frames that are malformed or not accepted.
+    """
+    if len(frame) < len(RELAY_FRAME) + RELAY_HEADER.size:
+        raise ValueError("Relay frame is shorter than its header!")
+    codec_index, header_length = RELAY_HEADER.unpack_from(frame, len(RELAY_FRAME))
+    codec = CODECS.get(RELAY_CODECS[codec_index]) if codec_index < len(RELAY_CODECS) else None
+    if codec is None:
+        raise ValueError(f"Relay frame has an unknown codec {codec_index}!")
+    start = len(RELAY_FRAME) + RELAY_HEADER.size
+    header = frame[start:start + header_length]
+    path, envelope = codec.decode(header if codec.binary else header.decode())
+    if opaque_paths is not None and (not isinstance(envelope, dict) or path != opaque_paths.get(envelope.get('type'))):
+        raise ValueError(f"Relay frame has an opaque value at {path}, which is not accepted!")
+    # The opaque value is a view of the frame, not a copy
+    opaque = Opaque(memoryview(frame)[start + header_length:], codec)
+    try:
+        return replace_at(envelope, path, opaque if opaque_paths is not None else opaque.unwrap())
+    except (KeyError, TypeError):
+        raise ValueError(f"Relay frame has no place for an opaque value at {path}!")
@@ -0,0 +1,82 @@
+from typing import List, Optional, Tuple
+
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory, ServerPerMessageDeflateFactory
+
+# Opcodes of continuation frames and the lowest opcode of control frames, see RFC 6455
+OP_CONT = 0
+OP_CLOSE = 8
+
+
+class MinimumSizeDeflate():
+    """
+    permessage-deflate leaving messages shorter than min_size uncompressed, e.g. responses without payload.
+
+    The extension allows sending any message uncompressed by leaving its RSV1 bit unset.
+    Such messages do not pass through the compressor, so its context stays valid for the following messages.
+    """
+
+    def __init__(self, extension, min_size: int):
+        self.extension = extension
+        self.name = extension.name
+        self.min_size = min_size
+
+    def decode(self, frame, *, max_size: Optional[int] = None):
+        return self.extension.decode(frame, max_size=max_size)
+
+    def encode(self, frame):
+        if frame.opcode != OP_CONT and frame.opcode < OP_CLOSE and frame.fin and len(frame.data) < self.min_size:
+            return frame
+        return self.extension.encode(frame)
+
+    def __repr__(self) -> str:
+        return f"MinimumSizeDeflate({self.extension!r}, min_size={self.min_size})"
+
+
+class ServerDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions) -> Tuple[list, MinimumSizeDeflate]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, MinimumSizeDeflate(extension, self.min_size)
+
+
+class ClientDeflateFactory(ClientPerMessageDeflateFactory):
+
+    def __init__(self, min_size: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_response_params(self, params, accepted_extensions) -> MinimumSizeDeflate:
+        return MinimumSizeDeflate(super().process_response_params(params, accepted_extensions), self.min_size)
+
+
+def compress_settings(config: dict) -> dict:
+    """
+    Arguments of zlib.compressobj besides the window, the level trades CPU for bytes and memory_level memory for speed.
+    """
+    return {'level': int(config.get('level', 6)), 'memLevel': int(config.get('memory_level', 8))}
+
+
+def compression_options(config: Optional[dict], server: bool) -> dict:
+    """
+    Returns the keyword arguments of websockets.serve or websockets.connect for the compression section of a configuration.
+
+    Without the section the defaults of the websockets library apply.
+    Both parties ask for the same window_bits, a party with a smaller window makes the other one use it as well.
+    """
+    if not config:
+        return {}
+    if config.get('enabled', '1') != '1':
+        return {'compression': None}
+    window_bits = int(config.get('window_bits', 15))
+    options = {
+        'server_max_window_bits': window_bits,
+        'client_max_window_bits': window_bits,
+        'compress_settings': compress_settings(config),
+        'min_size': int(config.get('min_size', 0))
+    }
+    extensions: List = [ServerDeflateFactory(**options) if server else ClientDeflateFactory(**options)]
+    return {'compression': None, 'extensions': extensions}
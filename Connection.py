@@ -1,10 +1,12 @@
 import asyncio
-import json
 import uuid
 import logging
-from typing import Any
+from typing import Any, Dict, List, Optional
 
-from websockets import WebSocketCommonProtocol
+from websockets import WebSocketCommonProtocol, ConnectionClosed
+
+from Codecs import JSON_CODEC, decode_frame, decode_relay_frame, encode_relay_frame, find_opaque, is_relay_frame, replace_at
+from Tracing import envelope_trace
 
 logger = logging.getLogger("Connection")
 
@@ -31,12 +33,52 @@ class Connection():
     The sending party needs to monitor all incoming messages looking for the reports.
     Meanwhile the rest of communication must be allowed to continue uninterrupted.
     The handling of reports and other communication is done in receive() and receive_many().
+
+    Every request in flight has a future in the pending table of the connection, resolved by the matching report.
+    A request fails when no report arrives within the timeout and all requests in flight fail once the socket closes.
+
+    Every attempt of a request has a new id, but a request that may be retried carries an idempotency key
+    that stays the same for all the attempts, so that the recipient can recognize the duplicates,
+    and the number of the attempt, so that the recipient looks for an earlier result only when the request is retried.
+    A request sent inside a traced span carries the trace, so that the recipient can continue it (see Tracing.py).
+
+    When batching is enabled, envelopes sent within a short window are sent together as one frame holding an array.
+    Frames holding a single envelope as well as arrays of envelopes are always accepted.
+
+    Envelopes are sent as JSON text frames unless another codec is negotiated (see Codecs.py).
+    Incoming frames are decoded according to their type, so both kinds are always accepted.
+
+    An envelope holding an opaque value (see Codecs.Opaque) is sent as a relay frame when the other party accepts them,
+    the envelope without the value is encoded as a small header and the bytes of the value follow it untouched.
+    The server keeps received opaque values as they are, so relaying a message costs decoding the header only,
+    but only at the paths of opaque_paths, e.g. the message of a send_message request, other relay frames are refused.
+    Other parties get the opaque value decoded and the envelope encoded as usual.
     """
-    requests = dict()
-    responses = dict()
 
-    def __init__(self, websocket: WebSocketCommonProtocol):
+    def __init__(self, websocket: WebSocketCommonProtocol, timeout: Optional[float] = None):
         self.websocket = websocket
+        # Identifies this particular connection, a client that reconnects gets a new one
+        self.id = str(uuid.uuid4())
+        # Default time to wait for a report, None waits forever
+        self.timeout = timeout
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.closed = False
+        self.batch_window: Optional[float] = None
+        self.batch_max_size = 1
+        self.batch_envelopes: List[dict] = []
+        self.batch_sent: Optional[asyncio.Future] = None
+        self.codec = JSON_CODEC
+        # Whether the other party accepts relay frames and, by envelope type, the paths where opaque values
+        # of received relay frames are left encoded, None decodes them wherever they are
+        self.relay_frames = False
+        self.opaque_paths: Optional[Dict[str, List[str]]] = None
+
+    def set_codec(self, codec) -> None:
+        self.codec = codec
+
+    def enable_batching(self, window: float = 0.001, max_size: int = 64) -> None:
+        self.batch_window = window
+        self.batch_max_size = max_size
 
     async def action(self, action: str, data: Any, *args, **kwargs) -> Any:
         return await self.request({'action': action, 'data': data}, *args, **kwargs)
@@ -49,12 +91,22 @@ class Connection():
             logger.exception("Sending message failed.")
             return False
 
-    async def request(self, payload: Any, max_tries: int = 1, backoff: float = 1.) -> Any:
-        for _ in range(max_tries):
+    async def request(self, payload: Any, max_tries: int = 1, backoff: float = 1., timeout: Optional[float] = None,
+                      idempotency_key: Optional[str] = None) -> Any:
+        """
+        Sends the payload and waits for the report, retrying up to max_tries times.
+        The timeout limits every attempt separately from the backoff between the attempts.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if idempotency_key is None and max_tries > 1:
+            idempotency_key = str(uuid.uuid4())
+        for attempt in range(1, max_tries + 1):
             try:
-                return await self.__request(payload)
+                return await self.__request(payload, timeout, idempotency_key, attempt)
             except:
-                logger.exception(f"Request failed on {_} attempt.")
+                logger.exception("Request failed on %s attempt.", attempt)
+                if self.closed or attempt == max_tries:
+                    break
                 await asyncio.sleep(backoff)
         raise FailedRequest(f"Request failed after {max_tries} attempts!")
 
@@ -63,17 +115,31 @@ class Connection():
             return message
 
     async def receive_many(self):
-        async for message_string in self.websocket:
-            logger.debug("Received: " + message_string)
-            message = json.loads(message_string)
-            if 'type' in message and message['type'] == RESPONSE_TYPE:
-                request_id = message['id']
-                if request_id not in self.requests:
-                    raise Exception(f"Received response to an unknown request: {request_id}")
-                self.responses[request_id] = message
-                self.requests[request_id]['response_event'].set()
-                continue
-            yield message
+        try:
+            async for frame in self.websocket:
+                logger.debug("Received: %s", frame)
+                if is_relay_frame(frame):
+                    try:
+                        messages = decode_relay_frame(frame, self.opaque_paths)
+                    except ValueError:
+                        logger.warning("Refused relay frame.", exc_info=True)
+                        continue
+                else:
+                    messages = decode_frame(frame)
+                for message in messages if isinstance(messages, list) else (messages,):
+                    if message.get('type') == RESPONSE_TYPE:
+                        response_future = self.pending.pop(message['id'], None)
+                        if response_future is None or response_future.done():
+                            # The request may have timed out already
+                            logger.warning("Received response to an unknown request: %s", message['id'])
+                        else:
+                            response_future.set_result(message)
+                        continue
+                    yield message
+        except ConnectionClosed as exception:
+            self.__fail_pending(exception)
+            raise
+        self.__fail_pending(FailedRequest("Connection closed."))
 
     async def report_success(self, request_id: str, payload: Any = None):
         await self.__response(request_id, payload=payload, success=True)
@@ -81,23 +147,29 @@ class Connection():
     async def report_failure(self, request_id: str, payload: Any = None):
         await self.__response(request_id, payload=payload, success=False)
 
-    async def __request(self, payload: Any) -> Any:
+    async def __request(self, payload: Any, timeout: Optional[float], idempotency_key: Optional[str] = None,
+                        attempt: int = 1) -> Any:
 
         id = str(uuid.uuid4())
+        envelope = {'id': id, 'type': REQUEST_TYPE, 'payload': payload}
+        if idempotency_key is not None:
+            envelope['key'] = idempotency_key
+            envelope['attempt'] = attempt
+        trace = envelope_trace()
+        if trace is not None:
+            envelope['trace'] = trace
 
         try:
-            response_event = asyncio.Event()
-            envelope = {'id': id, 'type': REQUEST_TYPE, 'payload': payload}
-            self.requests[id] = {**envelope, 'response_event': response_event}
+            response_future = asyncio.get_event_loop().create_future()
+            self.pending[id] = response_future
             await self.__raw_send(envelope)
-            await response_event.wait()
-            response = self.responses[id]
+            response = await asyncio.wait_for(response_future, timeout)
+        except asyncio.TimeoutError:
+            raise FailedRequest(f"No response to request {id} within {timeout} seconds.")
         except Exception as exception:
             raise FailedRequest(exception)
         finally:
-            del self.requests[id]
-            if id in self.responses:
-                del self.responses[id]
+            self.pending.pop(id, None)
 
         if not response['success']:
             raise FailedRequest(response_payload=response['payload'])
@@ -107,6 +179,60 @@ class Connection():
     async def __response(self, request_id: str, success: bool, payload: Any = None) -> None:
         await self.__raw_send({'id': request_id, 'type': RESPONSE_TYPE, 'success': success, 'payload': payload})
 
+    def __fail_pending(self, exception: Exception) -> None:
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for response_future in pending.values():
+            if not response_future.done():
+                response_future.set_exception(exception)
+
     async def __raw_send(self, envelope: dict) -> None:
-        await self.websocket.send(json.dumps(envelope))
-        logger.debug("Sent: " + json.dumps(envelope))
+        path = find_opaque(envelope)
+        if path is not None:
+            opaque = self.__get(envelope, path)
+            if self.relay_frames and opaque.codec is self.codec:
+                # Relay frames can not be a part of an array, so they are never batched
+                await self.__send_frame(envelope, encode_relay_frame(envelope, path, opaque))
+                return
+            envelope = replace_at(envelope, path, opaque.unwrap())
+
+        if self.batch_window is None:
+            await self.__send_frame(envelope)
+            return
+
+        if self.batch_sent is None:
+            self.batch_sent = asyncio.get_event_loop().create_future()
+            asyncio.get_event_loop().call_later(self.batch_window, self.__flush_batch, self.batch_sent)
+        batch_sent = self.batch_sent
+        self.batch_envelopes.append(envelope)
+        if len(self.batch_envelopes) >= self.batch_max_size:
+            self.__flush_batch(batch_sent)
+        await asyncio.shield(batch_sent)
+
+    def __flush_batch(self, batch_sent: asyncio.Future) -> None:
+        if self.batch_sent is not batch_sent:
+            return  # already flushed because it was full
+        envelopes, self.batch_envelopes, self.batch_sent = self.batch_envelopes, [], None
+        asyncio.ensure_future(self.__send_batch(envelopes, batch_sent))
+
+    async def __send_batch(self, envelopes: List[dict], batch_sent: asyncio.Future) -> None:
+        try:
+            await self.__send_frame(envelopes[0] if len(envelopes) == 1 else envelopes)
+            batch_sent.set_result(None)
+        except Exception as exception:
+            batch_sent.set_exception(exception)
+
+    def __get(self, envelope: dict, path: List[str]) -> Any:
+        for key in path:
+            envelope = envelope[key]
+        return envelope
+
+    async def __send_frame(self, data: Any, frame: Any = None) -> None:
+        frame = self.codec.encode(data) if frame is None else frame
+        try:
+            await self.websocket.send(frame)
+        except ConnectionClosed:
+            self.closed = True
+            raise
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sent: %s", frame)
@@ -0,0 +1,188 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+
+def fields(**values) -> dict:
+    """
+    Key/value fields of a record, e.g. logger.info("Transfer requested.", extra=fields(person=person_id, amount=amount)).
+    """
+    return {'fields': values}
+
+
+def format_value(value) -> str:
+    text = value if isinstance(value, str) else str(value)
+    if text and not any(character in text for character in ' ="\n\\'):
+        return text
+    return json.dumps(text, ensure_ascii=False)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats a record as one line of key=value pairs, values with spaces or quotes are quoted as JSON strings.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = (
+            f"time={self.formatTime(record)} level={record.levelname} logger={format_value(record.name)} "
+            f"msg={format_value(record.getMessage())}"
+        )
+        for key, value in getattr(record, 'fields', {}).items():
+            line += f" {key}={format_value(value)}"
+        if record.exc_info:
+            line += f" exc={format_value(self.formatException(record.exc_info))}"
+        return line
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The format of logging.basicConfig followed by the fields of the record.
+    """
+
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        message = super().formatMessage(record)
+        for key, value in getattr(record, 'fields', {}).items():
+            message += f" {key}={format_value(value)}"
+        return message
+
+
+FORMATTERS = {'kv': KeyValueFormatter, 'text': TextFormatter}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes a share of the records of a logger and at most rate_limit records per second, bursts up to a second worth of them.
+    Warnings and errors always pass. The first record passed after some were suppressed tells how many.
+    """
+
+    def __init__(self, sample_rate: float = 1., rate_limit: float = 0.):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.updated_at = time.monotonic()
+        self.suppressed = 0
+        self.unreported = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return self.__passed(record)
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.__suppressed()
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.updated_at) * self.rate_limit)
+            self.updated_at = now
+            if self.tokens < 1:
+                return self.__suppressed()
+            self.tokens -= 1
+        return self.__passed(record)
+
+    def __suppressed(self) -> bool:
+        self.suppressed += 1
+        self.unreported += 1
+        return False
+
+    def __passed(self, record: logging.LogRecord) -> bool:
+        if self.unreported:
+            record.fields = {**getattr(record, 'fields', {}), 'suppressed': self.unreported}
+            self.unreported = 0
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records into a bounded queue without formatting them, the writer thread formats the records it writes.
+    A record that does not fit is dropped instead of blocking the event loop, the next record that fits tells how many were.
+
+    Arguments of records are formatted later, so they should not be changed after they are logged.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.unreported:
+            record.fields = {**getattr(record, 'fields', {}), 'dropped': self.unreported}
+        try:
+            self.queue.put_nowait(record)
+            self.unreported = 0
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+
+
+class LogPipeline():
+    """
+    This class moves formatting and writing of log records off the event loop.
+
+    The root logger gets a handler putting records into a bounded queue and a background thread writes them
+    to the standard error or to a file, so that a slow terminal or disk does not stall the loop.
+    Messages are formatted only when written, therefore hot paths log with %s arguments or fields instead of f-strings.
+    Chatty loggers can be sampled and rate limited, each with their own level, e.g.
+        {"level": "INFO", "format": "kv", "queue_size": "10000", "path": "",
+         "loggers": {"Bank": {"level": "INFO", "sample_rate": "0.1", "rate_limit": "100"}}}
+    """
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or {}
+        self.level = config.get('level', 'INFO')
+        self.queue: queue.Queue = queue.Queue(int(config.get('queue_size', 10000)))
+        path = config.get('path')
+        writer = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+        writer.setFormatter(FORMATTERS[config.get('format', 'text')]())
+        self.handler = BoundedQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, writer)
+        self.running = False
+        self.filters: Dict[str, SamplingFilter] = {}
+        for name, logger_config in config.get('loggers', {}).items():
+            logger = logging.getLogger(name)
+            if 'level' in logger_config:
+                logger.setLevel(logger_config['level'])
+            if 'sample_rate' in logger_config or 'rate_limit' in logger_config:
+                self.filters[name] = SamplingFilter(
+                    float(logger_config.get('sample_rate', 1)), float(logger_config.get('rate_limit', 0))
+                )
+                logger.addFilter(self.filters[name])
+
+    def start(self) -> 'LogPipeline':
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+        self.running = True
+        # Records still in the queue are written before the process exits
+        atexit.register(self.stop)
+        return self
+
+    def stop(self) -> None:
+        if self.running:
+            self.running = False
+            self.listener.stop()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.handler.dropped,
+            'suppressed': {name: sampling.suppressed for name, sampling in self.filters.items()}
+        }
+
+
+def setup_logging(config: Optional[dict] = None) -> LogPipeline:
+    return LogPipeline(config).start()
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Upper bounds of histogram buckets in seconds, from 50 microseconds doubling up to about 50 seconds
+BUCKETS = [0.00005 * 2 ** i for i in range(21)]
+
+
+class Counter():
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Histogram():
+    """
+    Counts observations in fixed buckets, so that recording costs a binary search and two additions.
+    Observations may come from worker threads, e.g. database calls, therefore they are guarded by a lock.
+    """
+
+    def __init__(self, buckets: List[float] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        """
+        Returns the upper bound of the bucket holding the quantile, None without observations.
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99)
+        }
+
+
+class Timer():
+    """
+    Context manager observing the time spent inside of it.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metrics():
+    """
+    This class provides a registry of counters, histograms and gauges.
+
+    Counters and histograms are created once per name and labels, callers keep them and update them directly,
+    so recording a value costs only a few additions.
+    Gauges are functions called only when the metrics are read, e.g. the number of requests in flight.
+
+    Metrics can be read as a dictionary with snapshot() or as Prometheus text with render(),
+    optionally served over HTTP by serve_http().
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, tuple], Counter] = {}
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.gauges: Dict[Tuple[str, tuple], Callable[[], float]] = {}
+
+    def counter(self, name: str, **labels) -> Counter:
+        key = (name, tuple(sorted(labels.items())))
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = Counter()
+        return counter
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def gauge(self, name: str, function: Callable[[], float], **labels) -> None:
+        self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        for (name, labels), counter in list(self.counters.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': counter.value})
+        for (name, labels), function in list(self.gauges.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': function()})
+        for (name, labels), histogram in list(self.histograms.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), **histogram.snapshot()})
+        return snapshot
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metrics, kind in ((self.counters, 'counter'), (self.gauges, 'gauge')):
+            for name, entries in self.__by_name(metrics).items():
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, metric in entries:
+                    value = metric.value if kind == 'counter' else metric()
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, entries in self.__by_name(self.histograms).items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in entries:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + [float('inf')], histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve_http(self, host: str = '127.0.0.1', port: int = 9100):
+        """
+        Serves the metrics in the Prometheus text format to every HTTP request.
+        """
+        async def respond(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(respond, host, port)
+
+    def __by_name(self, metrics: dict) -> Dict[str, list]:
+        by_name = {}
+        for (name, labels), metric in list(metrics.items()):
+            by_name.setdefault(name, []).append((labels, metric))
+        return by_name
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
@@ -0,0 +1,116 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict
+
+from Connection import Connection
+
+
+class Admission():
+    """
+    This class limits the number of requests handled at once, per connection and in total.
+
+    A request that can not start right away waits in a bounded queue of its connection.
+    When a request finishes, the next request is taken from the connections with waiting requests in turns,
+    so that a connection flooding the server waits for its own requests instead of delaying everybody else.
+    A request that does not fit into the queue is rejected and the caller reports the overload to the client.
+
+    A request may be sent on behalf of another one that is still in flight, e.g. the challenge that the bank sends
+    to a person while handling the message of that person. Waiting for the slots held by the outer requests could
+    stall both of them, so the caller reserves slots for such requests, which start right away outside of the limits.
+    """
+
+    def __init__(self, max_in_flight_per_connection: int = 16, max_in_flight: int = 1024, max_queued_per_connection: int = 64):
+        self.max_in_flight_per_connection = max_in_flight_per_connection
+        self.max_in_flight = max_in_flight
+        self.max_queued_per_connection = max_queued_per_connection
+        self.in_flight = 0
+        self.in_flight_by_connection: Dict[Connection, int] = {}
+        self.reserved_by_connection: Dict[Connection, int] = {}
+        self.queued_by_connection: Dict[Connection, Deque[Callable[[], Awaitable]]] = {}
+        # Connections with queued requests that are below their own limit, served in turns
+        self.ready: Deque[Connection] = deque()
+        self.rejected = 0
+
+    def submit(self, connection: Connection, handle: Callable[[], Awaitable], reserved: int = 0) -> bool:
+        """
+        Starts or queues handling of a request, returns False if the request was rejected.
+        Up to `reserved` requests of the connection are started at once regardless of the limits.
+        """
+        if self.reserved_by_connection.get(connection, 0) < reserved:
+            self.__start_reserved(connection, handle)
+            return True
+        if not self.ready and connection not in self.queued_by_connection and self.__can_start(connection):
+            self.__start(connection, handle)
+            return True
+        queued = self.queued_by_connection.setdefault(connection, deque())
+        if len(queued) >= self.max_queued_per_connection:
+            self.rejected += 1
+            return False
+        queued.append(handle)
+        if self.__below_connection_limit(connection) and connection not in self.ready:
+            self.ready.append(connection)
+        self.__dispatch()
+        return True
+
+    def forget(self, connection: Connection) -> None:
+        """
+        Drops the queued requests of a closed connection, the requests in flight finish on their own.
+        """
+        if self.queued_by_connection.pop(connection, None) is not None and connection in self.ready:
+            self.ready.remove(connection)
+
+    def queued(self) -> int:
+        return sum(len(queued) for queued in self.queued_by_connection.values())
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'reserved': sum(self.reserved_by_connection.values()),
+            'queued': self.queued(),
+            'rejected': self.rejected
+        }
+
+    def __below_connection_limit(self, connection: Connection) -> bool:
+        return self.in_flight_by_connection.get(connection, 0) < self.max_in_flight_per_connection
+
+    def __can_start(self, connection: Connection) -> bool:
+        return self.in_flight < self.max_in_flight and self.__below_connection_limit(connection)
+
+    def __start(self, connection: Connection, handle: Callable[[], Awaitable]) -> None:
+        self.in_flight += 1
+        self.in_flight_by_connection[connection] = self.in_flight_by_connection.get(connection, 0) + 1
+        task = asyncio.ensure_future(handle())
+        task.add_done_callback(lambda _: self.__finished(connection))
+
+    def __start_reserved(self, connection: Connection, handle: Callable[[], Awaitable]) -> None:
+        self.reserved_by_connection[connection] = self.reserved_by_connection.get(connection, 0) + 1
+        task = asyncio.ensure_future(handle())
+        task.add_done_callback(lambda _: self.__reserved_finished(connection))
+
+    def __reserved_finished(self, connection: Connection) -> None:
+        remaining = self.reserved_by_connection[connection] - 1
+        if remaining:
+            self.reserved_by_connection[connection] = remaining
+        else:
+            del self.reserved_by_connection[connection]
+
+    def __finished(self, connection: Connection) -> None:
+        self.in_flight -= 1
+        remaining = self.in_flight_by_connection[connection] - 1
+        if remaining:
+            self.in_flight_by_connection[connection] = remaining
+        else:
+            del self.in_flight_by_connection[connection]
+        if connection in self.queued_by_connection and connection not in self.ready:
+            self.ready.append(connection)
+        self.__dispatch()
+
+    def __dispatch(self) -> None:
+        while self.ready and self.in_flight < self.max_in_flight:
+            connection = self.ready.popleft()
+            queued = self.queued_by_connection[connection]
+            self.__start(connection, queued.popleft())
+            if not queued:
+                del self.queued_by_connection[connection]
+            elif self.__below_connection_limit(connection):
+                self.ready.append(connection)
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import socket
+import stat
+import struct
+from logging import Logger
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from Codecs import BINARY_CODEC, JSON_CODEC
+from Connection import Connection, FailedRequest, REQUEST_TYPE, RESPONSE_TYPE
+from LogPipeline import fields
+from Tracing import Tracer
+
+# Every frame on the bus is prefixed by its length and its kind
+HEADER = struct.Struct('!IB')
+TEXT_FRAME = 0
+BINARY_FRAME = 1
+# Where relay frames of workers may hold an opaque value: the message forwarded by the relay action and the payload of a response
+BUS_OPAQUE_PATHS = {REQUEST_TYPE: ['payload', 'data', 'payload', 'message'], RESPONSE_TYPE: ['payload']}
+# Credentials of the process on the other end of a Unix socket: pid, uid and gid
+PEER_CREDENTIALS = struct.Struct('3i')
+
+
+def private_directory(path: str) -> None:
+    """
+    Creates the directory readable only by the user, or checks that an existing one is,
+    so that other local users can not replace the sockets of the workers with their own.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory owned by the user and accessible only to the user!")
+
+
+def peer_uid(writer: asyncio.StreamWriter) -> Optional[int]:
+    """
+    Returns the user id of the process on the other end of the socket, None where the system does not tell.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = writer.get_extra_info('socket').getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+    return PEER_CREDENTIALS.unpack(credentials)[1]
+
+
+class StreamSocket():
+    """
+    This class presents a Unix socket stream with the interface of a websocket used by Connection.
+    Frames are prefixed by their length, so that the stream can be split back into frames.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.drain_lock = asyncio.Lock()
+
+    async def send(self, frame) -> None:
+        if isinstance(frame, str):
+            kind, data = TEXT_FRAME, frame.encode()
+        else:
+            kind, data = BINARY_FRAME, frame
+        self.writer.write(HEADER.pack(len(data), kind) + data)
+        # Concurrent drains of one writer are not allowed
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    def __aiter__(self):
+        return self.__frames()
+
+    async def __frames(self):
+        while True:
+            try:
+                length, kind = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+                data = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            yield data.decode() if kind == TEXT_FRAME else data
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class Bus():
+    """
+    This class connects the worker processes of the server with each other over Unix sockets.
+
+    Every pair of workers shares one connection, the worker with the higher index connects to the one with the lower.
+    The connections are wrapped in Connection, so that workers can send requests to each other and wait for the reports
+    the same way as clients and the server do.
+
+    Requests from other workers are dispatched to actions, which are called with the data and the index of the worker.
+
+    The bus has no authentication of its own, instead the sockets live in a directory accessible only to the user
+    running the server and connections from processes of other users are refused.
+    """
+
+    def __init__(self, worker: int, workers: int, socket_dir: str, logger: Logger,
+                 actions: Dict[str, Callable[[dict, int], Awaitable]],
+                 connected: Callable[[int], Awaitable], disconnected: Callable[[int], None],
+                 timeout: Optional[float] = None, batching: Optional[dict] = None, connect_timeout: float = 10.,
+                 tracer: Optional[Tracer] = None):
+        self.worker = worker
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.logger = logger
+        self.actions = actions
+        self.connected = connected
+        self.disconnected = disconnected
+        self.timeout = timeout
+        self.batching = batching
+        self.connect_timeout = connect_timeout
+        self.tracer = tracer or Tracer(f"worker-{worker}")
+        self.peers: Dict[int, Connection] = {}
+
+    def socket_path(self, worker: int) -> str:
+        return os.path.join(self.socket_dir, f"worker-{worker}.sock")
+
+    async def start(self) -> None:
+        private_directory(self.socket_dir)
+        path = self.socket_path(self.worker)
+        if os.path.exists(path):
+            os.unlink(path)
+        await asyncio.start_unix_server(self.__accept, path)
+        await asyncio.gather(*(self.__connect(worker) for worker in range(self.worker)))
+
+    async def request(self, worker: int, action: str, data: Any) -> Any:
+        peer = self.peers.get(worker)
+        if peer is None:
+            raise FailedRequest(f"Worker {worker} is not connected.")
+        return await peer.action(action, data)
+
+    def publish(self, action: str, data: Any) -> None:
+        """
+        Sends the data to every connected worker without waiting for the reports.
+        """
+        for peer in self.peers.values():
+            asyncio.ensure_future(peer.send({'action': action, 'data': data}))
+
+    async def __connect(self, worker: int) -> None:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path(worker))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        if not self.__trusted(writer):
+            raise PermissionError(f"Socket of worker {worker} belongs to another user!")
+        connection = self.__connection(reader, writer)
+        asyncio.ensure_future(self.__serve(connection, worker))
+        await connection.action('hello', {'worker': self.worker})
+        self.__add_peer(worker, connection)
+
+    async def __accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if not self.__trusted(writer):
+            self.logger.warning("Refused bus connection of a process of another user.")
+            writer.close()
+            return
+        await self.__serve(self.__connection(reader, writer))
+
+    def __trusted(self, writer: asyncio.StreamWriter) -> bool:
+        uid = peer_uid(writer)
+        return uid is None or uid == os.getuid()
+
+    def __connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Connection:
+        connection = Connection(StreamSocket(reader, writer), timeout=self.timeout)
+        connection.set_codec(BINARY_CODEC or JSON_CODEC)
+        # Workers forward relayed messages between each other without decoding them
+        connection.relay_frames = True
+        connection.opaque_paths = BUS_OPAQUE_PATHS
+        if self.batching is not None:
+            connection.enable_batching(self.batching['window'], self.batching['max_size'])
+        return connection
+
+    def __add_peer(self, worker: int, connection: Connection) -> None:
+        self.peers[worker] = connection
+        self.logger.info("Worker connected.", extra=fields(worker=self.worker, peer=worker))
+        asyncio.ensure_future(self.connected(worker))
+
+    async def __serve(self, connection: Connection, worker: Optional[int] = None) -> None:
+        try:
+            async for request in connection.receive_many():
+                action = request['payload']['action']
+                if action == 'hello':
+                    worker = request['payload']['data']['worker']
+                    self.__add_peer(worker, connection)
+                    await connection.report_success(request['id'])
+                    continue
+                asyncio.ensure_future(self.__handle(connection, request, worker))
+        finally:
+            connection.websocket.close()
+            if self.peers.get(worker) is connection:
+                del self.peers[worker]
+                self.logger.warning("Worker lost connection.", extra=fields(worker=self.worker, peer=worker))
+                self.disconnected(worker)
+
+    async def __handle(self, connection: Connection, request: dict, worker: int) -> None:
+        payload = request['payload']
+        try:
+            with self.tracer.continue_trace(f"bus.{payload['action']}", request.get('trace'), worker=worker):
+                response = await self.actions[payload['action']](payload['data'], worker)
+        except Exception:
+            self.logger.exception("Bus action failed.", extra=fields(action=payload['action']))
+            await connection.report_failure(request['id'])
+            return
+        await connection.report_success(request['id'], response)
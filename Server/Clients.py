@@ -1,66 +1,341 @@
 import asyncio
+from collections import OrderedDict
 from logging import Logger
-from typing import Dict, List
+from typing import Dict, List, Optional, Set
 
-from Connection import Connection
+from Codecs import choose_codec
+from LogPipeline import fields
+from Connection import Connection, REQUEST_TYPE, RESPONSE_TYPE
+
+# Where relay frames of clients may hold an opaque value: the message of send_message and the payload of a response
+CLIENT_OPAQUE_PATHS = {REQUEST_TYPE: ['payload', 'data', 'message'], RESPONSE_TYPE: ['payload']}
+
+class UnknownClient(Exception):
+    pass
+
+def normalize(alias: str) -> str:
+    """
+    Normalizes a client id or name, so that "Küppers,  bastian" finds the client registered as "Küppers, Bastian".
+    """
+    return ", ".join(" ".join(part.split()) for part in alias.split(",")).casefold()
+
+class RegisteredClient():
+
+    def __init__(self, info: dict, connection: Optional[Connection] = None,
+                 connection_id: Optional[str] = None, worker: Optional[int] = None):
+        self.id = info['id']
+        # Clients connected to another worker of the server have no connection here, only the index of the worker
+        self.connection = connection
+        self.connection_id = connection.id if connection is not None else connection_id
+        self.worker = worker
+        self.info = info
+        # Names as provided by the client, the registry is indexed by their normalized form
+        self.names = [info['id'], info['last_name'] + ", " + info['first_name'], info['first_name'] + ", " + info['last_name']]
+        self.aliases = list(OrderedDict.fromkeys(normalize(name) for name in self.names))
 
 class Clients():
     """
     This class provides away of tracking client connections and other client related information.
-    """
 
-    clients_by_id = {}
-    waiting_for_registration_by_id:Dict[str, List[asyncio.Event]] = {}
+    Every connected client has a single record indexed by its id.
+    Its id and names are normalized into an alias index pointing at the id, so that a client can be found by any of them.
+    Both are cleaned up when the client disconnects, therefore their size follows the number of connected clients.
+
+    When the server runs many workers, clients connected to the other workers are registered as remote
+    with the index of their worker, so that messages can be routed to them (see Server/Bus.py).
+
+    A connection may serve many clients, e.g. a host of virtual clients (see Client/Host.py).
+    The first client registers when the connection opens and the others with register_hosted,
+    all of them are indexed by the connection, so that they leave together when it closes.
+    """
 
-    def __init__(self, logger: Logger):
+    def __init__(self, logger: Logger, batching: Optional[dict] = None, codecs: Optional[List[str]] = None,
+                 registration_timeout: Optional[float] = 10., max_known_clients: int = 10000, relay_frames: bool = False):
         self.logger = logger
+        self.clients_by_id: Dict[str, RegisteredClient] = {}
+        self.id_by_alias: Dict[str, str] = {}
+        self.waiting_for_registration_by_alias: Dict[str, List[asyncio.Event]] = {}
+        self.deregistration_subscribers: Set[Connection] = set()
+        self.ids_by_connection_id: Dict[str, Set[str]] = {}
+        # How long a lookup waits for a client that never registered, None waits forever
+        self.registration_timeout = registration_timeout
+        # Info of clients that registered before by normalized alias,
+        # so that messages can be encrypted for them while they are offline
+        self.known_info_by_alias: OrderedDict = OrderedDict()
+        self.max_known_clients = max_known_clients
+        # Envelope batching offered to the clients that support it, e.g. {'window': 0.001, 'max_size': 64}
+        self.batching = batching
+        # Codecs that clients may choose for their connection, JSON is always allowed
+        self.codecs = codecs or ['json']
+        # Whether messages are relayed to the clients that support it without decoding them (see Connection.py)
+        self.relay_frames = relay_frames
+        self.registrations = 0
+        self.deregistrations = 0
+        self.replaced_connections = 0
+        self.registration_timeouts = 0
 
     async def get_info_by_id(self, id: str) -> Dict[str, str]:
         """
         Returns a client info provided by the client during registration.
+        The info of a client that is offline is the one from its last registration.
         """
-        return (await self.get_client_by_id(id))['info']
+        client = self.__find(id)
+        if client is not None:
+            return client.info
+        info = self.known_info_by_alias.get(normalize(id))
+        if info is not None:
+            return info
+        return (await self.get_client_by_id(id)).info
 
     async def get_connection_by_id(self, id: str) -> Connection:
         """
         Returns a client websocket connection obtained during registration.
         """
-        return (await self.get_client_by_id(id))['connection']
+        return (await self.get_client_by_id(id)).connection
+
+    def get_registered_connection(self, id: str) -> Optional[Connection]:
+        """
+        Returns the connection of a client that is connected right now, without waiting.
+        """
+        client = self.__find(id)
+        if client is None or client.connection is None or client.connection.closed:
+            return None
+        return client.connection
 
-    async def get_client_by_id(self, id: str) -> dict:
+    def get_worker(self, id: str) -> Optional[int]:
+        """
+        Returns the index of the worker of a client connected to another worker, None otherwise.
+        """
+        client = self.__find(id)
+        return client.worker if client is not None else None
+
+    def get_info(self, id: str) -> Optional[dict]:
+        client = self.__find(id)
+        return client.info if client is not None else None
+
+    def get_ids_by_connection(self, connection: Connection) -> List[str]:
+        """
+        Returns the ids of all clients served over the connection.
+        """
+        return list(self.ids_by_connection_id.get(connection.id, ()))
+
+    def is_hosted_by(self, id: str, connection: Connection) -> bool:
+        client = self.clients_by_id.get(id)
+        return client is not None and client.connection is connection
+
+    def local_clients(self) -> List[dict]:
+        return [
+            {'info': client.info, 'connection_id': client.connection_id}
+            for client in self.clients_by_id.values() if client.worker is None
+        ]
+
+    def resolve(self, id: str) -> str:
+        """
+        Returns the id of the client known under the given id or name, or the normalized name if there is no such client.
+        """
+        client = self.__find(id)
+        if client is not None:
+            return client.id
+        info = self.known_info_by_alias.get(normalize(id))
+        return info['id'] if info is not None else normalize(id)
+
+    def get_aliases(self, id: str) -> List[str]:
+        """
+        Returns the id of a connected client followed by its normalized aliases.
+        """
+        client = self.clients_by_id.get(id)
+        if client is None:
+            return []
+        return [client.id] + [alias for alias in client.aliases if alias != client.id]
+
+    async def get_client_by_id(self, id: str) -> RegisteredClient:
         """
         Returns a client websocket connection and info obtained during registration.
+        Waits at most registration_timeout for the client to register.
         """
-        if id in self.clients_by_id:
-            return self.clients_by_id.get(id)
-        await self.__wait_for_registration(id)
-        return self.clients_by_id.get(id)
+        client = self.__find(id)
+        if client is not None:
+            return client
+        try:
+            await asyncio.wait_for(self.__wait_for_registration(normalize(id)), self.registration_timeout)
+        except asyncio.TimeoutError:
+            self.registration_timeouts += 1
+            raise UnknownClient(f"Client {id} did not register within {self.registration_timeout} seconds.")
+        return self.__find(id)
 
     async def register(self, connection: Connection) -> str:
         message = await connection.receive()
         info = message['payload']
-        await self.__save_by_id(connection, info['id'], info)
-        await self.__save_by_id(connection, info['last_name'] + ", " + info['first_name'], info)
-        await self.__save_by_id(connection, info['first_name'] + ", " + info['last_name'], info)
-        await connection.report_success(message['id'])
-        self.logger.info(f"Client with id {info['id']} and name {info['last_name']}, {info['first_name']} registered.")
+        client = self.__register_local(info, connection)
+        batching = self.batching if info.get('batching') else None
+        codec = choose_codec(info.get('codecs', []), self.codecs)
+        relay_frames = self.relay_frames and bool(info.get('relay_frames'))
+        await connection.report_success(message['id'], {'batching': batching, 'codec': codec.name, 'relay_frames': relay_frames})
+        connection.set_codec(codec)
+        connection.relay_frames = relay_frames
+        if relay_frames:
+            # Messages are relayed as they were received, the server never reads them anyway
+            connection.opaque_paths = CLIENT_OPAQUE_PATHS
+        if batching is not None:
+            connection.enable_batching(batching['window'], batching['max_size'])
+        self.logger.info(
+            "Client registered.", extra=fields(id=info['id'], name=f"{info['last_name']}, {info['first_name']}", connection=connection.id)
+        )
+        self.__remember(client)
         return info['id']
 
-    def deregister(self, id: str) -> None:
+    def register_hosted(self, info: dict, connection: Connection) -> str:
+        """
+        Registers another client served over the connection of an already registered client.
+        """
+        client = self.__register_local(info, connection)
+        self.logger.info(
+            "Hosted client registered.",
+            extra=fields(id=info['id'], name=f"{info['last_name']}, {info['first_name']}", connection=connection.id)
+        )
+        self.__remember(client)
+        return info['id']
+
+    def register_remote(self, info: dict, connection_id: str, worker: int) -> None:
+        self.__save(RegisteredClient(info, connection_id=connection_id, worker=worker))
+        self.__remember(self.clients_by_id[info['id']])
+
+    def deregister(self, id: str, connection: Connection) -> bool:
+        """
+        Removes the client and all of its aliases, unless the client already registered again on another connection.
+        Returns whether the client was removed.
+        """
+        self.deregistration_subscribers.discard(connection)
+        return self.__remove(id, connection.id, None)
+
+    def deregister_remote(self, id: str, connection_id: str, worker: int) -> bool:
+        return self.__remove(id, connection_id, worker)
+
+    def forget_worker(self, worker: int) -> None:
+        """
+        Removes the clients of a worker that is no longer reachable.
+        """
+        for client in [client for client in self.clients_by_id.values() if client.worker == worker]:
+            self.__remove(client.id, client.connection_id, worker)
+
+    def in_flight_requests(self) -> int:
+        """
+        Returns the number of requests sent to the clients of this worker that still wait for a report.
+        """
+        return sum(len(client.connection.pending) for client in self.clients_by_id.values() if client.connection is not None)
+
+    def stats(self) -> dict:
+        return {
+            'clients': len(self.clients_by_id),
+            'remote_clients': sum(1 for client in self.clients_by_id.values() if client.worker is not None),
+            'aliases': len(self.id_by_alias),
+            'waiting_for_registration': sum(len(waiting) for waiting in self.waiting_for_registration_by_alias.values()),
+            'known_aliases': len(self.known_info_by_alias),
+            'registrations': self.registrations,
+            'deregistrations': self.deregistrations,
+            'replaced_connections': self.replaced_connections,
+            'registration_timeouts': self.registration_timeouts
+        }
+
+    def __register_local(self, info: dict, connection: Connection) -> RegisteredClient:
+        client = RegisteredClient(info, connection)
+        self.__save(client)
+        if 'client_deregistered' in info.get('subscriptions', []):
+            self.deregistration_subscribers.add(connection)
+        return client
+
+    def __find(self, id: str) -> Optional[RegisteredClient]:
+        client = self.clients_by_id.get(id)
+        if client is None:
+            client = self.clients_by_id.get(self.id_by_alias.get(normalize(id)))
+        return client
+
+    def __save(self, client: RegisteredClient) -> None:
+        previous = self.clients_by_id.get(client.id)
+        if previous is not None:
+            # The client registered again before its previous connection was closed
+            self.replaced_connections += 1
+            if previous.connection is not None and previous.connection is not client.connection:
+                self.deregistration_subscribers.discard(previous.connection)
+            self.__remove_aliases(previous)
+            self.__remove_from_connection(previous)
+        self.clients_by_id[client.id] = client
+        if client.worker is None:
+            self.ids_by_connection_id.setdefault(client.connection_id, set()).add(client.id)
+        for alias in client.aliases:
+            self.id_by_alias[alias] = client.id
+        self.registrations += 1
+        for alias in client.aliases:
+            self.__inform_awaiting_registration(alias)
+
+    def __remove(self, id: str, connection_id: str, worker: Optional[int]) -> bool:
+        client = self.clients_by_id.get(id)
+        if client is None or client.connection_id != connection_id or client.worker != worker:
+            return False
         del self.clients_by_id[id]
-        self.logger.info(f"Client {id} deregistered.")
+        self.__remove_aliases(client)
+        self.__remove_from_connection(client)
+        self.deregistrations += 1
+        self.logger.info("Client deregistered.", extra=fields(id=id))
+        notification = {'action': 'client_deregistered', 'data': {'id': id, 'connection_id': connection_id}}
+        for subscriber in self.deregistration_subscribers:
+            asyncio.create_task(subscriber.send(notification))
+        return True
+
+    def __remove_aliases(self, client: RegisteredClient) -> None:
+        for alias in client.aliases:
+            # Another client may have registered with the same name since
+            if self.id_by_alias.get(alias) == client.id:
+                del self.id_by_alias[alias]
+
+    def __remove_from_connection(self, client: RegisteredClient) -> None:
+        ids = self.ids_by_connection_id.get(client.connection_id)
+        if ids is None:
+            return
+        ids.discard(client.id)
+        if not ids:
+            del self.ids_by_connection_id[client.connection_id]
 
-    async def __save_by_id(self, connection, id, info):
-        self.clients_by_id[id] = {'connection': connection, 'info': info}
-        self.__inform_awaiting_registration(id)
+    def __remember(self, client: RegisteredClient) -> None:
+        previous_public_key = self.known_info_by_alias.get(normalize(client.id), {}).get('public_key')
+        for alias in client.aliases:
+            self.known_info_by_alias[alias] = client.info
+            self.known_info_by_alias.move_to_end(alias)
+        while len(self.known_info_by_alias) > self.max_known_clients:
+            self.known_info_by_alias.popitem(last=False)
+        if previous_public_key is not None and previous_public_key != client.info['public_key']:
+            self.__notify_public_key_changed(client.connection, client.id, client.names, previous_public_key)
+
+    def __notify_public_key_changed(self, connection: Optional[Connection], id: str, aliases: List[str], previous_public_key: str):
+        """
+        Tells other clients to drop the key they may have cached for the re-registered client.
+        """
+        self.logger.info("Client registered with a new public key.", extra=fields(client=id))
+        notification = {
+            'action': 'public_key_changed',
+            'data': {'id': id, 'aliases': aliases, 'previous_public_key': previous_public_key}
+        }
+        # A connection serving many clients is told once
+        connections = {
+            client.connection.id: client.connection for client in self.clients_by_id.values()
+            if client.connection is not None and client.connection is not connection
+        }
+        for other_connection in connections.values():
+            asyncio.create_task(other_connection.send(notification))
 
-    def __inform_awaiting_registration(self, id: str) -> None:
-        for registration_event in self.waiting_for_registration_by_id.get(id, []):
+    def __inform_awaiting_registration(self, alias: str) -> None:
+        for registration_event in self.waiting_for_registration_by_alias.pop(alias, []):
             registration_event.set()
-        if id in self.waiting_for_registration_by_id: del self.waiting_for_registration_by_id[id]
 
-    async def __wait_for_registration(self, id: str) -> None:
-        self.waiting_for_registration_by_id.setdefault(id, [])
+    async def __wait_for_registration(self, alias: str) -> None:
+        waiting = self.waiting_for_registration_by_alias.setdefault(alias, [])
         registration_event = asyncio.Event()
-        self.waiting_for_registration_by_id[id].append(registration_event)
-        await registration_event.wait()
\ No newline at end of file
+        waiting.append(registration_event)
+        try:
+            await registration_event.wait()
+        finally:
+            # A waiter that timed out must not stay behind
+            if registration_event in waiting:
+                waiting.remove(registration_event)
+            if not waiting and self.waiting_for_registration_by_alias.get(alias) is waiting:
+                del self.waiting_for_registration_by_alias[alias]
@@ -0,0 +1,88 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+
+
+class MailboxFull(Exception):
+    pass
+
+
+class Mailboxes():
+    """
+    This class keeps messages sent to recipients that are not connected, until they register.
+
+    Every recipient has its own mailbox holding at most max_size messages for at most ttl seconds.
+    When a mailbox is full, the new message is rejected or the oldest message is dropped depending on the overflow policy.
+    The number of mailboxes is bounded as well, so that messages to ids that never register can not exhaust the memory.
+    """
+
+    def __init__(self, max_size: int = 100, ttl: float = 3600., overflow: str = REJECT, max_mailboxes: int = 10000):
+        if overflow not in (REJECT, DROP_OLDEST):
+            raise ValueError(f"Unknown mailbox overflow policy {overflow}!")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.overflow = overflow
+        self.max_mailboxes = max_mailboxes
+        self.mailboxes: Dict[str, Deque[Tuple[float, dict]]] = {}
+        self.dropped = 0
+        self.expired = 0
+
+    def put(self, recipient_id: str, message: dict) -> None:
+        mailbox = self.mailboxes.get(recipient_id)
+        if mailbox is None:
+            if self.max_size < 1 or len(self.mailboxes) >= self.max_mailboxes:
+                raise MailboxFull(f"No mailbox available for {recipient_id}!")
+            mailbox = self.mailboxes[recipient_id] = deque()
+        if len(mailbox) >= self.max_size:
+            if self.overflow == REJECT:
+                raise MailboxFull(f"Mailbox of {recipient_id} is full!")
+            mailbox.popleft()
+            self.dropped += 1
+        mailbox.append((time.monotonic() + self.ttl, message))
+
+    def __contains__(self, recipient_id: str) -> bool:
+        return recipient_id in self.mailboxes
+
+    def pop(self, recipient_id: str) -> Optional[dict]:
+        """
+        Removes and returns the oldest message of the recipient that did not expire, None if there is none.
+        """
+        mailbox = self.mailboxes.get(recipient_id)
+        message = None
+        now = time.monotonic()
+        while mailbox and message is None:
+            expires_at, message = mailbox.popleft()
+            if expires_at <= now:
+                message = None
+                self.expired += 1
+        if mailbox is not None and not mailbox:
+            del self.mailboxes[recipient_id]
+        return message
+
+    def expire(self) -> int:
+        """
+        Drops expired messages and empty mailboxes, returns the number of dropped messages.
+        """
+        now = time.monotonic()
+        expired = 0
+        for recipient_id in list(self.mailboxes):
+            mailbox = self.mailboxes[recipient_id]
+            # Messages expire in the order they were added, because they all live for the same ttl
+            while mailbox and mailbox[0][0] <= now:
+                mailbox.popleft()
+                expired += 1
+            if not mailbox:
+                del self.mailboxes[recipient_id]
+        self.expired += expired
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            'mailboxes': len(self.mailboxes),
+            'messages': sum(len(mailbox) for mailbox in self.mailboxes.values()),
+            'dropped': self.dropped,
+            'expired': self.expired
+        }
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+Traces of requests across the clients, the server and the bank.
+
+Usage: python3 -m Tracing spans.jsonl [more.jsonl ...] [--slowest 5] [--trace TRACE_ID]
+"""
+
+import argparse
+import atexit
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+
+class SpanContext():
+
+    __slots__ = ('trace_id', 'span_id', 'sampled')
+
+    def __init__(self, trace_id: Optional[str], span_id: Optional[str], sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+
+# Work of a request that was not sampled, nothing done on its behalf is traced
+NOT_SAMPLED = SpanContext(None, None, False)
+
+# The span of the running task, inherited by the tasks it creates and carried by the requests it sends (see Connection.py)
+current_span = ContextVar('current_span', default=None)
+
+
+# Shapes of the ids made by new_id(), a trace id is made of two
+TRACE_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+SPAN_ID_PATTERN = re.compile(r'[0-9a-f]{16}')
+
+
+def new_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+def is_valid_trace(trace) -> bool:
+    """
+    Tells whether the trace of a received envelope has the shape made by envelope_trace().
+    """
+    return (
+        isinstance(trace, dict)
+        and isinstance(trace.get('id'), str) and TRACE_ID_PATTERN.fullmatch(trace['id']) is not None
+        and isinstance(trace.get('span'), str) and SPAN_ID_PATTERN.fullmatch(trace['span']) is not None
+    )
+
+
+def envelope_trace() -> Optional[dict]:
+    """
+    Returns the trace of the current span for the envelope of a request, None if the request is not traced.
+    """
+    span = current_span.get()
+    if span is None or not span.sampled:
+        return None
+    return {'id': span.trace_id, 'span': span.span_id}
+
+
+class Span():
+    """
+    Context manager timing a part of the work, spans started and requests sent inside of it become its children.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, context: SpanContext, parent_id: Optional[str], attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.token = current_span.set(self.context)
+        self.start = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        duration = time.perf_counter() - self.started
+        current_span.reset(self.token)
+        if not self.context.sampled:
+            return
+        if exception_type is not None:
+            self.attributes['error'] = exception_type.__name__
+        self.tracer.write({
+            'trace_id': self.context.trace_id,
+            'span_id': self.context.span_id,
+            'parent_id': self.parent_id,
+            'service': self.tracer.service,
+            'name': self.name,
+            'start': self.start,
+            'duration': duration,
+            **self.attributes
+        })
+
+
+class NoSpan():
+    """
+    Span inside of work that is not traced, it costs nothing and leaves the context as it is.
+    """
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class SpanWriter():
+    """
+    Appends spans to a JSONL file from a background thread, so that a slow disk does not stall the event loop.
+    Spans that do not fit into the bounded queue are dropped and counted instead of blocking.
+    """
+
+    def __init__(self, path: str, queue_size: int = 10000):
+        self.file = open(path, 'a')
+        self.spans: queue.Queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.__write, name='SpanWriter', daemon=True)
+        self.thread.start()
+        # Spans still in the queue are written before the process exits
+        atexit.register(self.close)
+
+    def put(self, span: dict) -> None:
+        try:
+            self.spans.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.spans.put(None)
+            self.thread.join()
+
+    def __write(self) -> None:
+        while True:
+            span = self.spans.get()
+            if span is None:
+                break
+            self.file.write(json.dumps(span) + "\n")
+            # Every span is complete in the file once the queue is drained
+            if self.spans.empty():
+                self.file.flush()
+        self.file.close()
+
+
+class Tracer():
+    """
+    This class records timed spans of the work done on behalf of requests.
+
+    A trace starts with a root span, e.g. sending a message, and is sampled as a whole with probability sample_rate,
+    the decision is made once by the root, so that traces are never recorded in parts.
+    Requests sent inside a sampled span carry its trace id in the envelope and the party handling them
+    continues the trace with continue_trace(), which links the spans of the client, the server and the bank.
+
+    A party with sample_rate 0 neither starts nor continues traces. Other parties could otherwise make it trace
+    all of their requests, therefore received traces are continued only if they have the expected shape,
+    and at most max_traces_per_second traces are started or continued, bursts up to a second worth of them.
+    A trace over the limit is not recorded from that party on, the requests it sends do not carry it further.
+
+    Recorded spans are kept in a ring buffer of the last ring_size spans, see recent(),
+    and appended to a JSONL file by a background writer if a path is given,
+    so that the files of all processes can be merged by the report below.
+    With sample_rate 0 spans cost a lookup of the context.
+    """
+
+    def __init__(self, service: str, sample_rate: float = 0., ring_size: int = 1000, path: Optional[str] = None,
+                 max_traces_per_second: float = 100., queue_size: int = 10000):
+        self.service = service
+        self.sample_rate = sample_rate
+        self.spans: deque = deque(maxlen=ring_size)
+        self.writer = SpanWriter(path, queue_size) if path else None
+        self.recorded = 0
+        self.max_traces_per_second = max_traces_per_second
+        self.tokens = max_traces_per_second
+        self.updated_at = time.monotonic()
+        self.limited = 0
+
+    @classmethod
+    def from_config(cls, service: str, config: dict) -> 'Tracer':
+        return cls(
+            service,
+            sample_rate=float(config.get('sample_rate', 0)),
+            ring_size=int(config.get('ring_size', 1000)),
+            path=config.get('path') or None,
+            max_traces_per_second=float(config.get('max_traces_per_second', 100)),
+            queue_size=int(config.get('queue_size', 10000))
+        )
+
+    def span(self, name: str, **attributes):
+        """
+        Starts a child of the current span, or a new trace if there is none.
+        """
+        parent = current_span.get()
+        if parent is None:
+            if not self.sample_rate or random.random() >= self.sample_rate or not self.__admit():
+                return Span(self, name, NOT_SAMPLED, None, attributes)
+            return Span(self, name, SpanContext(new_id() + new_id(), new_id(), True), None, attributes)
+        if not parent.sampled:
+            return NO_SPAN
+        return Span(self, name, SpanContext(parent.trace_id, new_id(), True), parent.span_id, attributes)
+
+    def continue_trace(self, name: str, trace: Optional[dict], **attributes):
+        """
+        Starts a span of work requested by another party, it is traced only if the request was and this party traces.
+        """
+        if trace is None or not self.sample_rate or not is_valid_trace(trace) or not self.__admit():
+            return Span(self, name, NOT_SAMPLED, None, attributes)
+        return Span(self, name, SpanContext(trace['id'], new_id(), True), trace['span'], attributes)
+
+    def record(self, name: str, parent: Optional[SpanContext], start: float, duration: float, **attributes) -> None:
+        """
+        Records a span measured elsewhere, e.g. a database transaction shared by many requests.
+        """
+        if parent is None or not parent.sampled:
+            return
+        self.write({
+            'trace_id': parent.trace_id,
+            'span_id': new_id(),
+            'parent_id': parent.span_id,
+            'service': self.service,
+            'name': name,
+            'start': start,
+            'duration': duration,
+            **attributes
+        })
+
+    def write(self, span: dict) -> None:
+        self.recorded += 1
+        self.spans.append(span)
+        if self.writer is not None:
+            self.writer.put(span)
+
+    def recent(self) -> List[dict]:
+        return list(self.spans)
+
+    def stats(self) -> dict:
+        return {
+            'sample_rate': self.sample_rate,
+            'recorded': self.recorded,
+            'buffered': len(self.spans),
+            'limited': self.limited,
+            'dropped': self.writer.dropped if self.writer is not None else 0
+        }
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+    def __admit(self) -> bool:
+        if self.max_traces_per_second <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.max_traces_per_second, self.tokens + (now - self.updated_at) * self.max_traces_per_second)
+        self.updated_at = now
+        if self.tokens < 1:
+            self.limited += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+def load_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    """
+    Returns the spans in the files by trace id.
+    """
+    traces = {}
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    span = json.loads(line)
+                    traces.setdefault(span['trace_id'], []).append(span)
+    return traces
+
+
+def self_times(spans: List[dict]) -> Dict[str, float]:
+    """
+    Returns the time of every span not spent in its children, children running at once may cover all of it.
+    """
+    children_time = {}
+    for span in spans:
+        if span['parent_id'] is not None:
+            children_time[span['parent_id']] = children_time.get(span['parent_id'], 0.) + span['duration']
+    return {span['span_id']: max(0., span['duration'] - children_time.get(span['span_id'], 0.)) for span in spans}
+
+
+def quantile(values: List[float], quantile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+def print_breakdown(traces: Dict[str, List[dict]]) -> None:
+    by_name: Dict[str, List[tuple]] = {}
+    for spans in traces.values():
+        own = self_times(spans)
+        for span in spans:
+            by_name.setdefault(f"{span['service']} {span['name']}", []).append((span['duration'], own[span['span_id']]))
+    print(f"{'span':<40} {'count':>7} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'self ms':>9}")
+    for name, timings in sorted(by_name.items(), key=lambda item: -sum(own for _, own in item[1])):
+        durations = [duration for duration, _ in timings]
+        print(
+            f"{name:<40} {len(timings):>7} {sum(durations) / len(durations) * 1000:>9.2f} "
+            f"{quantile(durations, 0.5) * 1000:>9.2f} {quantile(durations, 0.99) * 1000:>9.2f} "
+            f"{sum(own for _, own in timings) / len(timings) * 1000:>9.2f}"
+        )
+
+
+def print_trace(trace_id: str, spans: List[dict]) -> None:
+    """
+    Prints the spans of a trace as a tree, with the start of every span relative to the start of the trace.
+    """
+    span_ids = {span['span_id'] for span in spans}
+    children: Dict[Optional[str], List[dict]] = {}
+    for span in spans:
+        # Spans whose parent was not recorded, e.g. its process wrote no file, are shown at the top
+        parent_id = span['parent_id'] if span['parent_id'] in span_ids else None
+        children.setdefault(parent_id, []).append(span)
+    started = min(span['start'] for span in spans)
+    print(f"trace {trace_id}")
+
+    def print_children(parent_id: Optional[str], depth: int) -> None:
+        for span in sorted(children.get(parent_id, []), key=lambda span: span['start']):
+            attributes = {key: value for key, value in span.items() if key not in (
+                'trace_id', 'span_id', 'parent_id', 'service', 'name', 'start', 'duration'
+            )}
+            print(
+                f"  {(span['start'] - started) * 1000:>9.2f} ms {span['duration'] * 1000:>9.2f} ms "
+                f"{'  ' * depth}{span['service']} {span['name']} {json.dumps(attributes) if attributes else ''}"
+            )
+            print_children(span['span_id'], depth + 1)
+
+    print_children(None, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuilds the latency breakdown of traced requests from span files.")
+    parser.add_argument('paths', nargs='+', help="JSONL files written by the tracers of the processes")
+    parser.add_argument('--slowest', type=int, default=3, help="number of the slowest traces to print")
+    parser.add_argument('--trace', help="print only the trace with the id")
+    args = parser.parse_args()
+
+    traces = load_spans(args.paths)
+    if args.trace is not None:
+        print_trace(args.trace, traces[args.trace])
+        return
+    print(f"{len(traces)} traces")
+    print_breakdown(traces)
+
+    def trace_duration(spans: List[dict]) -> float:
+        return max(span['start'] + span['duration'] for span in spans) - min(span['start'] for span in spans)
+
+    for trace_id, spans in sorted(traces.items(), key=lambda item: -trace_duration(item[1]))[:args.slowest]:
+        print()
+        print_trace(trace_id, spans)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,25 +4,31 @@ import logging
 import sys
 
 from Client.Bank import Bank
-
-logging.basicConfig(level=logging.INFO)
+from LogPipeline import setup_logging
 
 if len(sys.argv) > 1:
     config_file_path = sys.argv[1]
 else:
     config_file_path = input("Enter the path to your configuration file: ")
 
-with open(config_file_path) as client_data_file, open("configs/bank_permissions.json") as bank_database_file:
+# Permissions and accounts can be given after the configuration, e.g. by the load generator
+bank_permissions_file = sys.argv[2] if len(sys.argv) > 2 else "configs/bank_permissions.json"
+accounts_sqlite = sys.argv[3] if len(sys.argv) > 3 else "configs/accounts.sqlite"
+
+with open(config_file_path) as client_data_file, open(bank_permissions_file) as bank_database_file:
 
     logger = logging.getLogger("Bank")
 
     client_data = json.load(client_data_file)
+    setup_logging(client_data.get('logging'))
     bank_database = json.load(bank_database_file)
-    client = Bank(client_data, "configs/accounts.sqlite", bank_database, logger)
+    client = Bank(client_data, accounts_sqlite, bank_database, logger, bank_permissions_file)
 
     try:
         asyncio.get_event_loop().run_until_complete(client.start())
     except asyncio.TimeoutError:
         logger.info("Client closed due to limited duration.")
     except:
-        logger.exception("Client closed due to error.")
\ No newline at end of file
+        logger.exception("Client closed due to error.")
+    finally:
+        client.tracer.close()
\ No newline at end of file
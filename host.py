@@ -0,0 +1,33 @@
+import asyncio
+import json
+import logging
+import sys
+
+from Client.Host import Host
+from LogPipeline import setup_logging
+
+if len(sys.argv) > 1:
+    config_file_path = sys.argv[1]
+else:
+    config_file_path = input("Enter the path to your host configuration file: ")
+
+with open(config_file_path) as json_file:
+
+    logger = logging.getLogger("Host")
+
+    host_data = json.load(json_file)
+    setup_logging(host_data.get('logging'))
+    clients_data = []
+    for client_file_path in host_data['clients']:
+        with open(client_file_path) as client_file:
+            clients_data.append(json.load(client_file))
+    host = Host(host_data, clients_data, logger)
+
+    try:
+        asyncio.get_event_loop().run_until_complete(host.start())
+    except asyncio.TimeoutError:
+        logger.info("Host closed due to limited duration.")
+    except:
+        logger.exception("Host closed due to error.")
+    finally:
+        host.tracer.close()
@@ -5,8 +5,7 @@ import logging
 import sys
 
 from Client.Person import Person
-
-logging.basicConfig(level=logging.INFO)
+from LogPipeline import setup_logging
 
 if len(sys.argv) > 1:
     config_file_path = sys.argv[1]
@@ -18,6 +17,7 @@ with open(config_file_path) as json_file:
     logger = logging.getLogger("Person")
 
     client_data = json.load(json_file)
+    setup_logging(client_data.get('logging'))
     client = Person(client_data, logger)
 
     try:
@@ -25,4 +25,6 @@ with open(config_file_path) as json_file:
     except asyncio.TimeoutError:
         logger.info("Client closed due to limited duration.")
     except:
-        logger.exception("Client closed due to error.")
\ No newline at end of file
+        logger.exception("Client closed due to error.")
+    finally:
+        client.tracer.close()
\ No newline at end of file
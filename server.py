@@ -1,54 +1,281 @@
 #!/usr/bin/env python
 
 import asyncio
+import json
 import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
 
 import websockets
 
-from Connection import Connection
+from Compression import compression_options
+from Connection import Connection, FailedRequest
+from LogPipeline import fields, setup_logging
+from Metrics import Metrics
+from Tracing import Tracer
+from Server.Admission import Admission
+from Server.Bus import Bus
 from Server.Clients import Clients
-
-logging.basicConfig(level=logging.INFO)
+from Server.Mailboxes import Mailboxes, MailboxFull
 
 logger = logging.getLogger("Server")
 
-clients = Clients(logger)
+config = {}
+if len(sys.argv) > 1:
+    with open(sys.argv[1]) as config_file:
+        config = json.load(config_file)
+
+# Records are formatted and written by a background thread, see LogPipeline.py
+log_pipeline = setup_logging(config.get('logging'))
+
+# With many workers the server starts a process per worker, all of them listening on the same port
+workers_config = config.get('workers', {})
+workers = int(workers_config.get('count', 1))
+worker = int(sys.argv[sys.argv.index('--worker') + 1]) if '--worker' in sys.argv else None
+if worker is not None:
+    logger = logging.getLogger(f"Server-{worker}")
+
+# How long to wait for a client to report on a message relayed to it
+relay_timeout = float(config.get('relay_timeout', 30))
+
+batching = None
+if config.get('batching', {}).get('enabled', '0') == '1':
+    batching = {
+        'window': float(config['batching'].get('window', 0.001)),
+        'max_size': int(config['batching'].get('max_size', 64))
+    }
+
+clients = Clients(
+    logger, batching, config.get('codecs', ['json']),
+    registration_timeout=float(config.get('registration_timeout', 10)),
+    relay_frames=config.get('relay_frames', '0') == '1'
+)
+
+# Messages for recipients that are offline wait in bounded mailboxes until the recipients register
+mailboxes_config = config.get('mailboxes', {})
+mailboxes = Mailboxes(
+    max_size=int(mailboxes_config.get('max_size', 100)),
+    ttl=float(mailboxes_config.get('ttl', 3600)),
+    overflow=mailboxes_config.get('overflow', 'reject'),
+    max_mailboxes=int(mailboxes_config.get('max_mailboxes', 10000))
+)
+mailboxes_expire_interval = float(mailboxes_config.get('expire_interval', 60))
+
+# Recipients whose mailboxes are being delivered, new messages for them queue up behind the delivered ones
+draining = set()
+
+bus = None
+
+# Limits of requests handled at once, relayed messages wait for other clients while lookups do not,
+# so they have separate limits and a flood of messages can not hold up the lookups needed to answer them
+admission_config = config.get('admission', {})
+relay_admission, lookup_admission = (
+    Admission(
+        max_in_flight_per_connection=int(admission_config.get('max_in_flight_per_connection', 16)),
+        max_in_flight=int(admission_config.get('max_in_flight', 1024)),
+        max_queued_per_connection=int(admission_config.get('max_queued_per_connection', 64))
+    )
+    for _ in range(2)
+)
+
+metrics = Metrics()
+# Sampled spans of the requests handled by the server, continuing the traces of the clients (see Tracing.py)
+tracer = Tracer.from_config(logger.name, config.get('tracing', {}))
+metrics.gauge('server_clients', lambda: len(clients.local_clients()))
+metrics.gauge('server_remote_clients', lambda: clients.stats()['remote_clients'])
+metrics.gauge('server_registrations', lambda: clients.registrations)
+metrics.gauge('server_deregistrations', lambda: clients.deregistrations)
+metrics.gauge('server_in_flight_requests', lambda: clients.in_flight_requests())
+metrics.gauge('server_queued_messages', lambda: mailboxes.stats()['messages'])
+for name, admission in (('relay', relay_admission), ('lookup', lookup_admission)):
+    metrics.gauge('server_admission_in_flight', lambda admission=admission: admission.in_flight, kind=name)
+    metrics.gauge('server_admission_queued', lambda admission=admission: admission.queued(), kind=name)
+    metrics.gauge('server_admission_rejected', lambda admission=admission: admission.rejected, kind=name)
 
 class FailedAction(Exception):
     pass
 
 
-async def send_message_action(data: dict, sender_id: str, *args, **kwargs):
+async def send_message_action(data: dict, sender_id: str, connection: Connection, idempotency_key: str = None,
+                              attempt: int = 1, *args, **kwargs):
     """
     This action sends a message to a recipient form the sender.
-    If the recipient is not available it waits for the recipient to become available.
+    If the recipient is not available the message is put into its mailbox and the sender is told that it was queued.
     If message the recipient does not confirm the reception the action fails.
+    The idempotency key and the attempt of a retried request are passed to the recipient, so that it can recognize the duplicates.
+    A connection serving many clients names the sending one, which has to be registered on that connection.
+    The message is never decoded, its bytes are forwarded as they were received to recipients accepting relay frames.
+    """
+    if 'sender_id' in data:
+        if not clients.is_hosted_by(data['sender_id'], connection):
+            raise FailedAction(f"Client {data['sender_id']} is not registered on connection {connection.id}.")
+        sender_id = data['sender_id']
+    payload = {
+        'sender_id': sender_id,
+        'sender_connection_id': connection.id,
+        'message': data['message']
+    }
+    if idempotency_key is not None:
+        payload['idempotency_key'] = idempotency_key
+        payload['attempt'] = attempt
+    return await route_message(data['recipient_id'], payload)
+
+async def route_message(recipient_id: str, payload: dict, forwarded: bool = False):
+    """
+    Relays the message to the recipient connected to this worker, forwards it to the worker of the recipient
+    or queues it if the recipient is offline. Messages forwarded by another worker are not forwarded again.
     """
-    logger.debug(f"Sending message to: {data['recipient_id']}")
-    recipient_connection = await clients.get_connection_by_id(data['recipient_id'])
-    logger.debug(f"Recipient connection found: {data['recipient_id']}")
+    sender_id = payload['sender_id']
+    # Messages are queued by the id of the recipient if it is known, so that all of its names share one mailbox
+    mailbox_id = clients.resolve(recipient_id)
+    logger.debug("Sending message to: %s", recipient_id)
+    recipient_worker = clients.get_worker(recipient_id)
+    if recipient_worker is not None and mailbox_id not in draining and mailbox_id not in mailboxes:
+        if forwarded:
+            raise FailedAction(f"Recipient {recipient_id} moved to another worker.")
+        try:
+            with tracer.span('forward', worker=recipient_worker):
+                return await bus.request(recipient_worker, 'relay', {'recipient_id': recipient_id, 'payload': payload})
+        except FailedRequest:
+            raise FailedAction(f"Message send by {sender_id} was not received by {recipient_id}")
+
+    recipient_connection = clients.get_registered_connection(recipient_id)
+    if recipient_connection is None or mailbox_id in draining or mailbox_id in mailboxes:
+        try:
+            mailboxes.put(mailbox_id, payload)
+        except MailboxFull as exception:
+            raise FailedAction(str(exception))
+        logger.debug("Message queued for: %s", recipient_id)
+        return {'queued': True}
+    logger.debug("Recipient connection found: %s", recipient_id)
     try:
-        response = await recipient_connection.request(payload={'sender_id': sender_id, 'message': data['message']})
-        logger.debug(f"Message received by: {data['recipient_id']}")
+        # The recipient is named, because the connection may serve many clients
+        with tracer.span('relay', recipient=mailbox_id):
+            response = await recipient_connection.request(payload={**payload, 'recipient_id': mailbox_id})
+        logger.debug("Message received by: %s", recipient_id)
         return response
     except:
         logger.exception("Sending message failed.")
-        raise FailedAction(f"Message send by {sender_id} was not received by {data['recipient_id']}")
+        raise FailedAction(f"Message send by {sender_id} was not received by {recipient_id}")
+
+async def register_action(data: dict, client_id: str, connection: Connection, *args, **kwargs):
+    """
+    This action registers another client served over the connection of the requesting client, e.g. by a host of virtual clients.
+    """
+    announce_registration(connection, clients.register_hosted(data, connection))
+
+def announce_registration(connection: Connection, client_id: str):
+    if bus is not None:
+        bus.publish('client_registered', {'info': clients.get_info(client_id), 'connection_id': connection.id})
+    asyncio.create_task(deliver_mailbox(connection, client_id))
 
 async def get_public_key_action(client_id: str, *args, **kwargs):
     return (await clients.get_info_by_id(client_id))['public_key']
 
+async def get_peer_info_action(client_id: str, *args, **kwargs):
+    info = await clients.get_info_by_id(client_id)
+    return {'public_key': info['public_key'], 'encryption': info.get('encryption', ['rsa-oaep'])}
+
+async def deliver_mailbox(connection: Connection, client_id: str, forward: bool = False):
+    """
+    Delivers messages queued for a client that just registered, one by one in the order they were sent.
+    The messages for a client connected to another worker are forwarded through the bus connection to that worker.
+    """
+    for alias in clients.get_aliases(client_id):
+        if alias not in mailboxes:
+            continue
+        draining.add(alias)
+        try:
+            message = mailboxes.pop(alias)
+            while message is not None:
+                try:
+                    if forward:
+                        await connection.action('relay', {'recipient_id': client_id, 'payload': message})
+                    else:
+                        await connection.request(payload={**message, 'recipient_id': client_id})
+                except FailedRequest:
+                    logger.warning("Queued message not received.", extra=fields(sender=message['sender_id'], recipient=alias))
+                    if connection.closed:
+                        return
+                message = mailboxes.pop(alias)
+        finally:
+            draining.discard(alias)
+
+async def expire_mailboxes():
+    while True:
+        await asyncio.sleep(mailboxes_expire_interval)
+        expired = mailboxes.expire()
+        if expired:
+            logger.info("Dropped expired queued messages.", extra=fields(messages=expired))
+
+async def stats_action(*args, **kwargs):
+    return {
+        'clients': clients.stats(),
+        'mailboxes': mailboxes.stats(),
+        'admission': {'relay': relay_admission.stats(), 'lookup': lookup_admission.stats()},
+        'metrics': metrics.snapshot(),
+        'tracing': tracer.stats(),
+        'logging': log_pipeline.stats()
+    }
+
+async def relay_bus_action(data: dict, *args, **kwargs):
+    return await route_message(data['recipient_id'], data['payload'], forwarded=True)
+
+async def client_registered_bus_action(data: dict, peer: int, *args, **kwargs):
+    clients.register_remote(data['info'], data['connection_id'], peer)
+    if bus.peers.get(peer) is not None:
+        asyncio.create_task(deliver_mailbox(bus.peers[peer], data['info']['id'], forward=True))
+
+async def client_deregistered_bus_action(data: dict, peer: int, *args, **kwargs):
+    clients.deregister_remote(data['id'], data['connection_id'], peer)
+
+async def directory_bus_action(*args, **kwargs):
+    return clients.local_clients()
+
+async def worker_connected(peer: int):
+    """
+    Learns about the clients that connected to the other worker before the two workers were connected.
+    """
+    for client in await bus.request(peer, 'directory', None):
+        await client_registered_bus_action(client, peer)
+
+bus_actions = {
+    'relay': relay_bus_action,
+    'client_registered': client_registered_bus_action,
+    'client_deregistered': client_deregistered_bus_action,
+    'directory': directory_bus_action
+}
+
 actions = {
     'send_message': send_message_action,
-    'get_public_key': get_public_key_action
+    'register': register_action,
+    'stats': stats_action,
+    'get_public_key': get_public_key_action,
+    'get_peer_info': get_peer_info_action
+}
+
+# Metrics of every action are created up front, so that handling a request only updates them
+action_metrics = {
+    action: (
+        metrics.counter('server_requests', action=action, outcome='success'),
+        metrics.counter('server_requests', action=action, outcome='failure'),
+        metrics.histogram('server_request_seconds', action=action)
+    )
+    for action in list(actions) + ['unknown']
 }
 
 async def handler(websocket: websockets.WebSocketServerProtocol, path):
     """
     This function is responsible for registering clients and dispatching incoming messages to appropriate actions.
     """
-    connection = Connection(websocket)
+    connection = Connection(websocket, timeout=relay_timeout)
+    # Relay frames are refused until the client negotiates them at registration
+    connection.opaque_paths = {}
     client_id = await clients.register(connection)
+    announce_registration(connection, client_id)
     try:
         async for request in connection.receive_many():
             # Request handling inside this loop must be non-blocking
@@ -56,28 +283,103 @@ async def handler(websocket: websockets.WebSocketServerProtocol, path):
             # But receiving information does not happen if this loop does not progress
             # Therefore if a request handling is blocking you may encounter a dead-lock here
             # asyncio.create_task is non-blocking so it avoids the issue altogether
-            asyncio.create_task(handle_request(connection, request, client_id))
+            # Admission starts the task right away or queues it, requests beyond the limits fail immediately
+            handle = lambda request=request: handle_request(connection, request, client_id)
+            if request['payload'].get('action') == 'send_message':
+                # A client handling messages relayed to it may send messages on their behalf, like the challenge
+                # of the bank for a message of a person, so every relayed message reserves a slot for one of them
+                admitted = relay_admission.submit(connection, handle, reserved=len(connection.pending))
+            else:
+                admitted = lookup_admission.submit(connection, handle)
+            if not admitted:
+                asyncio.create_task(connection.report_failure(request['id'], {'error': 'overloaded'}))
     except websockets.ConnectionClosedError:
         print(f"Connection with client {client_id} closed.")
     finally:
-        clients.deregister(client_id)
+        relay_admission.forget(connection)
+        lookup_admission.forget(connection)
+        for hosted_id in clients.get_ids_by_connection(connection):
+            if clients.deregister(hosted_id, connection) and bus is not None:
+                bus.publish('client_deregistered', {'id': hosted_id, 'connection_id': connection.id})
 
 async def handle_request(connection: Connection, request, client_id: str):
+    action = request['payload'].get('action')
+    succeeded, failed, duration = action_metrics.get(action, action_metrics['unknown'])
+    started = time.perf_counter()
     try:
-        action = request['payload']['action']
-        if action not in actions:
-            raise FailedAction
-        response = await actions.get(action)(request['payload']['data'], client_id)
+        with tracer.continue_trace(action or 'unknown', request.get('trace'), client=client_id):
+            if action not in actions:
+                raise FailedAction
+            response = await actions.get(action)(
+                request['payload']['data'], client_id, connection, request.get('key'), request.get('attempt', 1)
+            )
         await connection.report_success(request['id'], response)
+        succeeded.inc()
     except:
+        failed.inc()
         await connection.report_failure(request['id'])
         raise
+    finally:
+        duration.observe(time.perf_counter() - started)
+
+def run_workers():
+    """
+    Starts a process for every worker and stops all of them as soon as any of them exits.
+    """
+    processes = [
+        subprocess.Popen([sys.executable, sys.argv[0], sys.argv[1], '--worker', str(index)])
+        for index in range(workers)
+    ]
+    try:
+        os.wait()
+    except KeyboardInterrupt:
+        logger.info("Server closed.")
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
 
-start_handler = websockets.serve(handler, "", 8765)
+def run():
+    global bus
+    loop = asyncio.get_event_loop()
+    if worker is not None:
+        bus = Bus(
+            worker, workers,
+            workers_config.get(
+                'socket_dir', os.path.join(tempfile.gettempdir(), f"websockets-{os.getuid()}-{config.get('port', 8765)}")
+            ),
+            logger, bus_actions,
+            connected=worker_connected, disconnected=clients.forget_worker,
+            timeout=relay_timeout, batching=batching, tracer=tracer
+        )
+        loop.run_until_complete(bus.start())
+
+    # Workers share the port, the kernel balances new connections between them
+    start_handler = websockets.serve(
+        handler, config.get('host', ""), int(config.get('port', 8765)), reuse_port=worker is not None,
+        **compression_options(config.get('compression'), server=True)
+    )
+
+    metrics_config = config.get('metrics', {})
+    if int(metrics_config.get('http_port', 0)) > 0:
+        # Every worker serves its own metrics on the next port
+        metrics_port = int(metrics_config['http_port']) + (worker or 0)
+        loop.run_until_complete(metrics.serve_http(metrics_config.get('http_host', '127.0.0.1'), metrics_port))
+        logger.info("Metrics are served.", extra=fields(port=metrics_port))
+
+    try:
+        logger.info("Server is listening...")
+        loop.run_until_complete(start_handler)
+        loop.create_task(expire_mailboxes())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        logger.info("Server closed.")
+    finally:
+        tracer.close()
 
-try:
-    logger.info("Server is listening...")
-    asyncio.get_event_loop().run_until_complete(start_handler)
-    asyncio.get_event_loop().run_forever()
-except KeyboardInterrupt:
-    logger.info("Server closed.")
+if workers > 1 and worker is None:
+    run_workers()
+else:
+    run()
@@ -0,0 +1,23 @@
+import logging
+import sys
+
+from Client.ShardedAccounts import split_accounts
+
+logging.basicConfig(level=logging.INFO)
+
+logger = logging.getLogger("Shards")
+
+if len(sys.argv) < 3:
+    print("Usage: python3 shard_accounts.py <accounts.sqlite> <shards>")
+    sys.exit(1)
+
+accounts_sqlite, shards = sys.argv[1], int(sys.argv[2])
+
+try:
+    for shard_filename in split_accounts(accounts_sqlite, shards):
+        logger.info("Created %s.", shard_filename)
+except Exception:
+    logger.exception("Failed to split the accounts.")
+    sys.exit(1)
+
+logger.info("Set \"shards\": \"%s\" in the accounts section of the bank configuration to use them.", shards)
@@ -0,0 +1,97 @@
+import asyncio
+import itertools
+import unittest
+
+from Server.Admission import Admission
+
+MAX_IN_FLIGHT = 4
+
+
+class FakeConnection():
+    """
+    Stands for a connection of the server, with the requests relayed to the client and not yet answered.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = Admission(max_in_flight_per_connection=MAX_IN_FLIGHT, max_in_flight=MAX_IN_FLIGHT, max_queued_per_connection=64)
+        self.bank = FakeConnection()
+        self.request_ids = itertools.count()
+        self.answered = 0
+
+    def submit_message(self, sender: FakeConnection, recipient: FakeConnection) -> bool:
+        """
+        Submits a message from the sender the way the server does.
+        """
+        return self.admission.submit(sender, lambda: self.relay(sender, recipient), reserved=len(sender.pending))
+
+    def submit_challenge(self, person: FakeConnection, answer: asyncio.Future) -> bool:
+        """
+        The bank sends a message to the person on behalf of the message of the person, which it answers afterwards.
+        """
+        async def handle():
+            await self.relay(self.bank, person)
+            if not answer.done():
+                answer.set_result(None)
+        return self.admission.submit(self.bank, handle, reserved=len(self.bank.pending))
+
+    async def relay(self, sender: FakeConnection, recipient: FakeConnection):
+        """
+        Relays the message and waits for the answer, the bank challenges the sender before it answers.
+        """
+        request_id = next(self.request_ids)
+        answer = recipient.pending[request_id] = asyncio.get_event_loop().create_future()
+        if recipient is self.bank:
+            asyncio.get_event_loop().call_soon(self.challenge, sender, answer)
+        else:
+            answer.set_result(None)
+        try:
+            await asyncio.wait_for(answer, 1)
+            self.answered += 1
+        finally:
+            del recipient.pending[request_id]
+
+    def challenge(self, person: FakeConnection, answer: asyncio.Future):
+        if not self.submit_challenge(person, answer):
+            answer.set_exception(Exception("Challenge rejected."))
+
+    def test_challenges_do_not_wait_for_slots_held_by_messages(self):
+        async def flood():
+            persons = [FakeConnection() for _ in range(MAX_IN_FLIGHT * 2)]
+            self.assertTrue(all(self.submit_message(person, self.bank) for person in persons))
+            self.assertEqual(self.admission.in_flight, MAX_IN_FLIGHT)
+            while self.admission.in_flight or self.admission.queued():
+                await asyncio.sleep(0.01)
+        asyncio.run(asyncio.wait_for(flood(), 5))
+        # Every message and every challenge was answered
+        self.assertEqual(self.answered, MAX_IN_FLIGHT * 4)
+        self.assertEqual(self.admission.stats(), {'in_flight': 0, 'reserved': 0, 'queued': 0, 'rejected': 0})
+
+    def test_reserved_requests_are_limited_by_reservations(self):
+        async def run():
+            started = []
+            release = asyncio.get_event_loop().create_future()
+
+            async def handle():
+                started.append(True)
+                await release
+            connection = FakeConnection()
+            for _ in range(MAX_IN_FLIGHT):
+                self.assertTrue(self.admission.submit(FakeConnection(), handle))
+            self.assertTrue(self.admission.submit(connection, handle, reserved=1))
+            # Without a reservation left the request waits for the limits
+            self.assertTrue(self.admission.submit(connection, handle, reserved=1))
+            await asyncio.sleep(0)
+            self.assertEqual(len(started), MAX_IN_FLIGHT + 1)
+            self.assertEqual(self.admission.stats()['reserved'], 1)
+            self.assertEqual(self.admission.queued(), 1)
+            release.set_result(None)
+            while self.admission.in_flight or self.admission.queued():
+                await asyncio.sleep(0)
+            self.assertEqual(len(started), MAX_IN_FLIGHT + 2)
+        asyncio.run(run())
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import apsw
+
+from Client.Accounts import BatchRolledBack, ROLLED_BACK, WITHDRAWAL
+from Client.Client import ClientResponseException
+from Client.Executors import Executors
+from Client.ShardedAccounts import ShardedAccounts, shard_filenames, shard_of, split_accounts
+
+SHARDS = 2
+BALANCE = 1000
+
+
+def accounts_in_shards() -> list:
+    """
+    Returns two accounts in every shard, so that tests can move money within a shard and between shards.
+    """
+    by_shard = {shard: [] for shard in range(SHARDS)}
+    index = 0
+    while any(len(accounts) < 2 for accounts in by_shard.values()):
+        account_id = f"account{index}"
+        if len(by_shard[shard_of(account_id, SHARDS)]) < 2:
+            by_shard[shard_of(account_id, SHARDS)].append(account_id)
+        index += 1
+    return [account_id for shard in range(SHARDS) for account_id in by_shard[shard]]
+
+
+class ShardedAccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'accounts.sqlite')
+        # a0 and a1 are in shard 0, b0 and b1 in shard 1
+        self.a0, self.a1, self.b0, self.b1 = accounts_in_shards()
+        connection = apsw.Connection(self.filename)
+        connection.cursor().execute("CREATE TABLE accounts (id TEXT NOT NULL, balance INTEGER)")
+        for account_id in (self.a0, self.a1, self.b0, self.b1):
+            connection.cursor().execute("INSERT INTO accounts VALUES (?, ?)", (account_id, BALANCE))
+        connection.close()
+        split_accounts(self.filename, SHARDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_with_accounts(self, test):
+        """
+        Runs the coroutine function with new sharded accounts, as a bank starting on the databases would have them.
+        """
+        async def run():
+            accounts = ShardedAccounts(self.filename, Executors(0, 0), shards=SHARDS)
+            try:
+                return await test(accounts)
+            finally:
+                accounts.close()
+        return asyncio.run(run())
+
+    def stored_balances(self) -> dict:
+        balances = {}
+        for shard_filename in shard_filenames(self.filename, SHARDS):
+            connection = apsw.Connection(shard_filename)
+            balances.update(connection.cursor().execute("SELECT id, balance FROM accounts"))
+            connection.close()
+        return balances
+
+    def outgoing_transfers(self) -> int:
+        count = 0
+        for shard_filename in shard_filenames(self.filename, SHARDS):
+            connection = apsw.Connection(shard_filename)
+            count += connection.cursor().execute("SELECT COUNT(*) FROM outgoing_transfers").fetchone()[0]
+            connection.close()
+        return count
+
+    def assert_money_conserved(self):
+        self.assertEqual(sum(self.stored_balances().values()), 4 * BALANCE)
+
+    def test_transfer_between_shards(self):
+        async def test(accounts):
+            await accounts.transfer_money(self.a0, self.b0, 100)
+            self.assertEqual(accounts.get_cached_balance(self.a0), BALANCE - 100)
+            self.assertEqual(accounts.get_cached_balance(self.b0), BALANCE + 100)
+
+        self.run_with_accounts(test)
+        self.assertEqual(self.stored_balances()[self.b0], BALANCE + 100)
+        self.assertEqual(self.outgoing_transfers(), 0)
+        self.assert_money_conserved()
+
+    def test_recover_delivers_transfer_interrupted_after_debit(self):
+        async def debit(accounts):
+            source = accounts.shards[0]
+            source.apply_operations([source.debit_operation('transfer', self.a0, self.b0, 100)])
+
+        self.run_with_accounts(debit)
+        self.assertEqual(self.stored_balances()[self.a0], BALANCE - 100)
+        self.assertEqual(self.outgoing_transfers(), 1)
+
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 1)
+        self.assertEqual(self.stored_balances()[self.b0], BALANCE + 100)
+        self.assertEqual(self.outgoing_transfers(), 0)
+        self.assert_money_conserved()
+
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 0)
+        self.assert_money_conserved()
+
+    def test_recover_does_not_credit_twice_after_credit(self):
+        async def debit_and_credit(accounts):
+            source, destination = accounts.shards
+            source.apply_operations([source.debit_operation('transfer', self.a0, self.b0, 100)])
+            destination.apply_operations([destination.credit_operation('transfer', self.b0, 100)])
+
+        self.run_with_accounts(debit_and_credit)
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 1)
+        self.assertEqual(self.stored_balances()[self.b0], BALANCE + 100)
+        self.assertEqual(self.outgoing_transfers(), 0)
+        self.assert_money_conserved()
+
+    def test_recover_refunds_transfer_refused_by_destination(self):
+        async def debit(accounts):
+            source = accounts.shards[0]
+            source.apply_operations([source.debit_operation('transfer', self.a0, self.b0, 100)])
+            # The account disappeared before the credit
+            accounts.shards[1].apply_operations([
+                lambda connection: connection.cursor().execute("DELETE FROM accounts WHERE id = ?", (self.b0,))
+            ])
+
+        self.run_with_accounts(debit)
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 1)
+        self.assertEqual(self.stored_balances()[self.a0], BALANCE)
+        self.assertEqual(self.outgoing_transfers(), 0)
+
+    def test_refund_is_applied_once(self):
+        async def debit_and_refund(accounts):
+            source = accounts.shards[0]
+            source.apply_operations([source.debit_operation('transfer', self.a0, self.b0, 100)])
+            source.apply_operations([source.refund_operation('transfer', self.a0, 100)])
+            source.apply_operations([source.refund_operation('transfer', self.a0, 100)])
+            self.assertEqual(accounts.get_cached_balance(self.a0), BALANCE)
+
+        self.run_with_accounts(debit_and_refund)
+        self.assertEqual(self.stored_balances()[self.a0], BALANCE)
+        self.assertEqual(self.outgoing_transfers(), 0)
+        self.assert_money_conserved()
+
+    def test_atomic_batch_across_shards(self):
+        async def test(accounts):
+            items = [('ADD', self.a0, self.b0, 100), ('ADD', self.b1, self.a1, 50), ('SUB', self.a1, 10)]
+            return json.loads(await accounts.apply_batch(items, atomic=True, response_key=('person', 'key')))
+
+        self.assertEqual(self.run_with_accounts(test), ['OK', 'OK', 'OK'])
+        balances = self.stored_balances()
+        self.assertEqual(balances[self.a0], BALANCE - 100)
+        self.assertEqual(balances[self.b0], BALANCE + 100)
+        self.assertEqual(balances[self.b1], BALANCE - 50)
+        self.assertEqual(balances[self.a1], BALANCE + 50 - 10)
+        self.assertEqual(self.outgoing_transfers(), 0)
+
+        async def response(accounts):
+            return accounts.get_response('person', 'key')
+
+        self.assertEqual(self.run_with_accounts(response), {'response': json.dumps(['OK', 'OK', 'OK'])})
+
+    def test_atomic_batch_across_shards_with_failing_item_is_rolled_back(self):
+        async def test(accounts):
+            items = [('ADD', self.a0, self.b0, 100), ('SUB', self.b1, BALANCE + 1)]
+            with self.assertRaises(BatchRolledBack) as raised:
+                await accounts.apply_batch(items, atomic=True)
+            self.assertEqual(accounts.get_cached_balance(self.a0), BALANCE)
+            return json.loads(raised.exception.response)
+
+        results = self.run_with_accounts(test)
+        self.assertEqual(results[0], ROLLED_BACK)
+        self.assertNotEqual(results[1], ROLLED_BACK)
+        self.assertEqual(set(self.stored_balances().values()), {BALANCE})
+        self.assertEqual(self.outgoing_transfers(), 0)
+
+    def test_each_batch_across_shards_applies_items_that_succeed(self):
+        async def test(accounts):
+            items = [('ADD', self.a0, self.b0, 100), ('SUB', self.b1, BALANCE + 1), ('ADD', self.b1, 'missing', 1)]
+            return json.loads(await accounts.apply_batch(items, atomic=False))
+
+        results = self.run_with_accounts(test)
+        self.assertEqual(results[0], 'OK')
+        self.assertNotEqual(results[1], 'OK')
+        self.assertEqual(results[2], "Account missing does not exist!")
+        self.assertEqual(self.stored_balances()[self.b0], BALANCE + 100)
+        self.assertEqual(self.stored_balances()[self.b1], BALANCE)
+        self.assert_money_conserved()
+
+    def test_recover_refunds_batch_interrupted_before_decision(self):
+        async def debit(accounts):
+            for shard, (account_id, to_account_id) in enumerate([(self.a0, self.b0), (self.b1, WITHDRAWAL)]):
+                accounts.shards[shard].apply_operations([
+                    accounts.shards[shard].debit_operation(f"batch/{shard}", account_id, to_account_id, 100)
+                ])
+
+        self.run_with_accounts(debit)
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 2)
+        self.assertEqual(set(self.stored_balances().values()), {BALANCE})
+        self.assertEqual(self.outgoing_transfers(), 0)
+
+    def test_recover_delivers_batch_interrupted_after_decision(self):
+        async def debit_and_commit(accounts):
+            for shard, (account_id, to_account_id) in enumerate([(self.a0, self.b0), (self.b1, WITHDRAWAL)]):
+                accounts.shards[shard].apply_operations([
+                    accounts.shards[shard].debit_operation(f"batch/{shard}", account_id, to_account_id, 100)
+                ])
+            accounts.shards[0].apply_operations([accounts.shards[0].decide_batch_operation('batch', True)])
+
+        self.run_with_accounts(debit_and_commit)
+        self.assertEqual(self.run_with_accounts(lambda accounts: accounts.recover()), 2)
+        balances = self.stored_balances()
+        self.assertEqual(balances[self.b0], BALANCE + 100)
+        self.assertEqual(balances[self.b1], BALANCE - 100)
+        self.assertEqual(sum(balances.values()), 4 * BALANCE - 100)
+        self.assertEqual(self.outgoing_transfers(), 0)
+
+    def test_batch_decision_is_made_once(self):
+        async def test(accounts):
+            coordinator = accounts.shards[0]
+            return coordinator.apply_operations([
+                coordinator.decide_batch_operation('batch', False), coordinator.decide_batch_operation('batch', True)
+            ])
+
+        self.assertEqual(self.run_with_accounts(test), [False, False])
+
+    def test_transfer_to_missing_account_is_refused_before_debit(self):
+        async def test(accounts):
+            with self.assertRaises(ClientResponseException):
+                await accounts.transfer_money(self.a0, 'missing', 100)
+
+        self.run_with_accounts(test)
+        self.assertEqual(self.stored_balances()[self.a0], BALANCE)
+
+
+class SplitAccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'accounts.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_split_leaves_no_shards(self):
+        connection = apsw.Connection(self.filename)
+        connection.cursor().execute("CREATE TABLE accounts (id TEXT NOT NULL, balance INTEGER)")
+        connection.cursor().execute("INSERT INTO accounts VALUES ('account1', 1000)")
+        # Recorded responses without the columns that are copied make the split fail after the shards were created
+        connection.cursor().execute("CREATE TABLE responses (sender_id TEXT, key TEXT)")
+        connection.close()
+
+        with self.assertRaises(apsw.SQLError):
+            split_accounts(self.filename, SHARDS)
+        self.assertEqual(os.listdir(self.directory), ['accounts.sqlite'])
+
+        connection = apsw.Connection(self.filename)
+        connection.cursor().execute("DROP TABLE responses")
+        connection.close()
+        self.assertEqual(split_accounts(self.filename, SHARDS), shard_filenames(self.filename, SHARDS))
+
+
+if __name__ == '__main__':
+    unittest.main()